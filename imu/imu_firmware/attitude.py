@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Where the camera's pointing, from the IMU.
+#
+# A complementary filter: the accelerometer (which way's up) and the
+# magnetometer (which way's north) give an absolute but noisy direction
+# for the camera's boresight; the gyros give a smooth but drifting change
+# in it from one sample to the next.  The estimate is
+#
+#   x[n] = alpha*(x[n-1] + gyro change[n]) + (1 - alpha)*measured[n]
+#
+# run on the boresight as a unit vector in east, north, up coordinates
+# (so there's no wrapping of azimuths, or trouble at the zenith), then
+# turned into alt/az at the end.  That's a first order IIR, and a batch
+# of it is a cumsum rather than a loop over samples: see iir().
+#
+# The azimuth comes out in the same convention as the HUD's alt_az
+# (planning/adsb_test/eci.py's sez_alt_az), so it can be compared with
+# (or stand in for) camera_loc directly.  In that convention east is 90
+# and north is 180; pass compass=True for the usual north = 0.
+
+import numpy as np
+
+# MPU-6050 gyro at its default +-250 deg/s full scale (the firmware
+# doesn't change it)
+GYRO_SCALE = np.deg2rad(1/131.0) # rad/s per count
+
+
+def iir(u, alpha, x0):
+    """x[n] = alpha*x[n-1] + u[n] for (N, k) u, starting from x[-1] = x0
+
+    Done in blocks short enough that alpha**-block stays well inside
+    what a float can hold without losing precision.
+    """
+    out = np.empty_like(u)
+    block = max(1, int(np.log(1e6)/-np.log(alpha))) if 0 < alpha < 1 else len(u)
+    x = np.asarray(x0, dtype=float)
+    for i in range(0, len(u), block):
+        ub = u[i:i+block]
+        p = alpha**np.arange(1, len(ub) + 1)[:,None] # alpha^(n+1)
+        out[i:i+len(ub)] = p*(x + np.cumsum(ub/p, axis=0))
+        x = out[i+len(ub)-1]
+    return out
+
+def _unit(v):
+    return v/np.maximum(np.sqrt(np.sum(v**2, axis=-1)), 1e-12)[...,None]
+
+def enu_frames(mag, accel):
+    """The east, north and up directions in the board's frame, each (N, 3)
+
+    mag should be hard and soft iron corrected (see mag_cal.py), and
+    accel is taken to be all gravity.
+    """
+    up = _unit(accel)
+    east = _unit(np.cross(mag, up))
+    north = np.cross(up, east)
+    return (east, north, up)
+
+def enu_alt_az(v, declination=0.0, compass=False):
+    """alt, az (radians) of (N, 3) east, north, up unit vectors
+
+    declination is magnetic north's bearing east of true north, in
+    radians.  See the top of the file for the az convention.
+    """
+    alt = np.arcsin(np.clip(v[:,2], -1, 1))
+    bearing = np.arctan2(v[:,0], v[:,1]) + declination
+    if compass:
+        return (alt, np.mod(bearing, 2*np.pi))
+    # sez_alt_az() of (south, east, z) = (-north, east, up)
+    return (alt, np.mod(np.pi - bearing, 2*np.pi))
+
+
+class Attitude:
+    """Complementary filter from batches of IMU samples to the boresight's alt/az
+
+    Batches are (N, 9): mag, accel, gyro, as IMUReader hands them out,
+    with the mag columns calibrated.  dt is the time between samples, tau
+    the filter's time constant (how long it trusts the gyros for), and
+    boresight the camera's axis in the board's frame.  gyro_bias, in raw
+    counts, is what the gyros read when still; any left over turns into
+    an error of about tau times itself.
+    """
+    def __init__(self, dt, tau=1.0, boresight=(1, 0, 0), gyro_bias=(0, 0, 0),
+                 declination=0.0, compass=False):
+        self.tau = tau
+        self.set_dt(dt)
+        self.boresight = _unit(np.asarray(boresight, dtype=float))
+        self.gyro_bias = np.asarray(gyro_bias, dtype=float)
+        self.declination = np.deg2rad(declination)
+        self.compass = compass
+        self.x = None # boresight, east north up, after the last sample
+
+    def set_dt(self, dt):
+        # For when the sample rate's only known once they've been coming in a while
+        self.dt = dt
+        self.alpha = self.tau/(self.tau + dt)
+
+    def update(self, batch):
+        """Filter a batch, returning the alt, az (degrees) after each sample"""
+        batch = np.asarray(batch, dtype=float)
+        mag, accel = batch[:,0:3], batch[:,3:6]
+        rates = (batch[:,6:9] - self.gyro_bias)*GYRO_SCALE
+
+        east, north, up = enu_frames(mag, accel)
+        frame = np.concatenate((east[:,None], north[:,None], up[:,None]), axis=1) # (N, 3, 3), board to ENU
+        measured = np.einsum('nij,j->ni', frame, self.boresight)
+
+        # A body fixed vector turns at rates x itself; in ENU, per sample
+        turned = np.einsum('nij,nj->ni', frame, np.cross(rates, self.boresight))*self.dt
+
+        if self.x is None:
+            self.x = measured[0]
+        a = self.alpha
+        est = iir(a*turned + (1 - a)*measured, a, self.x)
+        self.x = est[-1]
+
+        alt, az = enu_alt_az(_unit(est), self.declination, self.compass)
+        return (np.rad2deg(alt), np.rad2deg(az))
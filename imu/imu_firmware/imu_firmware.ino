@@ -6,9 +6,20 @@
 
 #include <Wire.h>
 
-// For MAG3110 calibration, run this with
+// For raw MAG3110 counts (MR lines) as well.  mag_cal.py fits the Mg
+// columns, in uT, so this isn't needed for calibration any more:
 // #define ENABLE_MAG_CAL_OUTPUT 1
 
+// For compact binary frames instead of text lines (imu_monitor.py --binary),
+// which is what lets this keep up with the MPU's 100Hz at 115200 baud:
+// #define ENABLE_BINARY_OUTPUT 1
+
+#if ENABLE_BINARY_OUTPUT
+#define LOOP_DELAY_MS 10
+#else
+#define LOOP_DELAY_MS 50
+#endif
+
 ////////////////////////////////////////////////////////////
 // MPU-6050 Stuff
 const int MPU_addr=0x68;  // I2C address of the MPU-6050
@@ -102,34 +113,8 @@ MAG3110 mag3110;
 
 const char MAG_AXES[3] = {  0, 1, 2 }; // orientation of mag axes on frame
 
-float mag_offsets[3] = { 0.0, 0.0, 0.0 };
-
-void mag_cal() {
-  digitalWrite(13, 1);
-
-  delay(100);
-
-  const int N = 2000;
-
-  for (int i = 0; i < N; i++) {
-    float xyz_uT[3];
-    mag3110.getMeasurement(xyz_uT);
-    for (char j = 0; j < 3; j++) {
-      mag_offsets[j] += xyz_uT[j];
-    }
-    delayMicroseconds(50);
-  }
-
-  Serial.print("Calibration: ");
-  for (char j = 0; j < 3; j++) {
-    mag_offsets[j] /= N;
-    Serial.print(mag_offsets[j], 2);
-    Serial.print(" ");
-  }
-  Serial.println();
-  digitalWrite(13, 0);
-}
-
+// Mg readings go out as plain uT: the hard and soft iron correction is
+// mag_cal.py's job, and has to be the same from one boot to the next.
 
 void mag_setup() {
   pinMode(13, OUTPUT);
@@ -137,9 +122,6 @@ void mag_setup() {
     Serial.println("Sensor found!");
     mag3110.setRawMode(0);
     mag3110.setSensorAutoReset(1);
-
-    mag_cal();
-
   } else {
     Serial.println("Sensor missing");
     while(1) {};
@@ -177,10 +159,29 @@ void loop(){
   Serial.println();
 #endif
 
+#if ENABLE_BINARY_OUTPUT
+  // 0xA5 0x5A, then mag, accel, gyro as 9 little-endian floats, then the
+  // low byte of the sum of those 36 bytes
+  float frame[9];
+  for (char i = 0; i < 3; i++) {
+    frame[i] = xyz_uT[ MAG_AXES[i] ];
+    frame[3 + i] = Ac[ MPU_AXES[i] ];
+    frame[6 + i] = Gy[ MPU_AXES[i] ];
+  }
+  const uint8_t *p = (const uint8_t *) frame;
+  uint8_t sum = 0;
+  for (char i = 0; i < sizeof(frame); i++) {
+    sum += p[i];
+  }
+  Serial.write(0xA5);
+  Serial.write(0x5A);
+  Serial.write(p, sizeof(frame));
+  Serial.write(sum);
+#else
   // Rearrange axes along the actual frame.
   Serial.print("Mg"); COMMA;
   for (char i = 0; i < 3; i++) {
-    float a = xyz_uT[ MAG_AXES[i] ] - mag_offsets[ MAG_AXES[i] ];
+    float a = xyz_uT[ MAG_AXES[i] ];
     Serial.print(a, 3); COMMA;
   }
 
@@ -195,7 +196,8 @@ void loop(){
   }
 
   Serial.println();
+#endif
 #undef COMMA
 
-  delay(50);
+  delay(LOOP_DELAY_MS);
 }
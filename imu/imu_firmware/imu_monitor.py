@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 
-import numpy as np
-
-import serial
-import sys
+# Watch the IMU board's output.
+#
+#   imu_monitor.py /dev/ttyUSB0 [--binary] [--interval 0.2]
+#   imu_monitor.py /dev/ttyUSB0 --fuse [--rate 100] [--cal mag_cal.json]
+#
+# Reading happens in batches (see imu_reader.py) at whatever rate the
+# board runs; printing is only of the latest sample, a few times a second.
+# With --fuse, it prints where the camera's pointing instead (see
+# attitude.py), as alt/az comparable with the HUD's camera_loc.  The
+# gyros get integrated at the sample rate measured off the port, unless
+# --rate says otherwise.
+
+import argparse
+import os
 
-port = sys.argv[1]
-speed = 115200
+import numpy as np
 
+from attitude import Attitude
+from imu_reader import IMUReader, RatePrinter
+from mag_cal import Calibration
 
 np.set_printoptions(precision=2)
 
 # Mg,632.082,-731.305,-161.944,Ac,240,0,-484,Gy,240,0,-484,^M
 
-sp = serial.Serial(port, speed)
-
 def xyz2rtp(a):
 #    print a, a.shape
     r = np.linalg.norm(a)
@@ -23,36 +33,58 @@ def xyz2rtp(a):
 
     return (r,t,p)
 
-for l in sp:
-    try:
-        fields = l.split(",", 12)
-        #print list(enumerate(fields))
-        #    continue
-        magnet = np.array(map(float, fields[1:4]))
-        accel  = np.array(map(float, fields[5:8]))
-        gyro   = np.array(map(float, fields[9:12]))
-
-        if len(gyro) != 3:
-            continue
-
-
-        #print magnet, accel, gyro
-
-        #print "%0.2f\t%0.2f\t%0.2f" % tuple(xyz2rtp(magnet).tolist())
-
-        s = ""
-        s += "%0.2f\t%0.2f\t%0.2f" % xyz2rtp(magnet)
-
-        a = np.rad2deg(np.arctan2(magnet[2], magnet[0]))
-        s += "\t%0.2f" % a
-
-
-        s += "\t\t"
-        s += "%0.2f\t%0.2f\t%0.2f" % xyz2rtp(accel)
-        s += "\t\t"    
-        s += "%0.2f\t%0.2f\t%0.2f" % xyz2rtp(gyro)
-
-        print s
-    
-    except ValueError:
-        pass
+def format_sample(sample):
+    magnet, accel, gyro = sample[0:3], sample[3:6], sample[6:9]
+
+    s = ""
+    s += "%0.2f\t%0.2f\t%0.2f" % xyz2rtp(magnet)
+
+    a = np.rad2deg(np.arctan2(magnet[2], magnet[0]))
+    s += "\t%0.2f" % a
+
+
+    s += "\t\t"
+    s += "%0.2f\t%0.2f\t%0.2f" % xyz2rtp(accel)
+    s += "\t\t"
+    s += "%0.2f\t%0.2f\t%0.2f" % xyz2rtp(gyro)
+    return s
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print what the IMU board is seeing")
+    parser.add_argument("port", help="serial port, or a file of recorded output")
+    parser.add_argument("--speed", type=int, default=115200)
+    parser.add_argument("--binary", action="store_true", help="firmware built with ENABLE_BINARY_OUTPUT")
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds between printed samples")
+    parser.add_argument("--fuse", action="store_true", help="print the camera's alt/az")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="samples per second the board's sending, for --fuse (default: measured, from a serial port; "
+                             "from a file, 100 with --binary and 20 without, as the firmware's loop delays give)")
+    parser.add_argument("--tau", type=float, default=1.0, help="--fuse's time constant, seconds")
+    parser.add_argument("--cal", default=None, help="magnetometer calibration for --fuse, from mag_cal.py")
+    args = parser.parse_args(argv)
+
+    port = args.port
+    if os.path.isfile(port):
+        port = open(port, "rb")
+    reader = IMUReader(port, args.speed, binary=args.binary)
+    printer = RatePrinter(format_sample, args.interval)
+
+    if args.fuse:
+        cal = Calibration.load(args.cal) if args.cal else None
+        fuse = Attitude(1/(args.rate or (100.0 if args.binary else 20.0)), args.tau)
+        printer = RatePrinter(lambda aa: "alt %0.2f\taz %0.2f" % tuple(aa), args.interval)
+
+    for batch in reader:
+        if args.fuse:
+            if cal is not None:
+                batch[:,0:3] = cal.apply(batch[:,0:3])
+            if args.rate is None and reader.rate():
+                fuse.set_dt(1/reader.rate())
+            printer(np.column_stack(fuse.update(batch)))
+        else:
+            printer(batch)
+
+    print reader.stats
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+# Batched reading of the IMU board's serial stream.
+#
+# Rather than a readline() and a few map(float, ...)s per sample, this
+# pulls whatever the port has waiting into a buffer in one go, decodes
+# every complete record in it at once into a preallocated (N, 9) array
+# of
+#
+#   mag x,y,z (uT), accel x,y,z, gyro x,y,z (raw MPU counts)
+#
+# and hands that batch on.  Whatever's left over (half a record) slides
+# back to the front of the buffer for next time.
+#
+# Two framings are understood:
+#
+# * text, what the firmware prints by default:
+#       Mg,632.082,-731.305,-161.944,Ac,240,0,-484,Gy,240,0,-484,\r\n
+#   Other lines (startup chatter, MR raw mag lines) are skipped, unless
+#   it's the MR lines that are wanted, for calibration.
+#
+# * binary, with the firmware built with ENABLE_BINARY_OUTPUT:
+#       0xA5 0x5A, 9 little-endian float32s, 1 byte sum of those 36 bytes
+#   which is about half the size, and is what lets the board run at the
+#   MPU's full rate at 115200 baud.
+
+import time
+
+import numpy as np
+
+N_FIELDS = 9
+
+SYNC = b'\xa5\x5a'
+PAYLOAD = 4*N_FIELDS
+FRAME = len(SYNC) + PAYLOAD + 1
+
+_PAYLOAD_IDX = np.arange(len(SYNC), len(SYNC) + PAYLOAD)
+
+
+def _decode_lines(buf, out, prefix, tags=()):
+    # Decode complete lines of prefix,v,v,...(with tags between values to
+    # drop) into out, which has a column per value.  See decode_text().
+    end = buf.rfind(b'\n')
+    if end < 0:
+        return (0, 0, 0)
+    lines = bytes(buf[:end]).split(b'\n')
+
+    which = [ i for i,l in enumerate(lines) if l.startswith(prefix) ]
+    if len(which) > len(out):
+        # Only consume up to the last line that fits
+        which = which[:len(out)]
+        end = sum(len(l) + 1 for l in lines[:which[-1] + 1]) - 1
+
+    def values(l):
+        l = l[len(prefix):]
+        for tag in tags:
+            l = l.replace(tag, b'')
+        return l.rstrip(b'\r,')
+
+    # eg Mg,x,y,z,Ac,x,y,z,Gy,x,y,z, has 12 commas, and 9 values
+    commas = out.shape[1] + len(tags) + 1
+    recs = [ values(lines[i]) for i in which if lines[i].count(b',') == commas ]
+    recs = [ r for r in recs if r.count(b',') == out.shape[1] - 1 ]
+    malformed = len(which) - len(recs)
+
+    # fromstring quietly stops at anything that isn't a number, so the
+    # trailing 0 only makes it through if everything before it did
+    vals = np.fromstring(b','.join(recs + [b'0']), sep=',')
+    if len(vals) == out.shape[1]*len(recs) + 1:
+        out[:len(recs)] = vals[:-1].reshape(-1, out.shape[1])
+        return (len(recs), end + 1, malformed)
+
+    # Something in there didn't parse as a number; fall back to doing it
+    # line by line to find out which
+    n = 0
+    for l in recs:
+        try:
+            out[n] = [ float(f) for f in l.split(b',') ]
+            n += 1
+        except ValueError:
+            malformed += 1
+    return (n, end + 1, malformed)
+
+def decode_text(buf, out):
+    """Decode the complete Mg,...,Ac,...,Gy,... records in buf (a bytearray) into out
+
+    Returns (records, bytes consumed, malformed lines).  Stops early if out
+    fills up, leaving the rest for the next call.
+    """
+    return _decode_lines(buf, out, b'Mg,', (b'Ac,', b'Gy,'))
+
+def decode_raw_mag(buf, out):
+    # Like decode_text(), for the MR,x,y,z, lines of raw MAG3110 counts
+    # from firmware built with ENABLE_MAG_CAL_OUTPUT; out is (N, 3)
+    return _decode_lines(buf, out, b'MR,')
+
+def decode_binary(buf, out):
+    """Decode the complete binary frames in buf (a bytearray) into out
+
+    Returns (records, bytes consumed, frames with bad checksums).
+    Anything that isn't a frame is skipped over, so this resyncs by
+    itself.
+    """
+    a = np.frombuffer(buf, dtype=np.uint8)
+    n_buf = len(a)
+    starts = np.flatnonzero((a[:-1] == 0xa5) & (a[1:] == 0x5a))
+    starts = starts[starts + FRAME <= n_buf]
+
+    idx = starts[:,None] + _PAYLOAD_IDX
+    payload = a[idx]
+    good = (payload.sum(axis=1, dtype=np.uint32) & 0xff) == a[starts + FRAME - 1]
+    bad = int(np.sum(~good))
+
+    # A sync pattern inside a frame we're keeping isn't the start of another
+    starts, payload = starts[good], payload[good]
+    if len(starts) > 1:
+        keep = np.ones(len(starts), dtype=bool)
+        keep[1:] = np.diff(starts) >= FRAME
+        starts, payload = starts[keep], payload[keep]
+    if len(starts) > len(out):
+        starts, payload = starts[:len(out)], payload[:len(out)]
+
+    n = len(starts)
+    out[:n] = payload.view('<f4')
+    consumed = starts[-1] + FRAME if n else 0
+    if n < len(out):
+        # A frame can't start more than FRAME-1 bytes from the end without being complete
+        consumed = max(consumed, n_buf - (FRAME - 1))
+    return (n, int(consumed), bad)
+
+
+class IMUReader:
+    """Reads batches of (N, 9) samples from the IMU board
+
+    port is a device path, or anything with a read(n) (eg an open file
+    of recorded output).  Each batch is a view of a preallocated array,
+    so it's only good until the next read(): copy it to keep it.
+
+    With raw_mag, it reads the raw magnetometer (MR) lines instead, as
+    (N, 3) batches.
+    """
+    def __init__(self, port, speed=115200, binary=False, raw_mag=False, chunk=4096, max_batch=1024):
+        if isinstance(port, basestring):
+            import serial
+            port = serial.Serial(port, speed, timeout=0.1)
+        self.port = port
+        if raw_mag:
+            self.decode = decode_raw_mag
+        else:
+            self.decode = decode_binary if binary else decode_text
+        self.chunk = chunk
+
+        self.buf = bytearray(4*chunk)
+        self.n = 0 # bytes in buf
+        self.out = np.empty((max_batch, 3 if raw_mag else N_FIELDS))
+        self.t = None # when the data in the last batch arrived
+        self.t_first = None # ... and the first, with the record count after it
+        self.n_first = 0
+
+        self.stats = {
+            'bytes': 0,
+            'records': 0,
+            'batches': 0,
+            'malformed': 0,
+            'dropped': 0, # bytes thrown away when the buffer overflowed
+        }
+
+    def _fill(self):
+        # Append whatever's waiting on the port (at least one byte, unless it times out)
+        want = self.chunk
+        if hasattr(self.port, 'inWaiting'):
+            want = max(1, min(self.port.inWaiting(), self.chunk))
+        data = self.port.read(want)
+        if not data:
+            return False
+
+        if self.n + len(data) > len(self.buf):
+            # Nothing in here is decoding; toss the oldest of it
+            drop = self.n + len(data) - len(self.buf)
+            self.buf[:self.n - drop] = self.buf[drop:self.n]
+            self.n -= drop
+            self.stats['dropped'] += drop
+        self.buf[self.n:self.n + len(data)] = data
+        self.n += len(data)
+        self.stats['bytes'] += len(data)
+        self.t = time.time()
+        return True
+
+    def read(self):
+        """The next batch of samples, as an (N, 9) array
+
+        Returns an empty batch if the port timed out, or None at the end
+        of a file.
+        """
+        # What's already buffered goes first: a batch can be smaller than
+        # a chunk, so filling every time would let the buffer overflow
+        while True:
+            n, consumed, malformed = self.decode(self.buf[:self.n], self.out)
+            if consumed:
+                self.buf[:self.n - consumed] = self.buf[consumed:self.n]
+                self.n -= consumed
+            self.stats['malformed'] += malformed
+            if n:
+                self.stats['records'] += n
+                self.stats['batches'] += 1
+                if self.t_first is None:
+                    self.t_first, self.n_first = self.t, self.stats['records']
+                return self.out[:n]
+            if not self._fill():
+                return self.out[:0] if hasattr(self.port, 'inWaiting') else None
+
+    def rate(self, min_span=2.0):
+        """Samples per second, going by when they've been arriving
+
+        None until they've been arriving for min_span seconds, and from a
+        file, where when they arrive says nothing.  The first batch (a
+        backlog, like as not) doesn't count.
+        """
+        if not hasattr(self.port, 'inWaiting') or self.t_first is None:
+            return None
+        span = self.t - self.t_first
+        if span < min_span:
+            return None
+        return (self.stats['records'] - self.n_first)/span
+
+    def __iter__(self):
+        # Batches, until the end of a file; (serial ports go forever)
+        while True:
+            batch = self.read()
+            if batch is None:
+                return
+            if len(batch):
+                yield batch
+
+
+class RatePrinter:
+    """An IMUReader sink that prints the latest sample, at most every interval seconds
+
+    fmt turns one (9,) sample into a string.  Printing every sample at
+    full rate is enough to hold the reader up, so this just drops the
+    rest, and appends the sample rate it's seeing.
+    """
+    def __init__(self, fmt, interval=0.2):
+        self.fmt = fmt
+        self.interval = interval
+        self.t_printed = 0
+        self.n = 0
+
+    def __call__(self, batch):
+        self.n += len(batch)
+        now = time.time()
+        if not len(batch) or now - self.t_printed < self.interval:
+            return
+        rate = self.n/(now - self.t_printed) if self.t_printed else 0
+        print "%s\t(%0.0f/s)" % (self.fmt(batch[-1]), rate)
+        self.t_printed = now
+        self.n = 0
@@ -1,49 +1,259 @@
 #!/usr/bin/env python
 
-# This is used to check the calibration values for the magnetometer.
-# Set it up to do raw readings, then hold the board in all possible
-# orientations for equal amounts of time (either put it in a random
-# hamster ball somehow, or hold it in all four quadrants in both
-# orientations about each axis.  I do the latter, counting to three in
-# each orientation.
+# Hard and soft iron calibration for the magnetometer.
 #
-# Adjust these offsets until you get 0,0,0 at the end of that result
+#   mag_cal.py /dev/ttyUSB0 [--binary] [--out mag_cal.json]
+#
+# This fits the mag (Mg) columns of the board's usual output, in uT, so
+# the result applies straight to what imu_monitor.py --fuse reads.  Run
+# it and turn the board through every orientation you can (a random
+# hamster ball, or all four quadrants in both orientations about each
+# axis, counting to three in each).  It shows how much of the
+# sphere of directions it's seen so far; once that's enough it fits an
+# ellipsoid to the readings and saves the correction for mag_check.py
+# (and anything else) to load.  Ctrl-C saves early, if the fit is any good.
+#
+# The ellipsoid is
+#
+#   a x^2 + b y^2 + c z^2 + f yz + g xz + h xy + p x + q y + r z + d = 0
+#
+# with a + b + c = 1 to pin down the scale, fit by least squares.  That
+# only needs the sums of the products of those ten terms (the last being
+# 1), so the calibrator just keeps running sums of those, plus counts of
+# samples per direction for the coverage, and never holds on to any
+# samples: memory doesn't grow, and each batch is a couple of matrix
+# products.
+#
+# Pinning the scale with a + b + c rather than d = -1 is what lets the
+# origin sit on the ellipsoid: d is zero for one through the origin, so
+# fixing it can't fit those, and fits ones near them badly.  Readings
+# get taken about the first batch's mean (see Calibrator), which is on
+# the surface.
 
+import argparse
+import json
+import os
+import time
 
-offsets = [3210,-4270,-550]
+import numpy as np
 
+np.set_printoptions(precision=2)
 
-import numpy as np
+UNITS = "uT" # of the readings fit, as the Mg columns have them
 
-import serial
-import sys
+# Directions are binned into equal area bins: COVERAGE_BANDS bands of
+# z (so equal steps of cos(polar angle)), by COVERAGE_SECTORS of azimuth
+COVERAGE_BANDS = 6
+COVERAGE_SECTORS = 12
+COVERAGE_MIN = 20 # samples for a bin to count as seen
 
-port = sys.argv[1]
-speed = 115200
 
+# The constraint on the fit, a + b + c = 1
+TRACE = np.array([1, 1, 1, 0, 0, 0, 0, 0, 0, 0], dtype=float)
+
+def _terms(m):
+    # The ellipsoid's terms, plus a constant, as (N, 10)
+    x, y, z = m[:,0], m[:,1], m[:,2]
+    return np.column_stack((x*x, y*y, z*z, y*z, x*z, x*y, x, y, z, np.ones(len(m))))
+
+
+class Calibration:
+    """A hard and soft iron correction: corrected = matrix . (raw - center)
+
+    matrix is symmetric, and scaled so a corrected reading's magnitude is
+    field wherever the board points.  center and field are in units,
+    which has to match the readings it's applied to.
+    """
+    def __init__(self, center, matrix, field, samples=0, coverage=0.0, error=0.0, units=UNITS):
+        self.center = np.asarray(center, dtype=float)
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.field = field
+        self.samples = samples
+        self.coverage = coverage
+        self.error = error # rms relative error in the field magnitude, about
+        self.units = units
+
+    def apply(self, raw):
+        # Correct (N, 3) (or (3,)) raw readings
+        return (np.asarray(raw, dtype=float) - self.center).dot(self.matrix.T)
+
+    def to_json(self):
+        return {
+            "center": self.center.tolist(),
+            "matrix": self.matrix.tolist(),
+            "field": self.field,
+            "units": self.units,
+            "samples": self.samples,
+            "coverage": self.coverage,
+            "error": self.error,
+            "t": time.time(),
+        }
+
+    def save(self, path):
+        f = open(path, "w")
+        json.dump(self.to_json(), f, indent=1)
+        f.close()
+
+    @classmethod
+    def load(cls, path):
+        # Files without units were fit to raw MR counts, which don't apply to Mg readings
+        f = open(path)
+        j = json.load(f)
+        f.close()
+        units = j.get("units", "MR counts")
+        if units != UNITS:
+            raise ValueError("%s is a calibration for %s, not %s; refit it with mag_cal.py" % (path, units, UNITS))
+        return cls(j["center"], j["matrix"], j["field"], j.get("samples", 0),
+                   j.get("coverage", 0.0), j.get("error", 0.0), units)
 
-np.set_printoptions(precision=2)
 
-# Mg,632.082,-731.305,-161.944,Ac,240,0,-484,Gy,240,0,-484,^M
+class Calibrator:
+    """Streaming ellipsoid fit to magnetometer readings
 
-sp = serial.Serial(port, speed)
+    update() takes batches of (N, 3) readings; solve() fits whatever's
+    been seen so far, whenever it's wanted.  Readings get shifted and
+    scaled by a fixed amount (picked from the first batch) before they're
+    summed, to keep the normal equations well conditioned.
+    """
+    def __init__(self):
+        self.n = 0
+        self.sums = np.zeros((10, 10))
+        self.offset = None
+        self.scale = None
 
+        # Coverage is counted around a rough center, from a sphere fit
+        # that gets redone every so often.  If that moves much, the counts
+        # so far are thrown out, as they were about the wrong center.
+        self.center = None
+        self.radius = None
+        self.refit_every = 500
+        self.refit_n = 0
+        self.bins = np.zeros(COVERAGE_BANDS*COVERAGE_SECTORS, dtype=int)
 
-vals = [0,0,0]
-n = 0.0
+    def update(self, raw):
+        raw = np.asarray(raw, dtype=float)
+        if not len(raw):
+            return
+        if self.offset is None:
+            self.offset = raw.mean(axis=0)
+            self.scale = max(np.abs(raw - self.offset).max(), 1.0)*4
 
-for l in sp:
+        d = _terms((raw - self.offset)/self.scale)
+        self.sums += d.T.dot(d)
+        self.n += len(raw)
+
+        if self.n - self.refit_n >= self.refit_every:
+            self.refit_n = self.n
+            self._recenter()
+        if self.center is not None:
+            self.bins += np.bincount(self._bin(raw), minlength=len(self.bins))
+
+    def _bin(self, raw):
+        # The coverage bin for each reading's direction from the center
+        u = raw - self.center
+        u /= np.maximum(np.sqrt(np.sum(u**2, axis=1)), 1e-9)[:,None]
+        band = np.minimum(((u[:,2] + 1)/2*COVERAGE_BANDS).astype(int), COVERAGE_BANDS - 1)
+        sector = ((np.arctan2(u[:,1], u[:,0]) + np.pi)/(2*np.pi)*COVERAGE_SECTORS).astype(int)
+        return band*COVERAGE_SECTORS + np.minimum(sector, COVERAGE_SECTORS - 1)
+
+    def _recenter(self):
+        # Sphere fit, x^2 + y^2 + z^2 = 2 c.x + k, from the same sums
+        S = self.sums
+        try:
+            sol = np.linalg.solve(S[6:,6:], S[6:,0:3].sum(axis=1))
+        except np.linalg.LinAlgError:
+            return
+        c = sol[:3]/2
+        r2 = sol[3] + c.dot(c)
+        if r2 <= 0:
+            return
+        center = c*self.scale + self.offset
+        radius = np.sqrt(r2)*self.scale
+        if self.center is None or np.linalg.norm(center - self.center) > 0.1*radius:
+            self.bins[:] = 0
+        self.center, self.radius = center, radius
+
+    def coverage(self):
+        # Fraction of directions seen at least COVERAGE_MIN times
+        return np.mean(self.bins >= COVERAGE_MIN)
+
+    def solve(self):
+        """Fit the ellipsoid, returning a Calibration, or None if it isn't one (yet)"""
+        if self.n < 10:
+            return None
+        S = self.sums
+        try:
+            w = np.linalg.solve(S, TRACE)
+        except np.linalg.LinAlgError:
+            return None
+        w /= TRACE.dot(w)
+
+        a, b, c, f, g, h, p, q, r, d = w
+        A = np.array([[a, h/2, g/2], [h/2, b, f/2], [g/2, f/2, c]])
+        u = np.array([p, q, r])/2
+        try:
+            center = -np.linalg.solve(A, u)
+        except np.linalg.LinAlgError:
+            return None
+        k = center.dot(A).dot(center) - d
+        if k <= 0:
+            return None
+        evals, evecs = np.linalg.eigh(A/k)
+        if np.any(evals <= 0):
+            return None
+
+        # Scale so the corrected field has the ellipsoid's mean radius
+        radii = 1/np.sqrt(evals)
+        field = np.prod(radii)**(1/3.0)
+        matrix = field*evecs.dot(np.diag(np.sqrt(evals))).dot(evecs.T)
+
+        # The algebraic residual, d.w, is about 2k times the relative
+        # error in the radius
+        error = np.sqrt(max(w.dot(S).dot(w), 0)/self.n)/(2*k)
+
+        return Calibration(center*self.scale + self.offset, matrix, field*self.scale,
+                           self.n, self.coverage(), error)
+
+
+def main(argv=None):
+    from imu_reader import IMUReader
+
+    parser = argparse.ArgumentParser(description="Fit the magnetometer's hard and soft iron correction")
+    parser.add_argument("port", help="serial port, or a file of recorded output")
+    parser.add_argument("--speed", type=int, default=115200)
+    parser.add_argument("--binary", action="store_true", help="firmware built with ENABLE_BINARY_OUTPUT")
+    parser.add_argument("--out", default="mag_cal.json")
+    parser.add_argument("--coverage", type=float, default=0.8, help="fraction of directions to see before saving")
+    args = parser.parse_args(argv)
+
+    port = args.port
+    if os.path.isfile(port):
+        port = open(port, "rb")
+    reader = IMUReader(port, args.speed, binary=args.binary)
+    cal = Calibrator()
+
+    t_printed = 0
     try:
-        fields = l.split(",", 4)
-        if fields[0] != 'MR':
-            continue
-
-        for i in range(1,4):
-            vals[i-1] += int(fields[i]) - offsets[i-1]
-
-        n += 1
-        
-        print [ int(v/n) for v in vals ]
-    except Exception, e:
-        print e
+        for batch in reader:
+            cal.update(batch[:,0:3])
+            now = time.time()
+            if now - t_printed > 0.5:
+                print "%d samples, %3.0f%% coverage, center %s" % (cal.n, cal.coverage()*100, cal.center)
+                t_printed = now
+            if cal.coverage() >= args.coverage:
+                break
+    except KeyboardInterrupt:
         pass
+
+    result = cal.solve()
+    if result is None:
+        print "Not enough data for a fit yet; turn it through more orientations"
+        return
+    print "center %s, field %0.1f %s, error %0.1f%%, coverage %0.0f%%" % (result.center, result.field, result.units,
+                                                                       result.error*100, result.coverage*100)
+    print "matrix\n%s" % result.matrix
+    result.save(args.out)
+    print "Saved %s" % args.out
+
+if __name__ == '__main__':
+    main()
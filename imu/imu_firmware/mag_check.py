@@ -1,48 +1,48 @@
 #!/usr/bin/env python
 
-# This is used to check the calibration values for the magnetometer.
-# Set it up to do raw readings, then hold the board in all possible
-# orientations for equal amounts of time (either put it in a random
-# hamster ball somehow, or hold it in all four quadrants in both
-# orientations about each axis.  I do the latter, counting to three in
-# each orientation.
+# This is used to check the calibration of the magnetometer.
 #
-# Adjust these offsets until you get 0,0,0 at the end of that result
-
-
-offsets = [3210,-4270,-550]
+#   mag_check.py /dev/ttyUSB0 [--binary] [--cal mag_cal.json]
+#
+# Fit a calibration with mag_cal.py first.  This prints the corrected readings, their magnitude
+# (which should stay put at the calibration's field, whichever way the
+# board's pointed) and the angle in each plane.
 
+import argparse
+import os
 
 import numpy as np
 
-import serial
-import sys
-
-port = sys.argv[1]
-speed = 115200
-
+from imu_reader import IMUReader, RatePrinter
+from mag_cal import Calibration
 
 np.set_printoptions(precision=2)
 
-sp = serial.Serial(port, speed)
 
-vals = [0,0,0]
-n = 0.0
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show calibrated magnetometer readings")
+    parser.add_argument("port", help="serial port, or a file of recorded output")
+    parser.add_argument("--speed", type=int, default=115200)
+    parser.add_argument("--binary", action="store_true", help="firmware built with ENABLE_BINARY_OUTPUT")
+    parser.add_argument("--cal", default="mag_cal.json", help="from mag_cal.py")
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds between printed samples")
+    args = parser.parse_args(argv)
 
-for l in sp:
-    try:
-        fields = l.split(",", 4)
-        if fields[0] != 'MR':
-            continue
+    cal = Calibration.load(args.cal)
+    print "center %s, field %0.1f %s, error %0.1f%%" % (cal.center, cal.field, cal.units, cal.error*100)
 
-        for i in range(1,4):
-            vals[i-1] = int(fields[i]) - offsets[i-1]
+    def fmt(m):
+        angles = np.array([ np.rad2deg(np.arctan2(m[j],m[i])) for j,i in [[1,0],[2,1],[2,0]] ])
+        return "%s\t%0.1f (%+0.1f%%)\t%s" % (m, np.linalg.norm(m), (np.linalg.norm(m)/cal.field - 1)*100, angles)
 
+    port = args.port
+    if os.path.isfile(port):
+        port = open(port, "rb")
+    reader = IMUReader(port, args.speed, binary=args.binary)
+    printer = RatePrinter(fmt, args.interval)
 
-        m = [ float(fields[i])-offsets[i-1] for i in [1,2,3] ]
-        angles = np.array([ np.rad2deg(np.arctan2(m[j],m[i])) for j,i in [[1,0],[2,1],[2,0]] ])
+    for batch in reader:
+        printer(cal.apply(batch[:,0:3]))
 
-        print vals, angles
-    except Exception, e:
-        print e
-        pass
+if __name__ == '__main__':
+    main()
@@ -6,44 +6,156 @@
 #   ./dump1090  --net --enable-agc
 #   (I also use --device-index 1 --interactive --interactive-rows 30 )
 # This will set up a listener on your localhost that the following connects to.
-
-
-# Do the config load before importing cv2, as it's slow as hell.
-import sys
+#
+# Then: adsb_hud.py [--no-video] config.json
+#
+# Nothing heavy happens at import time.  main() only imports cv2 (which is
+# slow as hell), opens the camera, and starts the HTTP server if the mode
+# it's running in needs them; --no-video just tracks and logs ADS-B.
+#
+# With the HTTP server up, /stats.json and /metrics (Prometheus text) have
+# the listener's counters, per-stage frame timings and per-stream rates.
+#
+# With a "detect" section in the camera config, each frame also goes
+# through detect.py's moving object detector, and whatever it finds is
+# matched up with where we're predicting the planes: matched planes get a
+# line from the prediction to what's in the video, and anything unmatched
+# gets a box.
+#
+# With a "platesolve" section, the camera's pointing comes from the stars
+# instead of camera_loc and FOV: every so often a frame goes to
+# platesolve.py, which refines a cached plate solution against it (or
+# solves it from scratch with solve-field), and planes get drawn through
+# that solution from then on.
+
+import argparse
+import atexit
+from contextlib import contextmanager
 import json
-
-if len(sys.argv) != 2:
-    print "Usage: adsb_hud.py config.json"
-    sys.exit(1)
-
-f = file(sys.argv[1])
-config = json.load(f)
-f.close()
-
+import os
 import signal
-
+import sys
+import threading
 import time
-import numpy as np
-
-t0 = time.time()
-import cv2 # XXX Why does this take so long?!
-t1 = time.time()
-
-print "Loading cv2 took %0.3f" % (t1-t0)
 
-from adsb_listener import ADSBListener
-
-import os
+import numpy as np
 
+from adsb_listener import ADSBMultiListener
+from sbs_log import SBSLogReader, SBSLogWriter, replay
 from eci import *
-
-from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
-
-
-OBS_LOC = [np.deg2rad(config['loc']['lat']),np.deg2rad(config['loc']['lon']), config['loc']['alt']] # lat,long,alt (meters)
-OBS_HEADING = [config['camera_loc']['alt'], config['camera_loc']['az']] # alt,az, degrees
-OBS_FOV = config['camera']['FOV'] # span of view, degrees
-OBS_PX = config['camera']['resolution']    # span of view, pixels (height, then width, because math)
+from fov import FOVCull, CameraProjection
+from aircraft import KNOTS
+from pipeline import LatestSlot, start_stage
+from enhance import Enhancer
+from detect import Detector, associate
+from platesolve import PlateSolver
+from metrics import Metrics, label
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+cv2 = None # see load_cv2()
+
+config = None
+
+# Filled in by configure()
+OBS_LOC = None     # lat,long (radians),alt (meters)
+OBS_HEADING = None # alt,az, degrees
+OBS_FOV = None     # span of view, degrees
+OBS_PX = None      # span of view, pixels (height, then width, because math)
+
+qth = None
+PROJ = None # CameraProjection (or platesolve.Solution) for aa_deg2px_many
+CULL = None
+ENHANCE = None # Enhancer for each frame, if the camera config asks for one
+DETECT = None  # Detector for each frame, likewise
+DETECT_GATE = 20 # pixels a detection can be from a plane's predicted spot to count as it
+SOLVER = None  # PlateSolver, if the camera config has a platesolve section
+STREAMS = {} # name => MJPEGStream, served as /name.mjpg
+
+ADSB = None # the ADSBListener, once adsb_worker has it up
+
+PREDICT_MAX_DT = 30.0 # seconds we'll dead-reckon planes past their last report
+
+# Served as /stats.json and /metrics (Prometheus) when the HTTP server's up
+METRICS = Metrics()
+T_BATCH = METRICS.timer("adsb_batch")      # planes_spotted, per batch with anything to print
+T_PREP = METRICS.timer("annotate_prep")    # color conversion and enhancement
+T_DETECT = METRICS.timer("annotate_detect")
+T_COORDS = METRICS.timer("annotate_coords") # culling, prediction and alt/az
+T_DRAW = METRICS.timer("annotate_draw")
+T_ANNOTATE = METRICS.timer("annotate")     # all of the above, per frame
+T_LATENCY = METRICS.timer("frame_latency") # capture to render, per frame rendered
+
+
+class StartupTimer:
+    "Times each phase of startup, so we can see where restart-to-first-frame goes"
+    def __init__(self):
+        self.t0 = time.time()
+        self.phases = [] # (name, seconds)
+
+    @contextmanager
+    def phase(self, name):
+        t = time.time()
+        yield
+        self.phases.append((name, time.time() - t))
+
+    def report(self, final="startup"):
+        print "Startup timing:"
+        for name,dt in self.phases:
+            print "  %-16s %7.3fs" % (name, dt)
+        print "  %-16s %7.3fs" % (final, time.time() - self.t0)
+
+
+def load_cv2():
+    # cv2 takes ages to import (especially on the Pi), so only do it when we need video
+    global cv2
+    if cv2 is None:
+        import cv2 as _cv2
+        cv2 = _cv2
+    return cv2
+
+
+def configure(cfg):
+    # Set up the observer/camera globals from a loaded config
+    global config, OBS_LOC, OBS_HEADING, OBS_FOV, OBS_PX, qth, PROJ, CULL, ENHANCE, DETECT, DETECT_GATE, SOLVER
+
+    config = cfg
+    OBS_LOC = [np.deg2rad(config['loc']['lat']),np.deg2rad(config['loc']['lon']), config['loc']['alt']] # lat,long,alt (meters)
+    OBS_HEADING = [config['camera_loc']['alt'], config['camera_loc']['az']] # alt,az, degrees
+    OBS_FOV = config['camera']['FOV'] # span of view, degrees
+    OBS_PX = config['camera']['resolution']    # span of view, pixels (height, then width, because math)
+
+    qth = ECIObserver(OBS_LOC[0], OBS_LOC[1], OBS_LOC[2])
+    PROJ = CameraProjection(OBS_HEADING, OBS_FOV, OBS_PX) # open_camera() updates OBS_PX in place
+
+    # aa_deg2px maps +/- OBS_FOV around the heading onto the sensor
+    CULL = make_cull(OBS_HEADING, OBS_FOV)
+
+    if 'enhance' in config['camera']:
+        ENHANCE = Enhancer(**config['camera']['enhance'])
+    if 'detect' in config['camera']:
+        dc = dict(config['camera']['detect'])
+        DETECT_GATE = dc.pop('gate', DETECT_GATE)
+        DETECT = Detector(**dc)
+    if 'platesolve' in config['camera']:
+        SOLVER = PlateSolver(config)
+
+
+def make_cull(heading, span):
+    # The FOVCull for a view of span (alt, az) degrees either side of heading.
+    # Planes can move up to PREDICT_MAX_DT of flight (at a generous 600 knots)
+    # before they're drawn, so that's the slack the culling region needs.
+    return FOVCull(config['loc']['lat'], config['loc']['lon'], config['loc']['alt'],
+                   heading, span,
+                   max_range_km=config['adsb'].get('max_range_km', 400.0),
+                   slack_km=PREDICT_MAX_DT*600*KNOTS/1e3)
+
+def use_solution(solution):
+    # Draw through a plate solution from now on, culling around where it says
+    # we're pointed rather than the config's camera_loc
+    global PROJ, CULL
+    CULL = make_cull(solution.center(), solution.span())
+    PROJ = solution
 
 
 def aa_deg2px(alt, az):
@@ -73,141 +185,189 @@ def aa_deg2px(alt, az):
         return None
     return (px_alt, px_az)
 
-class ECIPlanePoint(ECIEarthPoints):
-    def __init__(self, plane):
-        self.plane = plane
-        self._update()
-
-    def _update(self):
-        self.lat = np.deg2rad(self.plane.lat)
-        self.lon = np.deg2rad(self.plane.lon)
-        self.alt = self.plane.alt*0.3048/1e3 # convert to metrique
-
-
-    def at(self, t):
-        self._update()
-
-        # Get our basic position
-        ept = ECIEarthPoints.at(self,t)
-
-        return ept
-
-
-PLANES = {} # addr => ECIPP(plane)
-qth = ECIEarthPoints(OBS_LOC[0], OBS_LOC[1], OBS_LOC[2])
-qth_pt = qth.at(0)
-
-def plane_pos(pt):
-    alt,az = map(np.rad2deg, qth.alt_az(0, pt))
-    d = np.linalg.norm(qth_pt.range_to(pt))
-    return (alt, az, d)
-
-def plane_spotted(plane):
-    PLANES[plane.addr] = ECIPlanePoint(plane)
-
-    if plane.lat != 0 and plane.last_printed < (time.time() - 3) and \
-       (plane.last_printed < plane.pos_ts or plane.last_printed < plane.vector_ts):
-        pt = PLANES[plane.addr].at(0)
-
-        alt,az,d = plane_pos(pt)
-        pxpos = aa_deg2px(alt,az)
+def aa_deg2px_many(alt, az):
+    # Vectorized aa_deg2px: arrays of alt,az in degrees to pixel arrays.
+    # Returns (px_alt, px_az, onscreen), where onscreen is a boolean mask;
+    # pixel values are only meaningful where it's set.
+    px_alt, px_az = PROJ.to_px(alt, az)
+    px_alt = px_alt.astype(int)
+    px_az = px_az.astype(int)
+
+    onscreen = (px_alt >= 0) & (px_alt < OBS_PX[0]) & (px_az >= 0) & (px_az < OBS_PX[1])
+    return (px_alt, px_az, onscreen)
+
+def adsb_time(t):
+    # Wall clock time t on the clock the ADS-B table's timestamps are on:
+    # the same thing live, but the recorded times when replaying a log
+    if ADSB is None or ADSB.clock is time.time:
+        return t
+    return t - time.time() + ADSB.clock()
+
+def planes_spotted(planes, rows):
+    # The listener's batch_cb: every plane that changed since the last poll, once each
+    t_start = time.time()
+    now = adsb_time(t_start)
+    last = planes.last_printed[rows]
+    rows = rows[planes.active[rows] & (planes.lat[rows] != 0) & (last < now - 3) &
+                ((last < planes.pos_ts[rows]) | (last < planes.vector_ts[rows]))]
+    if not len(rows):
+        return
+
+    pts = ECIEarthPointsArray(np.deg2rad(planes.lat[rows]), np.deg2rad(planes.lon[rows]), planes.alt[rows]*0.3048)
+    alts,azs,ds = qth.alt_az_range(now, pts.pos(now))
+    alts = np.rad2deg(alts[:,0])
+    azs = np.rad2deg(azs[:,0])
+    px_alts,px_azs,onscreen = aa_deg2px_many(alts, azs)
+
+    for i,row in enumerate(rows):
+        pxpos = (int(px_alts[i]), int(px_azs[i])) if onscreen[i] else None
         flag = "*** " if pxpos else "    "
-        if pxpos:
-            flag = "*** "
+        lat, lon = planes.lat[row], planes.lon[row]
 
-        print "%s[%8s] alt=%5.2f az=%6.2f d=%5.1f el=%5d (%6.3f,%7.3f) / (%6.3f, %6.3f) / %s" % (flag, plane.flight if plane.flight else "##" + plane.addr, alt, az, d, plane.alt, plane.lat, plane.lon, plane.lat - np.rad2deg(qth.lat), plane.lon - np.rad2deg(qth.lon), pxpos)
-        plane.last_printed = time.time()
+        print "%s[%8s] alt=%5.2f az=%6.2f d=%5.1f el=%5d (%6.3f,%7.3f) / (%6.3f, %6.3f) / %s" % (flag, planes.flight[row] or "##" + planes.addr[row], alts[i], azs[i], ds[i,0], planes.alt[row], lat, lon, lat - np.rad2deg(qth.lat), lon - np.rad2deg(qth.lon), pxpos)
+    planes.last_printed[rows] = now
+    T_BATCH.since(t_start)
 
 
 def adsb_worker():
+    global ADSB
     try:
-        al = ADSBListener(config['adsb']['server'], config['adsb']['port'], plane_spotted)
+        if 'replay' in config['adsb']:
+            # Drive everything off a recorded log instead of the network
+            ADSB = ADSBMultiListener([], batch_cb=planes_spotted)
+            n,dt = replay(ADSB, SBSLogReader(config['adsb']['replay']), config['adsb'].get('replay_speed', 1.0))
+            print "Replay finished: %d lines in %0.1fs" % (n, dt)
+            return
+
+        # Either a single "server"/"port", or a list of them under "feeds"
+        feeds = config['adsb'].get('feeds', [ config['adsb'] ])
+        al = ADSBMultiListener([ (f['server'], f['port']) for f in feeds ], batch_cb=planes_spotted)
+        al.batch_interval = config['adsb'].get('batch_interval', 0.0)
+        if config['adsb'].get('record'):
+            al.recorder = SBSLogWriter(config['adsb']['record'])
+            atexit.register(al.recorder.close) # a .gz log won't read back without its trailer
+        ADSB = al
         while True:
-            al._poll()
-            time.sleep(0.001)
+            if al.wait(1.0):
+                al._poll()
             deleted = al.expire(time.time() - 10)
             for addr in deleted:
                 print "         Expired %s" % addr
-                if addr in PLANES:
-                    del PLANES[addr]
+            METRICS.tick() # we're awake at least once a second anyway
     except Exception, e:
         print "ADSB Worker Exception: %s" % e
         os.kill(os.getpid(), signal.SIGINT) # send an interrupt to kill ourself
         sys.exit(1)
 
-import threading
-d = threading.Thread(name='adsb_worker', target=adsb_worker)
-d.setDaemon(True)
-d.start()
+def adsb_counters():
+    if ADSB is None:
+        return {}
+    retval = dict(("adsb_%s_total" % k, v) for k,v in ADSB.stats.items())
+    retval["adsb_duplicates_total"] = ADSB.duplicates
+    return retval
+
+def adsb_gauges():
+    if ADSB is None:
+        return {}
+    return {
+        "adsb_aircraft": len(ADSB.planes),
+        "adsb_aircraft_with_position": len(ADSB.planes.rows(have_position=True)),
+        "adsb_feeds_connected": len([ f for f in ADSB.feeds if f.fd and not f.connecting ]),
+        "adsb_feeds": len(ADSB.feeds),
+    }
 
+METRICS.counter(adsb_counters)
+METRICS.gauge(adsb_gauges)
 
-curimg = None
 
 ############################################################
 # HTTP Server bits
 
-
 class CamHandler(BaseHTTPRequestHandler):
+    def send_text(self, content_type, text):
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
     def do_GET(self):
         print self.path
+        if self.path == '/stats.json':
+            self.send_text('application/json', METRICS.json())
+            return
+        if self.path == '/metrics':
+            self.send_text('text/plain; version=0.0.4', METRICS.prometheus())
+            return
         if self.path.endswith('.mjpg'):
-            self.send_response(200)
-            self.send_header('Content-type','multipart/x-mixed-replace; boundary=--jpgboundary')
-            self.end_headers()
-            while True:
-                if curimg is None:
-                    return
-                r, buf = cv2.imencode(".jpg",img, [int(cv2.IMWRITE_JPEG_QUALITY), 99])
-                self.wfile.write("--jpgboundary\r\n")
-                self.send_header('Content-type','image/jpeg')
-                self.send_header('Content-length',str(len(buf)))
-                self.end_headers()
-                self.wfile.write(bytearray(buf))
-                self.wfile.write('\r\n')
-                time.sleep(0.1)
+            stream = STREAMS.get(self.path[1:-len('.mjpg')])
+            if stream is None:
+                self.send_error(404)
+                return
+            stream.serve(self)
             return
         if self.path.endswith('.html') or self.path=="/":
             self.send_response(200)
             self.send_header('Content-type','text/html')
             self.end_headers()
             self.wfile.write('<html><head></head><body>')
-            self.wfile.write('<img src="/cam.mjpg"/>')
+            for name in sorted(STREAMS):
+                self.wfile.write('<img src="/%s.mjpg"/>' % name)
+            self.wfile.write('<p><a href="/stats.json">stats</a></p>')
             self.wfile.write('</body></html>')
             return
 
 def http_worker():
     try:
-        server = HTTPServer((config['http_server']['bindaddr'],config['http_server']['port']),CamHandler)
+        from mjpeg import ThreadedHTTPServer
+        server = ThreadedHTTPServer((config['http_server']['bindaddr'],config['http_server']['port']),CamHandler)
         print "Server started"
         server.serve_forever()
     except Exception, e:
         print "Error in HTTP Worker: %s" % e
         os.kill(os.getpid(), signal.SIGINT)
 
+def stream_counters():
+    retval = {}
+    for stream in STREAMS.values():
+        retval.update(stream.stats())
+    return retval
 
-if config['http_server']['enabled']:
-    http_server = threading.Thread(name='http_server', target=http_worker)
-    http_server.setDaemon(True)
-    http_server.start()
+def stream_gauges():
+    return dict((label("stream_clients", stream=name), len(stream.clients)) for name,stream in STREAMS.items())
 
+METRICS.counter(stream_counters)
+METRICS.gauge(stream_gauges)
 
+def start_http(streams=True):
+    # Without streams (eg --no-video) it's just the stats, and cv2 never gets imported
+    if streams:
+        from mjpeg import MJPEGStream
 
+        # Each stream is encoded once per frame no matter how many clients are watching.
+        for name,sc in config['http_server'].get('streams', { "cam": { "quality": 99, "fps": 10 } }).items():
+            STREAMS[name] = MJPEGStream(name, sc.get('quality', 80), sc.get('fps', 10))
 
-############################################################
-# Actual main loop
+    http_server = threading.Thread(name='http_server', target=http_worker)
+    http_server.setDaemon(True)
+    http_server.start()
 
 
+############################################################
+# Video
 
-cap = cv2.VideoCapture(config['camera']['descriptor'])
-if not cap.isOpened():
-    raise Exception("Couldn't open video capture")
-flag,frame = cap.read()
-if not flag:
-    raise Exception("error getting initial frame")
-OBS_PX[0] = frame.shape[0] # yay for backwards math notation being alt,az!
-OBS_PX[1] = frame.shape[1]
+def open_camera():
+    cap = cv2.VideoCapture(config['camera']['descriptor'])
+    if not cap.isOpened():
+        raise Exception("Couldn't open video capture")
+    flag,frame = cap.read()
+    if not flag:
+        raise Exception("error getting initial frame")
+    OBS_PX[0] = frame.shape[0] # yay for backwards math notation being alt,az!
+    OBS_PX[1] = frame.shape[1]
 
-print "Reset OBS_PX to %s" % OBS_PX
+    print "Reset OBS_PX to %s" % OBS_PX
+    return cap
 
 
 def brighten(img):
@@ -227,53 +387,236 @@ def posterize(img, percentile=75):
     
 
 
-while True:
-    ret,img = cap.read()
+############################################################
+# The frame pipeline: capture -> annotate -> render/publish, each in its
+# own thread, joined by single-slot queues that drop the oldest frame.  A
+# slow stage makes us skip frames instead of queueing them up, so latency
+# stays bounded at the camera's native frame rate.
+
+FRAMES = LatestSlot()    # (t, raw frame) from the camera
+ANNOTATED = LatestSlot() # (t, frame with the overlay drawn on)
+
+DETECT_MATCHED = [0] # planes matched to a detection, over all frames
+
+METRICS.counter(lambda: {
+    "detections_total": DETECT.stats['detections'],
+    "detect_resets_total": DETECT.stats['resets'],
+    "detect_matched_total": DETECT_MATCHED[0],
+} if DETECT else {})
+
+SOLVE_WANTED = threading.Event() # set when platesolve_worker wants a frame
+SOLVE_FRAMES = LatestSlot()      # (t, frame) for it
+
+METRICS.counter(lambda: dict(("platesolve_%s_total" % k, SOLVER.stats[k]) for k in ('solves', 'refines', 'failures'))
+                if SOLVER else {})
+METRICS.gauge(lambda: {
+    "platesolve_matches": SOLVER.stats['matches'],
+    "platesolve_rms_px": SOLVER.stats['rms_px'],
+} if SOLVER else {})
+
+METRICS.counter(lambda: {
+    "frames_captured_total": FRAMES.puts,
+    "frames_annotated_total": ANNOTATED.puts,
+    label("frames_dropped_total", stage="annotate"): FRAMES.dropped,
+    label("frames_dropped_total", stage="render"): ANNOTATED.dropped,
+})
+
+def capture_worker(cap):
+    try:
+        while True:
+            ret,img = cap.read()
+            if not ret:
+                raise Exception("error reading frame")
+            FRAMES.put((time.time(), img))
+    except Exception, e:
+        print "Error in capture worker: %s" % e
+        os.kill(os.getpid(), signal.SIGINT)
+
+def annotate(frame):
+    t,img = frame
+    t_start = time.time()
 
     if config['camera'].get('colorspace', 'RGB') == "BGR":
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-    any_planes = False
-
-    for ecipp in PLANES.values():
-        if ecipp.lon == 0:
-            continue
-        alt,az,d = plane_pos(ecipp.at(0))
-        pxpos = aa_deg2px(alt,az)
-
-        if pxpos:
-            any_planes = True
-            nom = ecipp.plane.flight if ecipp.plane.flight else ecipp.plane.addr
-
-            (y,x) = pxpos
+    if SOLVE_WANTED.is_set():
+        SOLVE_WANTED.clear()
+        SOLVE_FRAMES.put((t, img.copy())) # before it's enhanced or drawn on
+
+    t0 = t_start
+    dets = None
+    if DETECT:
+        # On the frame as the camera saw it, before it's enhanced
+        dets = DETECT(img)
+        t0 = T_DETECT.since(t0)
+
+    if ENHANCE:
+        ENHANCE(img)
+    t0 = T_PREP.since(t0)
+    matched = set() # detections that are planes
+
+    planes = ADSB.planes if ADSB else None
+    rows = planes.rows(have_position=True) if planes else []
+    if len(rows):
+        # Throw out everything that can't be on screen before doing any real math
+        rows = rows[CULL.visible(planes.lat[rows], planes.lon[rows], planes.alt[rows]*0.3048)]
+    if len(rows):
+        # Straight from the table's columns, dead-reckoned up to this frame,
+        # into one batched pass for every plane
+        lat,lon,alt = planes.predict(adsb_time(t), rows, max_dt=PREDICT_MAX_DT)
+        pts = ECIEarthPointsArray(np.deg2rad(lat), np.deg2rad(lon), alt*0.3048) # feet to meters
+        alts,azs,ds = qth.alt_az_range(t, pts.pos(t))
+        px_alts,px_azs,onscreen = aa_deg2px_many(np.rad2deg(alts[:,0]), np.rad2deg(azs[:,0]))
+        t0 = T_COORDS.since(t0)
+
+        # plane index => detection index, for the planes we can see in the video
+        seen = {}
+        if dets is not None and len(dets.y):
+            on = np.flatnonzero(onscreen)
+            p, q = associate(dets, OBS_PX[0] - 1 - px_alts[on], px_azs[on], DETECT_GATE)
+            seen = dict(zip(on[p], q))
+            matched.update(q)
+            DETECT_MATCHED[0] += len(p)
+
+        for i in np.flatnonzero(onscreen):
+            row = rows[i]
+            d = ds[i,0]
+            nom = planes.flight[row] or planes.addr[row] or "?" # row may expire under us
+
+            (y,x) = (int(px_alts[i]), int(px_azs[i]))
             y = OBS_PX[0] - 1 - y # origin funtime woo
 
             text_color = (255,0,0)
             cv2.circle(img,(x,y),5,(128,128,255),1)
+            if i in seen:
+                j = seen[i]
+                cv2.line(img, (x,y), (int(dets.x[j]), int(dets.y[j])), (0,255,0), 1)
             text_height = min(1.5, max(30.0/d, 0.33))
             cv2.putText(img, nom, (x,y), cv2.FONT_HERSHEY_PLAIN, text_height, text_color, thickness=1)
 
+    if dets is not None:
+        for j in range(len(dets.y)):
+            if j in matched:
+                continue
+            x, y, r = int(dets.x[j]), int(dets.y[j]), int(max(dets.length[j]/2, 3))
+            cv2.rectangle(img, (x-r,y-r), (x+r,y+r), (255,255,0), 1)
+
     cv2.putText(img,
-                time.strftime("%Y-%m-%d %T %Z"),
+                time.strftime("%Y-%m-%d %T %Z", time.localtime(t)),
                 (0, OBS_PX[0]),
                 cv2.FONT_HERSHEY_PLAIN,
                 1.0,
                 (0,255,0),
                 thickness=1)
+    T_DRAW.since(t0)
+
+    T_ANNOTATE.since(t_start)
+    return (t, img)
+
+
+def platesolve_worker():
+    # Check the camera's pointing against the stars every so often, and
+    # draw through whatever solution that gives from then on
+    interval = config['camera']['platesolve'].get('interval', 600)
+    while True:
+        SOLVE_WANTED.set()
+        t,img = SOLVE_FRAMES.get()
+        try:
+            solution = SOLVER.update(img, t)
+        except Exception, e:
+            print "Error plate solving: %s" % e
+            solution = None
+        if solution is not None:
+            use_solution(solution)
+            print "Plate solution: center alt %0.2f az %0.2f" % solution.center()
+        time.sleep(interval)
+
+def start_platesolve():
+    # Use the cached solution straight away, if there is one for this camera
+    solution = SOLVER.cached(OBS_PX)
+    if solution is not None:
+        use_solution(solution)
+    th = threading.Thread(name='platesolve', target=platesolve_worker)
+    th.setDaemon(True)
+    th.start()
+
+
+def run_video(cap, timer):
+    cap_thread = threading.Thread(name='capture', target=capture_worker, args=(cap,))
+    cap_thread.setDaemon(True)
+    cap_thread.start()
+
+    start_stage('annotate', annotate, FRAMES, ANNOTATED)
+
+    # Rendering stays on the main thread, as that's where the GUI wants to be
+    while True:
+        frame = ANNOTATED.get(1.0)
+        if frame is None:
+            continue
+        t,img = frame
+        T_LATENCY.add(time.time() - t)
+
+        if timer:
+            timer.report("first frame")
+            timer = None
+
+        for stream in STREAMS.values():
+            stream.publish(img, t)
+
+        if not config['run_headless']:
+            cv2.imshow("input", img)
+            key = cv2.waitKey(1)
+            if key == 27:
+                break
+
+    if not config['run_headless']:
+        cv2.destroyAllWindows()
+    cv2.VideoCapture(-1).release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="A quick and janky HUD for ADS-B data")
+    parser.add_argument("config", help="JSON config file, eg dev.json")
+    parser.add_argument("--no-video", action="store_true",
+                        help="just track and log ADS-B; never loads cv2 or opens the camera")
+    args = parser.parse_args(argv)
+
+    timer = StartupTimer()
+
+    with timer.phase("config"):
+        f = file(args.config)
+        configure(json.load(f))
+        f.close()
+
+    with timer.phase("adsb"):
+        d = threading.Thread(name='adsb_worker', target=adsb_worker)
+        d.setDaemon(True)
+        d.start()
+
+    if args.no_video:
+        if config['http_server']['enabled']:
+            with timer.phase("http server"):
+                start_http(streams=False)
+        timer.report()
+        while d.is_alive():
+            d.join(1.0) # a bare join() won't let ^C through
+        return
+
+    with timer.phase("import cv2"):
+        load_cv2()
+
+    if config['http_server']['enabled']:
+        with timer.phase("http server"):
+            start_http()
+
+    with timer.phase("camera"):
+        cap = open_camera()
 
-            #print ecipp.plane.addr, pxpos
+    if SOLVER:
+        start_platesolve()
 
-    curimg = img
-    sleep_time = 10 if any_planes else 300
+    run_video(cap, timer)
 
-    if config['run_headless']:
-        time.sleep(sleep_time/1000.0)
-    else:
-        cv2.imshow("input", img)
-        key = cv2.waitKey(sleep_time)
-        if key == 27:
-            break
 
-if not config['run_headless']:
-    cv2.destroyAllWindows()
-cv2.VideoCapture(-1).release()
+if __name__ == '__main__':
+    main()
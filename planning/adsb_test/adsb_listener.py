@@ -1,135 +1,434 @@
-from collections import defaultdict
+import errno
+import os
 import time
 import math
+import select
 import socket
 import sys
 
-class Squitter:
-    def __init__(self, addr=None):
-        self.addr = addr
-
-        self.flight = None
+import numpy as np
+
+from aircraft import AircraftTable
+
+class LineBuffer:
+    """A reusable receive buffer that hands back complete lines
+
+    Data is received straight into a preallocated bytearray, and only the
+    newly-received bytes get scanned for line boundaries, so a partial
+    line sitting in the buffer doesn't get re-split on every recv.
+    """
+    def __init__(self, size=256*1024):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0 # first byte not yet handed back in a line
+        self.scan = 0  # no newlines in [start, scan)
+        self.end = 0   # end of received data
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _make_room(self):
+        pending = self.end - self.start
+        if self.start == 0:
+            # One enormous line filled the whole thing; can't resize under a memoryview
+            buf = bytearray(2*len(self.buf))
+            buf[:pending] = self.buf[:pending]
+            self.buf = buf
+            self.view = memoryview(self.buf)
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.scan -= self.start
+        self.start = 0
+        self.end = pending
+
+    def recv_from(self, sock):
+        # Receive whatever's waiting on sock into the buffer; returns 0 on EOF
+        if len(self.buf) - self.end < 4096:
+            self._make_room()
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def lines(self):
+        # Returns a list of all complete lines received so far (without the \n)
+        retval = []
+        i = self.buf.find(b"\n", self.scan, self.end)
+        while i >= 0:
+            retval.append(self.view[self.start:i].tobytes())
+            self.start = i+1
+            i = self.buf.find(b"\n", self.start, self.end)
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        self.scan = self.end
+        return retval
+
+
+class SBSFeed:
+    """One dump1090 SBS-1 feed (usually port 30003) and its receive buffer
+
+    Sockets are non-blocking throughout, connects included, so any number
+    of these can be multiplexed in a single select() loop.  After a
+    failure, retry_at/backoff say when the next reconnect should happen.
+    """
+    BACKOFF_MIN = 1.0  # seconds
+    BACKOFF_MAX = 60.0
+
+    def __init__(self, hostname, port):
+        self.hostname = hostname
+        self.port = port
 
-        self.identity = None
+        self.fd = None
+        self.connecting = False
+        self.buf = LineBuffer()
 
-        self.lat = 0.0
-        self.lon = 0.0
-        self.alt = 0
-        self.pos_ts = 0
+        self.backoff = self.BACKOFF_MIN
+        self.retry_at = 0
 
-        self.track = 0
-        self.speed = 0
-        self.vr = 0
-        self.vector_ts = 0
+    def __str__(self):
+        return "%s:%d" % (self.hostname, self.port)
 
-        self.last_printed = None
+    def fileno(self):
+        return self.fd.fileno()
 
-        self.seen()
+    def connect(self, blocking=False):
+        # Start connecting; if not blocking, finish_connect() once it's writable
+        fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if blocking:
+            fd.connect((self.hostname, self.port))
+            fd.setblocking(0)
+        else:
+            fd.setblocking(0)
+            err = fd.connect_ex((self.hostname, self.port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                fd.close()
+                raise socket.error(err, os.strerror(err))
+            self.connecting = (err != 0)
+        self.fd = fd
+
+    def finish_connect(self):
+        err = self.fd.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        self.connecting = False
+
+    def close(self, t=None):
+        # Drop the connection, and schedule the next retry with exponential backoff
+        if self.fd:
+            self.fd.close()
+        self.fd = None
+        self.connecting = False
+        self.buf = LineBuffer()
+
+        self.retry_at = (t or time.time()) + self.backoff
+        self.backoff = min(2*self.backoff, self.BACKOFF_MAX)
+
+    def recv(self, max_bytes=256*1024):
+        # Non-blocking read of whatever's ready on the socket, up to about max_bytes
+        got = 0
+        while got < max_bytes:
+            try:
+                n = self.buf.recv_from(self.fd)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            if n == 0:
+                raise socket.error("Connection to %s closed" % self)
+            got += n
 
-    def seen(self):
-        self.last_seen = time.time()
+        if got:
+            self.backoff = self.BACKOFF_MIN # it's talking to us again
+        return got
 
-    def __str__(self):
-        return "(%6s) %7s: (%0.1f, %0.1f)@%d, %d at %d knots, vr=%d" % (self.addr, self.flight,
-                                                                      self.lat, self.lon,
-                                                                      self.alt,
-                                                                      self.track, self.speed,
-                                                                      self.vr)
 
 class ADSBListener:
-    def __init__(self, hostname, port, cb=None):
+    """Parses SBS-1 lines into an AircraftTable
+
+    cb gets the Squitter for every message, as it arrives.  batch_cb is
+    the cheap alternative: updates are coalesced, and it gets called once
+    per poll cycle (or at most every batch_interval seconds) as
+    batch_cb(table, rows), with each aircraft that changed in between
+    showing up once, in its latest state.
+    """
+    DEDUP_WINDOW = 0 # seconds; 0 doesn't dedup at all, see ADSBMultiListener
+
+    def __init__(self, hostname, port, cb=None, batch_cb=None):
         self.hostname = hostname
         self.port = port
 
-        self.fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.fd.connect((hostname, port))
+        feed = SBSFeed(hostname, port)
+        feed.connect(blocking=True)
+        self._setup([feed], cb, batch_cb)
 
-        self.buf = ""
+    def _setup(self, feeds, cb, batch_cb=None):
+        self.feeds = feeds
+        self._ready = feeds
 
-        self.planes = defaultdict(Squitter)
+        self.planes = AircraftTable()
 
         self.cb = cb
+        self.batch_cb = batch_cb
+        self.batch_interval = 0.0 # seconds; 0 flushes after every _poll()
+        self.changed = set() # rows updated since the last flush()
+        self.t_flushed = 0
+
+        # lines, like bytes, is everything received, counted a recv at a time
+        self.stats = { 'lines': 0, 'bytes': 0, 'malformed': 0, 'unknown': 0, 'expired': 0, 'batches': 0 }
+        self.duplicates = 0 # see ADSBMultiListener
+
+        self.clock = time.time # replays swap in their own, see sbs_log
+        self.recorder = None   # an SBSLogWriter to get every raw line we receive
+
+    def wait(self, timeout=None):
+        "Sleep until there's data to read (returns True) or timeout seconds pass"
+        rfds = [ f for f in self.feeds if f.fd and not f.connecting ]
+        wfds = [ f for f in self.feeds if f.fd and f.connecting ]
+        r,w,_ = select.select(rfds, wfds, [], timeout)
+        for f in w:
+            self._connected(f)
+        self._ready = r
+        return bool(r)
+
+    def _connected(self, feed):
+        feed.finish_connect()
+
+    def _feed_error(self, feed, e):
+        raise e
 
     def _poll(self):
-        b2 = self.fd.recv(128*1024)
-        while b2 and (len(self.buf) < 1024):
-            self.buf += b2
-            b2 = self.fd.recv(128*1024)
-
-        lines = self.buf.split("\n")
-        self.buf = lines[-1]
-
-        for l in lines[:-1]:
+        # Handle everything waiting on the feeds wait() said were ready
+        ready, self._ready = self._ready, self.feeds
+        for feed in ready:
+            if feed.fd is None or feed.connecting:
+                continue
+            err = None
             try:
-                self._proc(l)
-            except ValueError:
-                pass
-            except Exception, e:
-                fields = l.split(",")
-                print "BOGON: %s/%s (%s): %s" % (fields[0], fields[1], len(fields), str([ (i,s) for i,s in enumerate(fields) if s and s != '0' and i > 4]))
-                print e
-                raise
-
-    def _proc(self, l):
-        fields = l.split(",")
-
-        if "MSG" != fields[0]:
-            raise ValueError("Expected field[0] to be MSG")
-
-        typ = fields[1]
-        addr = fields[4]
-        if len(addr) != 6:
-            raise ValueError("Address length is malformed")
-
-        plane = self.planes[addr]
-        plane.addr = addr
-        plane.seen()
-
-        if typ == '1' and fields[10]:
-            plane.flight = fields[10]
-        elif typ == '3' and fields[14] != '0': # '' throws exceptions
-            plane.lat = float(fields[14])
-            plane.lon = float(fields[15])
-            plane.alt = float(fields[11])
-            plane.pos_ts = time.time()
-        elif typ == '4':
-            if fields[12] != '0':
-                plane.track = float(fields[12])
-            if fields[13] != '0':
-                plane.speed = float(fields[13])
-            if fields[16] != '0':
-                plane.vr = float(fields[16])
-            plane.vector_ts = time.time()
-        elif typ == '5':
-            if len(fields) == 22 and fields[11] != '0':
-                plane.alt = float(fields[11])
-                plane.pos_ts = time.time()
-
-        elif typ == '6':
-            plane.identity = fields[17]
-        elif typ == '8' and fields[14] != '0':
-            plane.lat = float(fields[14])
-            plane.lon = float(fields[15])
-            plane.pos_ts = time.time()
-        else:
-            print [ (i,s) for i,s in enumerate(fields) if s and s != '0' ]
-
-            # print "%s: %s" % (addr, l)
-            sys.stdout.flush()
-
-
+                self.stats['bytes'] += feed.recv()
+            except socket.error, e:
+                err = e
+
+            lines = feed.buf.lines()
+            now = self.clock()
+            self.stats['lines'] += len(lines)
+            if self.recorder:
+                self.recorder.write_lines(lines, now)
+            for l in lines:
+                self._handle(l, now, feed)
+
+            if err:
+                self._feed_error(feed, err)
+
+        self.maybe_flush()
+
+    def flush(self):
+        # Hand batch_cb everything that's changed since last time
+        if not self.changed:
+            return
+        rows = np.fromiter(self.changed, int, len(self.changed))
+        rows.sort()
+        self.changed = set()
+        self.t_flushed = self.clock()
+        self.stats['batches'] += 1
+        self.batch_cb(self.planes, rows)
+
+    def maybe_flush(self):
+        if self.changed and self.clock() - self.t_flushed >= self.batch_interval:
+            self.flush()
+
+    def _handle(self, l, now=None, source=None):
+        # One raw line, heard at now (default: the clock), which a whole recv's worth
+        # can share, from source (the SBSFeed it came in on, if known).  It's only
+        # split as far as field 10; the rest is up to the handler for its type.
+        # (Everything's inline, as at a few hundred thousand lines a second, each
+        # extra function call is a few percent.)
+        if now is None:
+            now = self.clock()
+        fields = l.split(",", 10)
+        if self.DEDUP_WINDOW and self._duplicate(fields, now, source):
+            self.duplicates += 1
+            return
+
+        try:
+            if fields[0] != "MSG":
+                raise ValueError("Expected field[0] to be MSG")
+            addr = fields[4]
+            if len(addr) != 6:
+                raise ValueError("Address length is malformed")
+
+            p = self.planes
+            row = p.index.get(addr)
+            if row is None:
+                row = p.row_for(addr, now)
+            p.last_seen[row] = now
+
+            handler = self.HANDLERS.get(fields[1])
+            if handler:
+                handler(self, p, row, fields[10], now)
+            else:
+                self.stats['unknown'] += 1
+        except (ValueError, IndexError):
+            self.stats['malformed'] += 1
+            return
+        except Exception, e:
+            fields = l.split(",")
+            print "BOGON: %s/%s (%s): %s" % (fields[0], fields[1], len(fields), str([ (i,s) for i,s in enumerate(fields) if s and s != '0' and i > 4]))
+            print e
+            raise
+
+        if self.batch_cb:
+            self.changed.add(row)
         if self.cb:
-            self.cb(plane)
-        else:
-            print plane
-
+            self.cb(p.records[row] or p.lookup(addr))
+        elif not self.batch_cb:
+            print p.lookup(addr)
+
+    # Per-message-type handlers.  Everything they use is at field 10 or
+    # later, so they get that end of the line unsplit (see _handle), split it
+    # only as far as the last field they need, and write straight into the
+    # AircraftTable's columns.  In the comments, f[i] is field 10 + i.
+
+    def _msg_1(self, p, row, tail, now):
+        flight = tail.split(",", 1)[0] # callsign
+        if flight:
+            p.flight[row] = flight
+
+    def _msg_3(self, p, row, tail, now):
+        f = tail.split(",", 6) # altitude, lat and lon in f[1], f[4] and f[5]
+        if f[4] and f[4] != '0':
+            p.lat[row] = float(f[4])
+            p.lon[row] = float(f[5])
+            p.alt[row] = float(f[1])
+            p.pos_ts[row] = p.fix_ts[row] = now
+
+    def _msg_4(self, p, row, tail, now):
+        # dump1090 puts ground speed in f[2], track in f[3] and vertical rate in f[6]
+        f = tail.split(",", 7)
+        if f[2] != '0':
+            p.speed[row] = float(f[2])
+        if f[3] != '0':
+            p.track[row] = float(f[3])
+        if f[6] != '0':
+            p.vr[row] = float(f[6])
+        p.vector_ts[row] = now
+
+    def _msg_5(self, p, row, tail, now):
+        alt = tail.split(",", 2)[1]
+        if alt != '0':
+            p.alt[row] = float(alt)
+            p.pos_ts[row] = now
+
+    def _msg_6(self, p, row, tail, now):
+        p.identity[row] = tail.split(",", 8)[7] # squawk
+
+    def _msg_8(self, p, row, tail, now):
+        f = tail.split(",", 6)
+        if f[4] and f[4] != '0':
+            p.lat[row] = float(f[4])
+            p.lon[row] = float(f[5])
+            p.pos_ts[row] = p.fix_ts[row] = now
+
+    HANDLERS = {
+        '1': _msg_1,
+        '3': _msg_3,
+        '4': _msg_4,
+        '5': _msg_5,
+        '6': _msg_6,
+        '8': _msg_8,
+    }
 
     def expire(self, t_expiry):
-        todel = [ p.addr for p in self.planes.values() if p.last_seen < t_expiry ]
-        for addr in todel:
-            del self.planes[addr]
+        # A changed row that's about to be recycled has to go out first;
+        # otherwise batching is left to maybe_flush()
+        q = self.planes.expiry
+        if self.changed and q and q[0][0] < t_expiry:
+            rows = np.fromiter(self.changed, int, len(self.changed))
+            if np.any(self.planes.last_seen[rows] < t_expiry):
+                self.flush()
+        todel = self.planes.expire(t_expiry)
+        self.stats['expired'] += len(todel)
         return todel
 
+class ADSBMultiListener(ADSBListener):
+    """An ADSBListener fed by any number of receivers at once
+
+    All feeds share one select() loop.  Dropped or refused connections
+    are retried with backoff rather than raised, and a squitter heard by
+    several receivers only gets parsed (and reaches the callback) once.
+
+    What counts as the same squitter is the same message type, address
+    and decoded fields from a different feed, within DEDUP_WINDOW (to
+    twice that: keys are kept in two generations, swapped every window,
+    rather than expired one by one).  A feed repeating itself is a fresh
+    message, as a steady aircraft says the same thing over and over, and
+    that's what keeps its last_seen and vector_ts current.  Lines with
+    no source (replays, as the log doesn't record which feed a line came
+    in on) are deduped on their content alone.
+    """
+    DEDUP_WINDOW = 1.0 # seconds
+
+    def __init__(self, servers, cb=None, batch_cb=None):
+        # servers is a list of (hostname, port)
+        self._setup([ SBSFeed(h, p) for h,p in servers ], cb, batch_cb)
+
+        self.recent = {} # dedup key => the feed that got it through, this window
+        self.older = {}  # and in the window before
+        self.t_rotated = 0
+
+    def wait(self, timeout=None):
+        now = time.time()
+        for f in self.feeds:
+            if f.fd is None and f.retry_at <= now:
+                try:
+                    f.connect()
+                except socket.error, e:
+                    self._feed_error(f, e)
+
+        # Don't sleep through the next scheduled reconnect
+        retries = [ f.retry_at - now for f in self.feeds if f.fd is None ]
+        if retries:
+            t_retry = max(0, min(retries))
+            timeout = t_retry if timeout is None else min(timeout, t_retry)
+
+        return ADSBListener.wait(self, timeout)
+
+    def _connected(self, feed):
+        try:
+            feed.finish_connect()
+            print "Connected to %s" % feed
+        except socket.error, e:
+            self._feed_error(feed, e)
+
+    def _feed_error(self, feed, e):
+        feed.close()
+        print "Feed %s: %s; retrying in %0.1fs" % (feed, e, feed.retry_at - time.time())
+
+    def _duplicate(self, fields, now, source):
+        # The receiver-specific bits are the IDs and timestamps in fields 2,3 and 6-9;
+        # the rest is the decoded squitter itself.
+        if len(fields) < 11:
+            return False
+        if now - self.t_rotated >= self.DEDUP_WINDOW:
+            # (after a quiet spell, even this window's keys are too old to keep)
+            self.older = self.recent if now - self.t_rotated < 2*self.DEDUP_WINDOW else {}
+            self.recent = {}
+            self.t_rotated = now
+        key = (fields[1], fields[4], fields[10].rstrip())
+
+        recent = self.recent
+        if key in recent:
+            heard_by = recent[key]
+        elif key in self.older:
+            heard_by = self.older[key]
+        else:
+            recent[key] = source
+            return False
+        if source is None or heard_by is not source:
+            return True
+        recent[key] = source
+        return False
+
+
 if __name__ == '__main__':
     import time
 
@@ -138,11 +437,15 @@ if __name__ == '__main__':
             print plane
             plane.last_printed = time.time()
 
-    al = ADSBListener('localhost', 30003, print_plane)
+    servers = [ (s.split(":")[0], int(s.split(":")[1])) for s in sys.argv[1:] ]
+    if not servers:
+        servers = [ ('localhost', 30003) ]
+
+    al = ADSBMultiListener(servers, print_plane)
 
     while True:
-        al._poll()
-        time.sleep(0.001)
+        if al.wait(1.0):
+            al._poll()
         deleted = al.expire(time.time() - 10)
         for addr in deleted:
             print "   Expired %s" % addr
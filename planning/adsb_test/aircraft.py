@@ -0,0 +1,217 @@
+import heapq
+import time
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8 # meters, mean radius; plenty for a few seconds of flight
+KNOTS = 1852.0/3600 # meters/second per knot
+
+def dead_reckon(lat, lon, alt, track, speed, vr, dt, dt_alt=None):
+    """Extrapolate positions along their great circle track
+
+    * lat, lon, track in degrees; alt in feet; speed in knots; vr in ft/min
+    * dt: seconds since the lat/lon fix; dt_alt: since the altitude (default dt)
+
+    Everything broadcasts, so this does a whole table in one pass.
+    Returns (lat, lon, alt) in the same units.
+    """
+    if dt_alt is None:
+        dt_alt = dt
+
+    phi = np.deg2rad(lat)
+    lam = np.deg2rad(lon)
+    theta = np.deg2rad(track)
+    delta = speed*KNOTS*dt / EARTH_RADIUS # angular distance travelled
+
+    s_phi, c_phi = np.sin(phi), np.cos(phi)
+    s_delta, c_delta = np.sin(delta), np.cos(delta)
+
+    s_phi2 = s_phi*c_delta + c_phi*s_delta*np.cos(theta)
+    phi2 = np.arcsin(np.clip(s_phi2, -1, 1))
+    lam2 = lam + np.arctan2(np.sin(theta)*s_delta*c_phi, c_delta - s_phi*s_phi2)
+
+    lon2 = np.mod(np.rad2deg(lam2) + 180, 360) - 180
+    alt2 = alt + vr*dt_alt/60.0
+
+    return (np.rad2deg(phi2), lon2, alt2)
+
+
+class AircraftTable:
+    """Columnar state for every aircraft we're currently hearing
+
+    Each numeric field lives in its own NumPy array (one row per aircraft),
+    so consumers can hand whole columns to vectorized math instead of
+    walking a dict of objects.  addr => row lookups go through an index
+    dict, and rows of expired aircraft get recycled.
+
+    Ingest goes through row_for() and writes the columns directly; the
+    Squitter view of a row only gets made when someone asks for it with
+    lookup(), as every attribute on it is a property.
+
+    Expiry uses a heap of (last_seen, addr) with lazy updates: an entry is
+    only re-examined once its (possibly stale) timestamp is older than the
+    cutoff, so expire() costs O(expired) instead of O(all planes).
+    """
+    COLUMNS = ('lat', 'lon', 'alt', 'pos_ts', 'fix_ts', 'track', 'speed', 'vr', 'vector_ts', 'last_seen', 'last_printed')
+
+    def __init__(self, capacity=256):
+        for c in AircraftTable.COLUMNS:
+            setattr(self, c, np.zeros(capacity))
+        self.active = np.zeros(capacity, dtype=bool)
+
+        self.addr = [None]*capacity
+        self.flight = [None]*capacity
+        self.identity = [None]*capacity
+        self.records = [None]*capacity # row => Squitter, once lookup() has made one
+
+        self.index = {} # addr => row
+        self.free = list(range(capacity-1, -1, -1)) # pop() hands out the lowest row
+        self.expiry = [] # heap of (last_seen when queued, addr)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, addr):
+        return addr in self.index
+
+    def __getitem__(self, addr):
+        return self.lookup(addr)
+
+    def row_for(self, addr, t):
+        # Returns addr's row, inserting it (as seen at time t) if need be
+        row = self.index.get(addr)
+        if row is None:
+            row = self._insert(addr, t)
+        return row
+
+    def lookup(self, addr, t=None):
+        # Returns the Squitter for addr, creating it (as seen at time t) if need be
+        row = self.row_for(addr, t or time.time())
+        if self.records[row] is None:
+            self.records[row] = Squitter(self, row)
+        return self.records[row]
+
+    def values(self):
+        return [ self.lookup(addr) for addr in self.index.keys() ]
+
+    def _grow(self):
+        # Other threads read the table while this happens, so active goes
+        # last: no column is ever shorter than it (see rows())
+        n = len(self.active)
+        for c in AircraftTable.COLUMNS:
+            setattr(self, c, np.concatenate((getattr(self, c), np.zeros(n))))
+        self.active = np.concatenate((self.active, np.zeros(n, dtype=bool)))
+
+        for l in (self.addr, self.flight, self.identity, self.records):
+            l.extend([None]*n)
+        self.free = list(range(2*n-1, n-1, -1))
+
+    def _insert(self, addr, t):
+        if not self.free:
+            self._grow()
+        row = self.free.pop()
+
+        for c in AircraftTable.COLUMNS:
+            getattr(self, c)[row] = 0
+        self.addr[row] = addr
+        self.flight[row] = None
+        self.identity[row] = None
+        self.records[row] = None
+
+        self.index[addr] = row
+        self.active[row] = True
+
+        self.last_seen[row] = t
+        heapq.heappush(self.expiry, (t, addr))
+        return row
+
+    def _remove(self, addr):
+        row = self.index.pop(addr)
+        self.active[row] = False
+        if self.records[row] is not None:
+            self.records[row]._detach()
+            self.records[row] = None
+        self.free.append(row)
+
+    def expire(self, t_expiry):
+        # Drop everything not seen since t_expiry; returns the list of addrs dropped
+        todel = []
+        q = self.expiry
+        while q and q[0][0] < t_expiry:
+            t,addr = heapq.heappop(q)
+            row = self.index.get(addr)
+            if row is None:
+                continue
+            last_seen = self.last_seen[row]
+            if last_seen < t_expiry:
+                self._remove(addr)
+                todel.append(addr)
+            else:
+                heapq.heappush(q, (last_seen, addr)) # heard from since it was queued
+        return todel
+
+    def rows(self, have_position=False):
+        # Indices of the live rows, optionally only those with a position report
+        active = self.active
+        if have_position:
+            n = len(active) # the columns may have grown since
+            return np.flatnonzero(active & ((self.lat[:n] != 0) | (self.lon[:n] != 0)))
+        return np.flatnonzero(active)
+
+    def predict(self, t, rows, max_dt=30.0):
+        """Dead-reckoned (lat, lon, alt) for the given rows at unix time t
+
+        Planes without a velocity report stay put, and nothing gets pushed
+        more than max_dt seconds past its last report, so a plane that's
+        gone quiet doesn't wander off across the sky.
+        """
+        has_vec = self.vector_ts[rows] > 0
+        dt = np.where(has_vec, np.clip(t - self.fix_ts[rows], 0, max_dt), 0)
+        dt_alt = np.where(has_vec, np.clip(t - self.pos_ts[rows], 0, max_dt), 0)
+
+        return dead_reckon(self.lat[rows], self.lon[rows], self.alt[rows],
+                           self.track[rows], self.speed[rows], self.vr[rows],
+                           dt, dt_alt)
+
+
+def _column(name):
+    # A Squitter attribute backed by the AircraftTable column (array or list) of the same name
+    def get(self):
+        if self.row is None:
+            return self._frozen[name]
+        return getattr(self.table, name)[self.row]
+
+    def set(self, v):
+        if self.row is None:
+            self._frozen[name] = v
+        else:
+            getattr(self.table, name)[self.row] = v
+
+    return property(get, set)
+
+class Squitter(object):
+    "A view of one aircraft's row in an AircraftTable"
+    __slots__ = ('table', 'row', '_frozen')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        self._frozen = None
+
+    def _detach(self):
+        # Called when our row is recycled: keep the final values for anyone still holding us
+        self._frozen = dict((c, getattr(self, c)) for c in AircraftTable.COLUMNS + ('addr', 'flight', 'identity'))
+        self.row = None
+
+    def seen(self, t=None):
+        self.last_seen = t or time.time()
+
+    def __str__(self):
+        return "(%6s) %7s: (%0.1f, %0.1f)@%d, %d at %d knots, vr=%d" % (self.addr, self.flight,
+                                                                      self.lat, self.lon,
+                                                                      self.alt,
+                                                                      self.track, self.speed,
+                                                                      self.vr)
+
+for c in AircraftTable.COLUMNS + ('addr', 'flight', 'identity'):
+    setattr(Squitter, c, _column(c))
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+# Benchmarks for the hot paths: SBS-1 ingest, the coordinate math, and the
+# HUD's drawing/encoding.  Everything runs on synthetic data, so no
+# dump1090 or camera is needed.
+#
+#   bench.py [-k substring] [--quick] [-o results.json]
+#
+# Results are printed as a table and, with -o, written as JSON (with the
+# host, Python/NumPy versions and git revision) for comparing runs across
+# releases and machines.
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from adsb_listener import ADSBMultiListener
+from eci import *
+from fov import FOVCull
+from sbs_log import SBSLogReader, SBSLogWriter, replay
+import adsb_hud
+
+CONFIG = {
+    "loc": { "lat": 37.728206, "lon": -122.407863, "alt": 25},
+    "camera": { "descriptor": -1, "FOV": [30.0, 40.0], "resolution": [240, 320] },
+    "camera_loc": { "alt": 25.0, "az": 30.0 },
+    "adsb": { "server": "localhost", "port": 30003 },
+    "http_server": { "enabled": 0, "port": 9090, "bindaddr": "" },
+    "run_headless": 1
+}
+
+BENCHMARKS = [] # (name, params, setup)
+
+def bench(name, params=(None,)):
+    """Register a benchmark
+
+    The decorated function gets one param and returns (fn, items): fn()
+    is what gets timed, and items is how many things one call handles,
+    for a throughput figure.
+    """
+    def wrap(setup):
+        BENCHMARKS.append((name, params, setup))
+        return setup
+    return wrap
+
+def run_one(fn, min_time=0.2, repeat=5):
+    # asv/timeit-style: scale the loop count to min_time, take the best of repeat
+    number = 1
+    while True:
+        t0 = time.time()
+        for i in range(number):
+            fn()
+        dt = time.time() - t0
+        if dt >= min_time or number >= 1e6:
+            break
+        number *= max(2, int(min_time/max(dt, 1e-9)))
+
+    times = [dt/number]
+    for r in range(repeat-1):
+        t0 = time.time()
+        for i in range(number):
+            fn()
+        times.append((time.time() - t0)/number)
+    return (min(times), float(np.median(times)), number)
+
+
+############################################################
+# Synthetic data
+
+def synthetic_sbs(n, n_planes=300, seed=1):
+    # n SBS-1 lines from n_planes aircraft around the observer, in roughly dump1090's mix
+    rng = random.Random(seed)
+    planes = [ ("%06X" % rng.randint(0, 0xffffff),
+                CONFIG['loc']['lat'] + rng.uniform(-2, 2),
+                CONFIG['loc']['lon'] + rng.uniform(-2.5, 2.5),
+                rng.randint(1000, 40000)) for i in range(n_planes) ]
+
+    # dump1090 fills in the generated/logged dates and times (fields 6-9) on every line
+    stamp = "2017/11/28,21:19:39.123,2017/11/28,21:19:39.150"
+
+    retval = []
+    for i in range(n):
+        addr, lat, lon, alt = rng.choice(planes)
+        typ = rng.choice("3334455568")
+        if typ == '1':
+            l = "MSG,1,1,1,%s,1,%s,UAL%d,,,,,,,,,,,0" % (addr, stamp, rng.randint(1,999))
+        elif typ == '3':
+            l = "MSG,3,1,1,%s,1,%s,,%d,,,%0.5f,%0.5f,,,0,0,0,0" % (addr, stamp, alt, lat, lon)
+        elif typ == '4':
+            l = "MSG,4,1,1,%s,1,%s,,,%d,%d,,,%d,,0,0,0,0" % (addr, stamp, rng.randint(100,500), rng.randint(1,359), rng.randint(-2000,2000))
+        elif typ == '5':
+            l = "MSG,5,1,1,%s,1,%s,,%d,,,,,,,0,,0,0" % (addr, stamp, alt)
+        elif typ == '6':
+            l = "MSG,6,1,1,%s,1,%s,,,,,,,,%04d,0,0,0,0" % (addr, stamp, rng.randint(0,7777))
+        else:
+            l = "MSG,8,1,1,%s,1,%s,,,,,,,,,,,,0" % (addr, stamp)
+        retval.append(l + "\r")
+    return retval
+
+def populated_listener(n_planes):
+    al = ADSBMultiListener([], lambda p: None)
+    for l in synthetic_sbs(20*n_planes, n_planes):
+        al._handle(l)
+    return al
+
+def random_points(n, seed=2):
+    rng = np.random.RandomState(seed)
+    lat = CONFIG['loc']['lat'] + rng.uniform(-2, 2, n)
+    lon = CONFIG['loc']['lon'] + rng.uniform(-2.5, 2.5, n)
+    alt = rng.uniform(300, 12000, n)
+    return (lat, lon, alt)
+
+def synthetic_catalog(n, seed=4):
+    # n random LEO-ish satellites, with an epoch of t=1.5e9
+    from sgp4.api import Satrec, WGS72
+    from passes import Catalog
+    rng = np.random.RandomState(seed)
+    satrecs = []
+    for i in range(n):
+        s = Satrec()
+        s.sgp4init(WGS72, 'i', i, 1.5e9/86400.0 + 2440587.5 - 2433281.5, # days since 1949 Dec 31
+                   1e-5, 0.0, 0.0, rng.uniform(0, 0.02), rng.uniform(0, 2*np.pi),
+                   np.deg2rad(rng.uniform(0, 110)), rng.uniform(0, 2*np.pi),
+                   rng.uniform(0.04, 0.07), rng.uniform(0, 2*np.pi)) # mean motion, radians/minute
+        satrecs.append(s)
+    return Catalog(satrecs)
+
+def observer():
+    return ECIObserver(np.deg2rad(CONFIG['loc']['lat']), np.deg2rad(CONFIG['loc']['lon']), CONFIG['loc']['alt'])
+
+
+############################################################
+# Ingest
+
+@bench("ingest.handle", params=(10000,))
+def _(n):
+    lines = synthetic_sbs(n)
+    al = ADSBMultiListener([], lambda p: None)
+    al.DEDUP_WINDOW = 0 # we're measuring parsing, not dropping repeats
+    def fn():
+        for l in lines:
+            al._handle(l)
+    return (fn, n)
+
+@bench("ingest.replay", params=(20000,))
+def _(n):
+    fd, path = tempfile.mkstemp(suffix=".sbslog")
+    os.close(fd)
+    w = SBSLogWriter(path)
+    for i,l in enumerate(synthetic_sbs(n)):
+        w.write(l, 1.5e9 + i*0.001)
+    w.close()
+    log = SBSLogReader(path)
+    os.unlink(path)
+
+    def fn():
+        replay(ADSBMultiListener([], lambda p: None), log)
+    return (fn, n)
+
+@bench("ingest.expire", params=(1000,))
+def _(n):
+    al = populated_listener(n)
+    def fn():
+        al.expire(0) # the steady state: nothing due
+    return (fn, 1)
+
+
+############################################################
+# Coordinates
+
+@bench("eci.gmst", params=(1, 1000))
+def _(n):
+    t = 1.5e9 + np.arange(n)
+    if n == 1:
+        return (lambda: GMST.from_unix(1.5e9), 1)
+    return (lambda: GMST.from_unix(t), n)
+
+@bench("eci.at", params=(1, 100, 1000))
+def _(n):
+    pts = [ ECIEarthPoints(np.deg2rad(la), np.deg2rad(lo), al) for la,lo,al in zip(*random_points(n)) ]
+    def fn():
+        for p in pts:
+            p.at(0)
+    return (fn, n)
+
+@bench("eci.alt_az", params=(1, 100, 1000))
+def _(n):
+    q = ECIEarthPoints(np.deg2rad(CONFIG['loc']['lat']), np.deg2rad(CONFIG['loc']['lon']), CONFIG['loc']['alt'])
+    pts = [ ECIEarthPoints(np.deg2rad(la), np.deg2rad(lo), al).at(0) for la,lo,al in zip(*random_points(n)) ]
+    def fn():
+        for p in pts:
+            q.alt_az(0, p)
+    return (fn, n)
+
+@bench("eci.observer_alt_az", params=(1, 100, 1000))
+def _(n):
+    q = observer()
+    pts = [ ECIEarthPoints(np.deg2rad(la), np.deg2rad(lo), al).at(0) for la,lo,al in zip(*random_points(n)) ]
+    def fn():
+        for p in pts:
+            q.alt_az(0, p)
+    return (fn, n)
+
+@bench("eci.alt_az_range", params=(1, 100, 1000, 10000))
+def _(n):
+    q = observer()
+    lat, lon, alt = random_points(n)
+    def fn():
+        t = 1.5e9
+        q.alt_az_range(t, ECIEarthPointsArray(np.deg2rad(lat), np.deg2rad(lon), alt).pos(t))
+    return (fn, n)
+
+@bench("aircraft.predict", params=(100, 1000))
+def _(n):
+    al = populated_listener(n)
+    rows = al.planes.rows(have_position=True)
+    return (lambda: al.planes.predict(time.time(), rows), len(rows))
+
+@bench("fov.cull", params=(100, 1000, 10000))
+def _(n):
+    c = FOVCull(CONFIG['loc']['lat'], CONFIG['loc']['lon'], CONFIG['loc']['alt'],
+                (CONFIG['camera_loc']['alt'], CONFIG['camera_loc']['az']), CONFIG['camera']['FOV'], slack_km=10)
+    lat, lon, alt = random_points(n)
+    return (lambda: c.visible(lat, lon, alt), n)
+
+
+@bench("passes.find", params=(100, 1000))
+def _(n):
+    from passes import find_passes
+    catalog = synthetic_catalog(n)
+    q = observer()
+    return (lambda: find_passes(catalog, q, 1.5e9, 1.5e9 + 12*3600), n)
+
+@bench("crossings.find", params=(100,))
+def _(n):
+    from crossings import find_crossings, from_config
+    catalog = synthetic_catalog(n)
+    q, proj = from_config(CONFIG)
+    return (lambda: find_crossings(catalog, q, proj, 1.5e9, 1.5e9 + 12*3600), n)
+
+@bench("tle_fit.fit", params=(300,))
+def _(n):
+    # A pass's worth of noisy observations, fit from a TLE that's 0.3 degrees off in mean anomaly
+    from passes import find_passes
+    from tle_fit import fit, with_elements
+    q = observer()
+    catalog = synthetic_catalog(50)
+    p = max(find_passes(catalog, q, 1.5e9, 1.5e9 + 12*3600), key=lambda p: p.alt)
+    truth = catalog.satrecs[p.sat]
+    t = np.linspace(p.rise, p.set, n)
+    err, r, v = catalog[p.sat:p.sat+1].propagate(t)
+    alt, az, d = q.alt_az_range(t, r)
+    rng = np.random.RandomState(5)
+    alt = alt[0] + rng.normal(0, 1e-4, n)
+    az = az[0] + rng.normal(0, 1e-4, n)
+    start = with_elements(truth, ['mo'], [[truth.mo + np.deg2rad(0.3)]])[0]
+    return (lambda: fit(start, q, t, alt, az), n)
+
+
+############################################################
+# HUD
+
+def hud_setup(resolution):
+    cfg = json.loads(json.dumps(CONFIG))
+    cfg['camera']['resolution'] = list(resolution)
+    adsb_hud.configure(cfg)
+
+@bench("hud.aa_deg2px", params=(1, 1000))
+def _(n):
+    hud_setup((240, 320))
+    rng = np.random.RandomState(3)
+    alt = rng.uniform(0, 60, n)
+    az = rng.uniform(0, 90, n)
+    def fn():
+        for i in range(n):
+            adsb_hud.aa_deg2px(alt[i], az[i])
+    return (fn, n)
+
+@bench("hud.aa_deg2px_many", params=(1000, 10000))
+def _(n):
+    hud_setup((240, 320))
+    rng = np.random.RandomState(3)
+    alt = rng.uniform(0, 60, n)
+    az = rng.uniform(0, 90, n)
+    return (lambda: adsb_hud.aa_deg2px_many(alt, az), n)
+
+@bench("hud.annotate", params=((240,320), (1080,1920)))
+def _(res):
+    adsb_hud.load_cv2()
+    hud_setup(res)
+    adsb_hud.ADSB = populated_listener(300)
+    frame = np.random.randint(0, 64, res + (3,)).astype(np.uint8)
+    def fn():
+        adsb_hud.annotate((time.time(), frame.copy()))
+    return (fn, 1)
+
+@bench("hud.imencode", params=((240,320), (1080,1920)))
+def _(res):
+    cv2 = adsb_hud.load_cv2()
+    frame = np.random.randint(0, 64, res + (3,)).astype(np.uint8)
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+    return (lambda: cv2.imencode(".jpg", frame, params), 1)
+
+@bench("hud.enhance", params=((240,320), (1080,1920)))
+def _(res):
+    from enhance import Enhancer
+    e = Enhancer('brighten', decimate=4, alpha=0.2)
+    frame = np.random.randint(0, 64, res + (3,)).astype(np.uint8)
+    return (lambda: e(frame), 1)
+
+@bench("hud.detect", params=((240,320), (1080,1920)))
+def _(res):
+    from detect import Detector
+    d = Detector(decimate=2 if res[0] < 480 else 4, warmup=2)
+    sky = np.random.randint(60, 70, res + (3,)).astype(np.uint8)
+    frames = []
+    for i in range(20): # something crossing the frame
+        img = sky.copy()
+        y, x = res[0]//3 + i, res[1]//4 + 3*i
+        img[y:y+4, x:x+12] = 200
+        frames.append(img)
+    it = itertools.cycle(frames)
+    return (lambda: d(next(it)), 1)
+
+@bench("platesolve.refine", params=((480,640),))
+def _(res):
+    # A cached solution checked against the same stars a few pixels off
+    from platesolve import WCS, Solution, Stars, refine
+    h, w = res
+    rng = np.random.RandomState(1)
+    t = 1.5e9
+    wcs = WCS((80.0, 20.0), (w/2.0, h/2.0), [[-0.1, 0.0], [0.0, 0.1]])
+    y, x = rng.uniform(0, h, 60), rng.uniform(0, w, 60)
+    ra, dec = wcs.pix_to_radec(x + 1, y + 1)
+    solution = Solution(wcs, t, 37.7, -122.4, res, np.column_stack((ra, dec)))
+    stars = Stars(y + 2.0, x - 3.0, np.ones(60))
+    return (lambda: refine(solution, stars, t), 1)
+
+
+############################################################
+
+def host_info():
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        rev = None
+    return {
+        "hostname": platform.node(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cv2": getattr(sys.modules.get('cv2'), '__version__', None),
+        "git_rev": rev,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ADS-B HUD hot paths")
+    parser.add_argument("-k", dest="filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("-o", dest="output", default=None, help="write JSON results here")
+    parser.add_argument("--quick", action="store_true", help="shorter timing runs, for a smoke test")
+    args = parser.parse_args(argv)
+
+    min_time, repeat = (0.02, 2) if args.quick else (0.2, 5)
+
+    results = []
+    for name, params, setup in BENCHMARKS:
+        if args.filter not in name:
+            continue
+        for param in params:
+            label = name if param is None else "%s[%s]" % (name, "x".join(map(str, param)) if isinstance(param, tuple) else param)
+            try:
+                fn, items = setup(param)
+            except ImportError, e:
+                print "%-36s skipped: %s" % (label, e)
+                continue
+            best, median, number = run_one(fn, min_time, repeat)
+            results.append({ "name": name, "param": param, "best_s": best, "median_s": median,
+                             "number": number, "items": items, "items_per_s": items/best })
+            print "%-36s %12.3fms %14.0f/s" % (label, best*1e3, items/best)
+            sys.stdout.flush()
+
+    if args.output:
+        f = open(args.output, "w")
+        json.dump({ "timestamp": time.time(), "host": host_info(), "results": results }, f, indent=1)
+        f.close()
+
+if __name__ == '__main__':
+    main()
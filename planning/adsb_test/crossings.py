@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Which satellites cross a fixed camera's frame, and when, for scheduling
+# captures across the catalog.
+#
+#   crossings.py catalog.txt config.json [--hours 12] [--start unix_time]
+#
+# The pointing, FOV and resolution come from the config's camera_loc and
+# camera sections, and pixels are mapped the same way the HUD draws them.
+# This builds on passes.py: the catalog gets propagated over the same
+# coarse grid, and only the grid intervals where a satellite could be as
+# high as the bottom of the frame get sampled finely (from the Hermite
+# interpolant, not more propagation) and projected onto the sensor in one
+# batch.  The edges of each run of on-screen samples are then bisected for
+# the entry and exit times.
+
+import argparse
+from collections import namedtuple
+import json
+import time
+
+import numpy as np
+
+from eci import *
+from fov import CameraProjection
+from passes import Catalog, Intervals, elevations, peaks, time_grid
+
+# enter/exit are unix times.  The track is t (T,) with the matching px
+# (T,2), as fractional (y, x) sensor coordinates in aa_deg2px's order:
+# it starts and ends on the edge of the frame, at enter and exit.
+Crossing = namedtuple('Crossing', ['sat', 'name', 'enter', 'exit', 't', 'px'])
+
+# Candidate intervals sampled at once.  Everything in flight is about a
+# kilobyte per sample, and a minute's grid interval is 60 samples, so this
+# keeps it to tens of MB, which matters on a Pi.
+SAMPLE_BATCH = 512
+
+
+def candidates(observer, proj, t_grid, r, v, el, climbing, ok, tol):
+    # (sats, intervals) where a satellite might get up to the bottom of the frame
+    low = np.deg2rad(proj.lowest())
+    high = (el[:,:-1] > low) | (el[:,1:] > low)
+
+    # A peak between two low grid points can still poke up into the frame
+    s, i = peaks(climbing, ok)
+    s, i = s[~high[s,i]], i[~high[s,i]]
+    if len(s):
+        iv = Intervals(observer, t_grid, r, v, s, i)
+        top = iv.elevation(iv.maximize(tol)) > low
+        high[s[top], i[top]] = True
+
+    return np.nonzero(high & ok)
+
+def screen_frame(catalog, observer, proj, t_grid, step=1.0, tol=0.01, offset=0):
+    """Find every crossing of the frame by a satellite in catalog over t_grid
+
+    step is how finely (in seconds) the interesting intervals get sampled,
+    so anything that clips a corner of the frame in less time than that
+    can be missed.  Returns a list of Crossings, in no particular order.
+    """
+    r, v, el, climbing, ok = elevations(observer, t_grid, catalog.propagate(t_grid))
+    s, i = candidates(observer, proj, t_grid, r, v, el, climbing, ok, tol)
+    if not len(s):
+        return []
+
+    # Sample every candidate interval at the same fractions of the way across
+    dt = t_grid[1] - t_grid[0]
+    n_sub = int(np.ceil(dt/step))
+    spacing = dt/n_sub
+    frac = np.arange(n_sub)/float(n_sub)
+
+    def project(iv, t):
+        alt, az = iv.alt_az(t)
+        return proj.to_px(np.rad2deg(alt), np.rad2deg(az))
+
+    # SAMPLE_BATCH intervals at a time, each replicated across its
+    # sub-steps, keeping only the samples that land on the sensor
+    found = []
+    for b in range(0, len(s), SAMPLE_BATCH):
+        bs, bi = np.repeat(s[b:b+SAMPLE_BATCH], n_sub), np.repeat(i[b:b+SAMPLE_BATCH], n_sub)
+        rep = Intervals(observer, t_grid, r, v, bs, bi)
+        t = rep.t0 + np.tile(frac, len(bs)//n_sub)*rep.dt
+        py, px = project(rep, t)
+        on = proj.onscreen(py, px)
+        found.append((bs[on], bi[on], t[on], py[on], px[on]))
+    sats, ivals, times, pys, pxs = [ np.concatenate(c) for c in zip(*found) ]
+    if not len(times):
+        return []
+
+    # Runs of on-screen samples, by satellite then time
+    order = np.lexsort((times, sats))
+    sats, ivals, times, pys, pxs = sats[order], ivals[order], times[order], pys[order], pxs[order]
+
+    breaks = np.flatnonzero((np.diff(sats) != 0) | (np.diff(times) > 1.5*spacing)) + 1
+    first = np.concatenate(([0], breaks))
+    last = np.concatenate((breaks - 1, [len(times) - 1]))
+
+    # Bisect between the first on-screen sample and the one before it for
+    # entry, and likewise for exit.  Each uses its sample's own interval,
+    # extrapolating up to one sample spacing past its end if need be.
+    def edge(j, lo, hi, entering):
+        ends = Intervals(observer, t_grid, r, v, sats[j], ivals[j])
+        def inside(tt):
+            return proj.onscreen(*project(ends, tt)) == entering
+        tt = ends.flip(inside, tol, lo, hi)
+        # Nothing to bisect at the very start or end of the window
+        clipped = (lo < t_grid[0]) | (hi > t_grid[-1])
+        tt = np.where(clipped, times[j], tt)
+        return (tt, project(ends, tt))
+
+    t_enter, (ey, ex) = edge(first, times[first] - spacing, times[first], True)
+    t_exit, (xy, xx) = edge(last, times[last], times[last] + spacing, False)
+
+    retval = []
+    for k in range(len(first)):
+        a, b = first[k], last[k] + 1
+        sat = sats[a]
+        track_t = np.concatenate(([t_enter[k]], times[a:b], [t_exit[k]]))
+        track_px = np.column_stack((np.concatenate(([ey[k]], pys[a:b], [xy[k]])),
+                                    np.concatenate(([ex[k]], pxs[a:b], [xx[k]]))))
+        retval.append(Crossing(int(sat) + offset, catalog.names[sat], t_enter[k], t_exit[k], track_t, track_px))
+    return retval
+
+def find_crossings(catalog, observer, proj, t0, t1, grid_step=60.0, step=1.0, tol=0.01, chunk=256):
+    """Every crossing of proj's frame, seen from observer, between unix times t0 and t1
+
+    The catalog is screened chunk satellites at a time, which (with
+    SAMPLE_BATCH) is what bounds the memory used.  Returns Crossings
+    sorted by entry time.
+    """
+    t_grid = time_grid(t0, t1, grid_step)
+    retval = []
+    for i in range(0, len(catalog), chunk):
+        retval.extend(screen_frame(catalog[i:i+chunk], observer, proj, t_grid, step, tol, offset=i))
+    retval.sort(key=lambda c: (c.enter, c.sat))
+    return retval
+
+def from_config(config):
+    # (ECIObserver, CameraProjection) for a HUD config, eg dev.json
+    loc = config['loc']
+    observer = ECIObserver(np.deg2rad(loc['lat']), np.deg2rad(loc['lon']), loc['alt'])
+    proj = CameraProjection((config['camera_loc']['alt'], config['camera_loc']['az']),
+                            config['camera']['FOV'], config['camera']['resolution'])
+    return (observer, proj)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the satellites crossing a fixed camera's frame")
+    parser.add_argument("catalog", help="TLE file (2 or 3 line), or a glob of Gpredict .sat files")
+    parser.add_argument("config", help="JSON config with loc, camera_loc and camera, eg dev.json")
+    parser.add_argument("--start", type=float, default=None, help="unix time to start from (default: now)")
+    parser.add_argument("--hours", type=float, default=12.0)
+    parser.add_argument("--step", type=float, default=1.0, help="sampling step inside the frame, seconds")
+    args = parser.parse_args(argv)
+
+    f = open(args.config)
+    observer, proj = from_config(json.load(f))
+    f.close()
+
+    catalog = Catalog.load(args.catalog)
+    t_start = time.time()
+    t0 = args.start or t_start
+    crossings = find_crossings(catalog, observer, proj, t0, t0 + args.hours*3600, step=args.step)
+    t_end = time.time()
+
+    for c in crossings:
+        print "%-24s %s - %s (%5.1fs)  (%3d,%3d) -> (%3d,%3d)" % (c.name[:24],
+            time.strftime("%H:%M:%S", time.localtime(c.enter)),
+            time.strftime("%H:%M:%S", time.localtime(c.exit)),
+            c.exit - c.enter, c.px[0,0], c.px[0,1], c.px[-1,0], c.px[-1,1])
+    print "%d crossings by %d satellites; screened in %0.2fs" % (len(crossings), len(catalog), t_end - t_start)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# Moving object detection on the HUD's frames, for finding the planes
+# (and satellite streaks) we're predicting in the video itself.
+#
+# Each frame gets shrunk (by `decimate` in each direction) and turned to
+# gray, and compared against a running average of the sky.  Pixels that
+# differ by more than `threshold` are foreground; those are grouped into
+# connected components, and each component's second moments give its
+# length and direction, so a streak comes out as one long detection
+# rather than a dot.  The background learns from foreground pixels ten
+# times slower than the rest, so something slow doesn't get averaged
+# into the sky.
+#
+# All the per-frame images are allocated once, up front, and everything
+# past the OpenCV calls is array math over just the foreground pixels.
+#
+# Run this directly for a benchmark at a range of frame sizes.
+
+from collections import namedtuple
+import time
+
+import numpy as np
+
+# Everything found in one frame, as arrays with one entry per detection.
+# y, x are the centroid in full frame pixels (row from the top, as
+# OpenCV has it); area is in shrunk pixels; length is the streak's
+# length along its major axis, in full frame pixels, and angle its
+# direction (radians, from the x axis towards +y).
+Detections = namedtuple('Detections', ['y', 'x', 'area', 'length', 'angle'])
+
+NO_DETECTIONS = Detections(*[ np.zeros(0) for f in Detections._fields ])
+
+
+class Detector:
+    """Running background subtraction and blob/streak finding on uint8 frames
+
+    * decimate: shrink frames by this in each direction first
+    * alpha: the background's weight for each new frame
+    * threshold: gray levels a pixel has to differ from the background by
+    * min_area: smallest detection, in shrunk pixels
+    * max_fraction: if more of the frame than this changes at once (the
+      camera adjusting its exposure, say), start the background over
+    * warmup: frames to learn the background from before detecting
+    """
+    def __init__(self, decimate=2, alpha=0.05, threshold=20, min_area=2, max_fraction=0.05, warmup=10):
+        self.cv2 = None # imported with the first frame, so a HUD running without video never loads it
+        self.decimate = max(1, int(decimate))
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_area = min_area
+        self.max_fraction = max_fraction
+        self.warmup = warmup
+
+        self.shape = None # of the full frames the buffers are set up for
+        self.frames = 0
+        self.stats = { 'detections': 0, 'resets': 0 }
+
+    def _allocate(self, shape):
+        if self.cv2 is None:
+            import cv2
+            self.cv2 = cv2
+        h, w = shape[0], shape[1]
+        sh, sw = -(-h//self.decimate), -(-w//self.decimate)
+        self.shape = shape
+        self.small = np.empty((sh, sw) + tuple(shape[2:]), dtype=np.uint8)
+        self.gray = np.empty((sh, sw), dtype=np.uint8)
+        self.background = np.empty((sh, sw), dtype=np.float32)
+        self.background8 = np.empty((sh, sw), dtype=np.uint8)
+        self.diff = np.empty((sh, sw), dtype=np.uint8)
+        self.mask = np.empty((sh, sw), dtype=np.uint8)
+        self.learn = np.empty((sh, sw), dtype=np.uint8)
+        self.labels = np.empty((sh, sw), dtype=np.int32)
+        self.frames = 0
+
+    def _shrink(self, img):
+        # img, decimated and in gray, into self.gray
+        cv2 = self.cv2
+        src = img
+        if self.decimate > 1:
+            cv2.resize(img, (self.gray.shape[1], self.gray.shape[0]), dst=self.small, interpolation=cv2.INTER_AREA)
+            src = self.small
+        if src.ndim == 3:
+            cv2.cvtColor(src, cv2.COLOR_RGB2GRAY, dst=self.gray)
+        else:
+            self.gray[:] = src
+
+    def __call__(self, img):
+        # Detections in the uint8 frame img (gray, or RGB), which isn't touched
+        cv2 = self.cv2
+        if img.shape != self.shape:
+            self._allocate(img.shape)
+        self._shrink(img)
+
+        self.frames += 1
+        if self.frames == 1:
+            self.background[:] = self.gray
+            return NO_DETECTIONS
+
+        if self.frames <= self.warmup:
+            # Start off with the plain average, so whatever was moving in
+            # the first frame doesn't stay behind as a ghost
+            cv2.accumulateWeighted(self.gray, self.background, 1.0/self.frames)
+            return NO_DETECTIONS
+
+        cv2.convertScaleAbs(self.background, dst=self.background8)
+        cv2.absdiff(self.gray, self.background8, dst=self.diff)
+        cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.mask)
+
+        # Learn the sky from everything that isn't foreground, and from
+        # the foreground too, but much more slowly (so something that's
+        # stopped does fade into the sky eventually)
+        cv2.accumulateWeighted(self.gray, self.background, self.alpha/10)
+        cv2.bitwise_not(self.mask, dst=self.learn)
+        cv2.accumulateWeighted(self.gray, self.background, self.alpha, mask=self.learn)
+        n_fg = cv2.countNonZero(self.mask)
+        if not n_fg:
+            return NO_DETECTIONS
+        if n_fg > self.max_fraction*self.mask.size:
+            self.background[:] = self.gray
+            self.frames = 1
+            self.stats['resets'] += 1
+            return NO_DETECTIONS
+
+        n, labels, comp, centroids = cv2.connectedComponentsWithStats(self.mask, self.labels, connectivity=8)
+        area = comp[1:, cv2.CC_STAT_AREA].astype(float)
+
+        # Second moments of each component, over just the foreground pixels
+        ys, xs = np.nonzero(self.mask)
+        lab = labels[ys, xs]
+        def total(w):
+            return np.bincount(lab, weights=w, minlength=n)[1:]
+        my, mx = centroids[1:,1], centroids[1:,0]
+        dy, dx = ys - centroids[lab,1], xs - centroids[lab,0]
+        syy, sxx, sxy = total(dy*dy)/area, total(dx*dx)/area, total(dx*dy)/area
+
+        # The major axis' variance, and a uniform bar of length L has L^2/12
+        major = (sxx + syy)/2 + np.sqrt(((sxx - syy)/2)**2 + sxy**2)
+        length = np.sqrt(12*major + 1)*self.decimate
+        angle = 0.5*np.arctan2(2*sxy, sxx - syy)
+
+        keep = area >= self.min_area
+        d = self.decimate
+        retval = Detections((my[keep] + 0.5)*d - 0.5, (mx[keep] + 0.5)*d - 0.5, area[keep], length[keep], angle[keep])
+        self.stats['detections'] += len(retval.y)
+        return retval
+
+
+def associate(dets, pred_y, pred_x, gate):
+    """Match predicted positions (eg planes, in frame pixels) to detections
+
+    Each prediction gets at most one detection and vice versa, nearest
+    pairs first, and only within gate pixels.  Returns (prediction
+    indices, detection indices), matched up.
+    """
+    pred_y = np.asarray(pred_y, dtype=float)
+    pred_x = np.asarray(pred_x, dtype=float)
+    if not len(pred_y) or not len(dets.y):
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+
+    dist = np.hypot(pred_y[:,None] - dets.y[None,:], pred_x[:,None] - dets.x[None,:])
+    p, q = np.nonzero(dist <= gate)
+    order = np.argsort(dist[p, q])
+    used_p, used_q = set(), set()
+    retval_p, retval_q = [], []
+    for i in order:
+        if p[i] in used_p or q[i] in used_q:
+            continue
+        used_p.add(p[i])
+        used_q.add(q[i])
+        retval_p.append(p[i])
+        retval_q.append(q[i])
+    return (np.array(retval_p, dtype=int), np.array(retval_q, dtype=int))
+
+
+def benchmark(sizes=((240,320), (480,640), (720,1280), (1080,1920)), n=50):
+    rng = np.random.RandomState(1)
+
+    print "%-10s %12s %12s" % ("size", "decimate 2", "decimate 4")
+    for h,w in sizes:
+        sky = rng.randint(60, 70, (h,w,3)).astype(np.uint8)
+        frames = []
+        for i in range(n):
+            img = sky.copy()
+            y, x = h//3 + i, w//4 + 3*i
+            img[y:y+3, x:x+12] = 200 # something moving
+            frames.append(img)
+
+        times = []
+        for d in (2, 4):
+            det = Detector(decimate=d, warmup=2)
+            t0 = time.time()
+            for img in frames:
+                det(img)
+            times.append((time.time() - t0)/n*1e3)
+        print "%-10s %10.2fms %10.2fms" % (("%dx%d" % (h,w),) + tuple(times))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import threading
+
 import numpy as np
 
 class GMST:
@@ -37,6 +40,57 @@ class WGS84:
                         # Alternately, omega = 2*pi/86400*omega_e
 
 
+def geodetic_to_eci(lat, alt_km, theta):
+    """ECI position(s), in km, of geodetic point(s) at sidereal angle(s) theta
+
+    Everything broadcasts, so this serves both the scalar and batched paths:
+    lat and theta in radians, alt in km above the spheroid.  Returns (x,y,z).
+    """
+    # Correct for spheroid (as in Kelso's "Orbital Coordinate Systems, Part III")
+    c = 1/np.sqrt(1 + WGS84.f*(WGS84.f-2)*(np.sin(lat)**2))
+    sq = c*(1-WGS84.f)**2
+
+    # no idea why this is called achcp.
+    achcp = (WGS84.a*c + alt_km) * np.cos(lat)
+
+    pos_x = achcp*np.cos(theta)
+    pos_y = achcp*np.sin(theta)
+    pos_z = (WGS84.a*sq + alt_km)*np.sin(lat)
+    return (pos_x, pos_y, pos_z)
+
+def sez_xform(lat, theta):
+    """Rotation matrix from ECI into topocentric (south, east, zenith)
+
+    For scalar theta, returns a (3,3) matrix; for an array of M sidereal
+    angles, returns an (M,3,3) stack of them.
+    """
+    l_c,l_s = np.cos(lat), np.sin(lat) # we use these a lot below
+    t_c,t_s = np.cos(theta), np.sin(theta)
+
+    # The axes used here are slightly annoying to me: they're due south, due east, and up.
+    # This is almost certainly done to keep some handedness constraints in the math, but,
+    # dangit three-space, why are you so difficult?
+    xform = np.empty(np.shape(theta) + (3,3))
+    xform[...,0,0] = l_s*t_c
+    xform[...,0,1] = l_s*t_s
+    xform[...,0,2] = -l_c
+    xform[...,1,0] = -t_s
+    xform[...,1,1] = t_c
+    xform[...,1,2] = 0
+    xform[...,2,0] = l_c*t_c
+    xform[...,2,1] = l_c*t_s
+    xform[...,2,2] = l_s # prettier if you swap y and z, but that's confusing
+    return xform
+
+def sez_alt_az(vec_sez):
+    """Elevation, azimuth (radians) and range of SEZ vector(s), shape (...,3)"""
+    distance = np.sqrt(np.sum(vec_sez**2, axis=-1))
+
+    azimuth = np.mod(np.pi/2 - np.arctan2(vec_sez[...,0], vec_sez[...,1]), 2*np.pi)
+    elevation = np.arcsin(vec_sez[...,2]/distance)
+    return (elevation, azimuth, distance)
+
+
 class ECIPoint:
     "Represents an (x,y,z) point with velocity in the Earth-Centered Inertial coordinate system"
     def __init__(self, pos, vel):
@@ -89,16 +143,7 @@ class ECIEarthPoints:
 
         theta = self.lmst(t)
 
-        # Correct for spheroid
-        c = np.sqrt(1 + WGS84.f*(WGS84.f-2)*(np.sin(self.lat)**2))
-        sq = c*(1-WGS84.f)**2
-
-        # no idea why this is called achcp.
-        achcp = (WGS84.a*sq + self.alt) * np.cos(self.lat)
-
-        pos_x = achcp*np.cos(theta)
-        pos_y = achcp*np.sin(theta)
-        pos_z = (WGS84.a*c + self.alt)*np.sin(self.lat)
+        pos_x, pos_y, pos_z = geodetic_to_eci(self.lat, self.alt, theta)
 
         vel_x = WGS84.omega * -1*pos_y # derivative of sin and cos are handy here
         vel_y = WGS84.omega *    pos_x
@@ -115,29 +160,117 @@ class ECIEarthPoints:
 
         v_range = obs_pt.range_to(pt)
 
-        l_c,l_s = np.cos(self.lat), np.sin(self.lat) # we use these a lot below
-        t_c,t_s = np.cos(theta), np.sin(theta)
-
-        # The axes used here are slightly annoying to me: they're due south, due east, and up.
-        # This is almost certainly done to keep some handedness constraints in the math, but,
-        # dangit three-space, why are you so difficult?
-        xform = np.array([
-            [l_s*t_c, l_s*t_s, -l_c],
-            [-t_s,    t_c,        0],
-            [l_c*t_c, l_c*t_s,  l_s]]) # prettier if you swap y and z, but that's confusing
+        xform = sez_xform(self.lat, theta)
 
         vec_sez = xform.dot(v_range)
         return vec_sez
 
+    def frames(self, t):
+        "(positions, SEZ rotations) of this point at M unix times t, as (M,3) and (M,3,3) arrays"
+        theta = self.lmst(np.atleast_1d(np.asarray(t, dtype=float)))
+        obs_pos = np.stack(np.broadcast_arrays(*geodetic_to_eci(self.lat, self.alt, theta)), axis=-1)
+        return (obs_pos, sez_xform(self.lat, theta))
+
+    def alt_az_range(self, t, pos, frames=None):
+        """Batched alt_az: elevation, azimuth and range to many points at many times
+
+        * t: M unix times (or a scalar)
+        * pos: (N,M,3) ECI positions in km, eg from ECIEarthPointsArray.pos(t)
+        * frames: frames(t), if you've already got them
+
+        Returns (elevation, azimuth, range) as (N,M) arrays, in radians and
+        km.  The observer's position and SEZ rotation are computed once per
+        timestamp and shared across all N points.
+        """
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        obs_pos, xform = frames if frames is not None else self.frames(t) # (M,3), (M,3,3)
+
+        v_range = np.asarray(pos, dtype=float).reshape(-1, len(t), 3) - obs_pos
+        vec_sez = np.einsum('mij,nmj->nmi', xform, v_range)
+        return sez_alt_az(vec_sez)
+
     def alt_az(self, t, pt):
         # Returns the elevation and azimuth of the given point in space at time t from here
-        vec_sez = self.v_to(t,pt)
-        distance = np.sqrt(np.sum(vec_sez**2))
+        elevation, azimuth, distance = sez_alt_az(self.v_to(t,pt))
+        return (elevation, azimuth)
 
-        azimuth = np.pi/2 - np.arctan2(vec_sez[0], vec_sez[1])
-        elevation = np.arcsin(vec_sez[2]/distance)
 
-        if azimuth < 0:
-            azimuth += 2*np.pi
+class ECIObserver(ECIEarthPoints):
+    """An ECIEarthPoints for a fixed observer, with its per-time frame cached
+
+    The geodetic terms only depend on lat/alt, so they're computed once up
+    front.  The (position, SEZ rotation) frame for a given unix time is kept
+    in a small LRU, so every target looked at for the same timestamp costs
+    a single matrix-vector product, whether one at a time or in a batched
+    alt_az_range.
+    """
+    def __init__(self, lat, lon, alt_m, cache_size=16):
+        ECIEarthPoints.__init__(self, lat, lon, alt_m)
+
+        # At theta=0, x is the equatorial-plane radius and z is fixed for good
+        self._achcp, _, self._pos_z = geodetic_to_eci(self.lat, self.alt, 0)
+
+        self.cache_size = cache_size
+        self._frames = OrderedDict() # t => (pos, xform)
+        self._frames_lock = threading.Lock()
+
+    def frame(self, t):
+        "Returns (ECI position, SEZ rotation matrix) for the observer at unix time t"
+        with self._frames_lock:
+            fr = self._frames.pop(t, None)
+            if fr is None:
+                theta = self.lmst(t)
+                pos = np.array((self._achcp*np.cos(theta), self._achcp*np.sin(theta), self._pos_z))
+                fr = (pos, sez_xform(self.lat, theta))
+                if len(self._frames) >= self.cache_size:
+                    self._frames.popitem(last=False)
+            self._frames[t] = fr # most recently used goes at the end
+            return fr
+
+    def frames(self, t):
+        # As ECIEarthPoints.frames, but a single time goes through the
+        # cache, and several are made from the precomputed terms
+        t = np.asarray(t, dtype=float)
+        if t.size == 1:
+            pos, xform = self.frame(float(t))
+            return (pos[None], xform[None])
+        theta = self.lmst(t.ravel())
+        pos = np.column_stack((self._achcp*np.cos(theta), self._achcp*np.sin(theta), np.full(len(theta), self._pos_z)))
+        return (pos, sez_xform(self.lat, theta))
 
-        return (elevation, azimuth)
+    def at(self, t):
+        pos, xform = self.frame(t)
+        vel = (WGS84.omega * -1*pos[1], WGS84.omega * pos[0], 0)
+        return ECIPoint(pos, vel)
+
+    def v_to(self, t, pt):
+        pos, xform = self.frame(t)
+        return xform.dot(pt.pos - pos)
+
+
+class ECIEarthPointsArray:
+    "Vectorized ECIEarthPoints: N lat/lon/alts evaluated at M unix times in one pass"
+    def __init__(self, lat, lon, alt_m):
+        """Create a batch of earth points
+
+        * lat, lon in radians, alt in meters; anything broadcastable to (N,)
+        """
+        lat, lon, alt_m = np.broadcast_arrays(np.atleast_1d(np.asarray(lat, dtype=float)),
+                                              np.atleast_1d(np.asarray(lon, dtype=float)),
+                                              np.atleast_1d(np.asarray(alt_m, dtype=float)))
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt_m/1e3 # Convert to km
+
+    def __len__(self):
+        return len(self.lat)
+
+    def lmst(self, t):
+        # Local mean sidereal times for every point at every unix time t, (N,M) radians
+        gmst = GMST.from_unix(np.atleast_1d(np.asarray(t, dtype=float)))
+        return self.lon[:,None] + gmst[None,:]
+
+    def pos(self, t):
+        # ECI positions (km) of every point at every unix time t, as an (N,M,3) array
+        theta = self.lmst(t)
+        return np.stack(np.broadcast_arrays(*geodetic_to_eci(self.lat[:,None], self.alt[:,None], theta)), axis=-1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Frame enhancement for faint targets, cheap enough to run on every frame.
+#
+# Run this directly for a benchmark against adsb_hud's brighten() and
+# posterize() at a range of frame sizes.
+
+import sys
+import time
+
+import numpy as np
+
+def hist_percentiles(hist, percentiles):
+    # Levels (0-255) at the given percentiles of a 256-bin histogram
+    cdf = np.cumsum(hist, dtype=float)
+    return np.searchsorted(cdf, np.asarray(percentiles, dtype=float)/100.0*cdf[-1])
+
+def apply_lut(img, lut):
+    # Map a uint8 image through a 256-entry uint8 lookup table, in place
+    cv2 = sys.modules.get('cv2') # only if someone else already paid to import it
+    if cv2 is not None:
+        cv2.LUT(img, lut, dst=img)
+    else:
+        # uint8 indices are always in range, and 'clip' skips numpy's bounds-check copy
+        np.take(lut, img, out=img, mode='clip')
+    return img
+
+
+class Enhancer:
+    """Per-frame contrast stretch (brighten) or threshold (posterize)
+
+    Percentiles come from a 256-bin histogram rather than a full sort,
+    optionally taken on a frame decimated by `decimate` in each direction,
+    and optionally smoothed across frames (exponentially, with weight
+    `alpha` for the newest).  The stretch is then applied through a
+    lookup table, in place on the uint8 frame, with no float copies.
+
+    * mode 'brighten' maps the low..high percentiles onto 0..255
+    * mode 'posterize' blows everything above `percentile` out to 255
+    """
+    def __init__(self, mode='brighten', low=5, high=95, percentile=75, decimate=1, alpha=None):
+        if mode not in ('brighten', 'posterize'):
+            raise ValueError("Unknown enhancement mode %s" % mode)
+        self.mode = mode
+        self.low = low
+        self.high = high
+        self.percentile = percentile
+        self.decimate = max(1, int(decimate))
+        self.alpha = alpha
+
+        self.hist = None
+        self.levels = None
+        self.lut = None
+
+    def _update_hist(self, img):
+        sub = img[::self.decimate, ::self.decimate] if self.decimate > 1 else img
+        hist = np.bincount(sub.ravel(), minlength=256)
+        if self.alpha is None or self.hist is None:
+            self.hist = hist.astype(float)
+        else:
+            self.hist *= (1 - self.alpha)
+            self.hist += self.alpha*hist
+
+    def _build_lut(self, levels):
+        v = np.arange(256, dtype=float)
+        if self.mode == 'brighten':
+            lo, hi = levels
+            lut = (v - lo) * 255.0/max(hi - lo, 1)
+        else:
+            lut = (v - levels[0]) * 255
+        return np.clip(lut, 0, 255).astype(np.uint8)
+
+    def __call__(self, img):
+        # Enhances the uint8 frame img in place, and returns it
+        self._update_hist(img)
+
+        if self.mode == 'brighten':
+            levels = tuple(hist_percentiles(self.hist, (self.low, self.high)))
+        else:
+            levels = tuple(hist_percentiles(self.hist, (self.percentile,)))
+
+        if levels != self.levels:
+            self.levels = levels
+            self.lut = self._build_lut(levels)
+
+        return apply_lut(img, self.lut)
+
+
+def benchmark(sizes=((240,320), (480,640), (720,1280), (1080,1920)), n=20):
+    from adsb_hud import brighten, posterize
+
+    def timeit(fn, img):
+        t0 = time.time()
+        for i in range(n):
+            fn(img)
+        return (time.time() - t0)/n*1e3
+
+    print "%-10s %12s %12s %12s %12s %12s" % ("size", "brighten", "Enhancer", "decim. 4", "posterize", "Enhancer")
+    for h,w in sizes:
+        img = np.random.randint(0, 256, (h,w,3)).astype(np.uint8)
+        frame = img.copy()
+        print "%-10s %10.2fms %10.2fms %10.2fms %10.2fms %10.2fms" % (
+            "%dx%d" % (h,w),
+            timeit(brighten, img),
+            timeit(Enhancer('brighten'), frame),
+            timeit(Enhancer('brighten', decimate=4), frame),
+            timeit(posterize, img),
+            timeit(Enhancer('posterize', decimate=4), frame))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,130 @@
+import numpy as np
+
+class FOVCull:
+    """A cheap pre-filter for things that can't possibly be in the camera's view
+
+    This works on a flat-earth (equirectangular) approximation around the
+    observer, so rejecting a point is a handful of multiplies, with no trig,
+    and only the survivors need to go through the full ECI pipeline.  It
+    checks three things: slant range, the azimuth wedge the camera looks
+    along, and the lowest elevation it can see.  Everything is padded by
+    margin degrees and slack_km, and the range and wedge by the flat-earth
+    approximation's own error out to max_range_km, so it only ever errs
+    on the side of letting things through.
+
+    Azimuths follow eci's alt_az() (pi/2 - atan2(S, E) in its SEZ frame),
+    so this wedge lines up with aa_deg2px.
+    """
+    KM_PER_DEG = 111.195 # km per degree of latitude, near enough
+
+    def __init__(self, lat, lon, alt_m, heading, span, max_range_km=400.0, margin=2.0, slack_km=0.0):
+        """Set up the culling region
+
+        * lat, lon of the observer in degrees, alt in meters
+        * heading: (alt, az) of the frame center, degrees
+        * span: (alt, az) degrees either side of heading that can land on the sensor
+        * max_range_km: anything further out is dropped
+        * margin: degrees of padding on every angular edge
+        * slack_km: how far a point may move between now and when it's drawn
+        """
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt_m/1e3
+        self.km_per_deg_lon = self.KM_PER_DEG*np.cos(np.deg2rad(lat))
+
+        self.slack = slack_km
+
+        # The flat distance uses the observer's km per degree of longitude,
+        # which overstates east-west distances toward the pole, by up to
+        # the ratio of cos(latitude) here and at max_range_km poleward.
+        # Pad the range by that, plus a percent for the spheroid.
+        reach = min(abs(lat) + max_range_km/self.KM_PER_DEG, 89.0)
+        pad = np.cos(np.deg2rad(lat))/np.cos(np.deg2rad(reach))*1.01
+        self.max_range2 = (max_range_km*pad + slack_km)**2
+
+        # Bearings on the flat map are off from the great circle ones by
+        # about half the meridians' convergence, which the wedge has to allow for
+        d_lon = (max_range_km*pad + slack_km)/(self.KM_PER_DEG*np.cos(np.deg2rad(reach)))
+        skew = d_lon*np.sin(np.deg2rad(reach))/2
+
+        # Lowest elevation that could be on screen; None if it dips below the horizon
+        el_min = heading[0] - span[0] - margin
+        self.tan_min = np.tan(np.deg2rad(el_min)) if el_min > 0 else None
+
+        # The azimuth wedge, as edge vectors in (east, south), with its apex
+        # pulled back far enough to cover anything within slack of the real one
+        self.half = span[1] + margin + skew
+        if self.half >= 180:
+            self.edges = None
+        else:
+            a0, a_l, a_r = np.deg2rad([heading[1], heading[1] - self.half, heading[1] + self.half])
+            self.edges = (np.sin(a_l), np.cos(a_l), np.sin(a_r), np.cos(a_r))
+
+            back = slack_km/np.sin(np.deg2rad(self.half)) if self.half < 90 else slack_km
+            self.apex = (-back*np.sin(a0), -back*np.cos(a0))
+
+    def visible(self, lat, lon, alt_m):
+        # Boolean mask of the points (degrees, degrees, meters) that might be on screen
+        d_s = (self.lat - np.asarray(lat))*self.KM_PER_DEG
+        d_e = (np.mod(np.asarray(lon) - self.lon + 180, 360) - 180)*self.km_per_deg_lon
+
+        r2 = d_s*d_s + d_e*d_e
+        mask = r2 <= self.max_range2
+
+        if self.edges is not None:
+            l_e, l_s, r_e, r_s = self.edges
+            s = d_s - self.apex[1]
+            e = d_e - self.apex[0]
+            past_left = (l_e*s - l_s*e) <= 0  # clockwise of the left edge
+            before_right = (r_e*s - r_s*e) >= 0 # counterclockwise of the right edge
+            if self.half <= 90:
+                mask &= past_left & before_right
+            else:
+                mask &= past_left | before_right
+
+        if self.tan_min is not None:
+            # Earth curvature only ever lowers the elevation, so flat-earth is conservative
+            h = np.asarray(alt_m)/1e3 - self.alt + self.slack
+            mask &= (h > 0) & (np.maximum(np.sqrt(r2) - self.slack, 0)*self.tan_min <= h)
+
+        return mask
+
+
+class CameraProjection:
+    """Maps alt/az onto the camera's sensor, the same way the HUD's aa_deg2px does
+
+    * heading: (alt, az) of the frame center, degrees
+    * fov: (alt, az) span of view, degrees
+    * px: (height, width) of the sensor; read on every call, so it can be
+      updated in place once the camera reports its real resolution
+
+    NB: like aa_deg2px, this spreads +/- fov (not fov/2) around the heading
+    across the sensor, and returns pixels in (alt, az), ie (y, x), order,
+    with y counting up from the bottom of the frame.
+    """
+    def __init__(self, heading, fov, px):
+        self.heading = heading
+        self.fov = fov
+        self.px = px
+
+    def to_px(self, alt, az):
+        # Fractional (px_alt, px_az) for arrays of alt, az in degrees
+        d_alt = np.asarray(alt) - self.heading[0]
+        d_az = np.mod(np.asarray(az) - self.heading[1] + 180, 360) - 180 # +/- 180
+
+        px_alt = self.px[0]/2.0 + d_alt/self.fov[0]/2.0*self.px[0]
+        px_az = self.px[1]/2.0 + d_az/self.fov[1]/2.0*self.px[1]
+        return (px_alt, px_az)
+
+    def from_px(self, px_alt, px_az):
+        # The inverse of to_px: (alt, az) in degrees for fractional pixel coordinates
+        alt = self.heading[0] + (np.asarray(px_alt) - self.px[0]/2.0)/self.px[0]*2.0*self.fov[0]
+        az = self.heading[1] + (np.asarray(px_az) - self.px[1]/2.0)/self.px[1]*2.0*self.fov[1]
+        return (alt, np.mod(az, 360))
+
+    def onscreen(self, px_alt, px_az):
+        return (px_alt >= 0) & (px_alt < self.px[0]) & (px_az >= 0) & (px_az < self.px[1])
+
+    def lowest(self):
+        # The lowest elevation (degrees) that lands on the sensor
+        return self.heading[0] - self.fov[0]
@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+
+# Always-on instrumentation that's cheap enough to leave in the hot paths.
+#
+# Nothing here logs per event.  The code being measured just bumps plain
+# counters (the listener's stats dict, LatestSlot.puts, ...) or adds to a
+# Timer, and Metrics pulls those in when it's asked, once per interval,
+# turning the deltas into rates.
+
+def label(name, **labels):
+    # A metric name with Prometheus-style labels, eg label("x", stream="cam") => 'x{stream="cam"}'
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (k, labels[k]) for k in sorted(labels)))
+
+
+def _total(k):
+    # Prometheus wants counters named ..._total (labels and all), eg x{a="b"} => x_total{a="b"}
+    name, brace, labels = k.partition("{")
+    if not name.endswith("_total"):
+        name += "_total"
+    return name + brace + labels
+
+
+class Timer:
+    "Accumulates the time taken by something, eg one stage of the frame pipeline"
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0 # since Metrics last took a sample
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def since(self, t0):
+        # Add the time since t0 (from time.time()); returns now, to chain stages
+        now = time.time()
+        self.add(now - t0)
+        return now
+
+
+class Metrics:
+    """A registry of counters, gauges and timers, sampled once per interval
+
+    * counters: functions returning {name: cumulative count}
+    * gauges: functions returning {name: current value}
+    * timers: Timers, by name
+
+    tick() takes a new sample once interval seconds have passed since the
+    last one (the HUD calls it from a thread that's awake anyway), and
+    rates are always over the last full interval.
+    """
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.counters = []
+        self.gauges = []
+        self.timers = {}
+
+        self.lock = threading.Lock()
+        self.t_sample = None
+        self.sample = {}     # counter name => value at t_sample
+        self.rates = {}      # counter name => per second, over the interval before t_sample
+        self.timer_max = {}  # timer name => longest time, over the same interval
+
+    def counter(self, fn):
+        self.counters.append(fn)
+
+    def gauge(self, fn):
+        self.gauges.append(fn)
+
+    def timer(self, name):
+        if name not in self.timers:
+            self.timers[name] = Timer()
+        return self.timers[name]
+
+    def _counts(self):
+        retval = {}
+        for fn in self.counters:
+            retval.update(fn())
+        for name,t in self.timers.items():
+            retval[name + "_count"] = t.count
+            retval[name + "_seconds_total"] = t.total
+        return retval
+
+    def _gauges(self):
+        retval = {}
+        for fn in self.gauges:
+            retval.update(fn())
+        return retval
+
+    def tick(self, now=None):
+        now = now or time.time()
+        if self.t_sample is not None and now - self.t_sample < self.interval:
+            return
+        with self.lock:
+            counts = self._counts()
+            if self.t_sample is not None:
+                dt = now - self.t_sample
+                self.rates = dict((k, (v - self.sample.get(k, 0))/dt) for k,v in counts.items())
+            self.timer_max = dict((name, t.max) for name,t in self.timers.items())
+            for t in self.timers.values():
+                t.max = 0.0
+            self.sample = counts
+            self.t_sample = now
+
+    def report(self):
+        # Everything as a dict, for /stats.json
+        self.tick()
+        with self.lock:
+            timers = {}
+            for name,t in self.timers.items():
+                n = self.rates.get(name + "_count", 0)
+                timers[name] = {
+                    "count": t.count,
+                    "per_s": n,
+                    "mean_ms": self.rates.get(name + "_seconds_total", 0)/n*1e3 if n else None,
+                    "max_ms": self.timer_max.get(name, 0)*1e3,
+                }
+            return {
+                "t": self.t_sample,
+                "interval": self.interval,
+                "counters": self._counts(),
+                "rates": dict(self.rates),
+                "gauges": self._gauges(),
+                "timers": timers,
+            }
+
+    def json(self):
+        return json.dumps(self.report(), indent=1, sort_keys=True)
+
+    def prometheus(self, prefix="hud_"):
+        # The Prometheus text exposition format, for /metrics; every
+        # counter comes out as ..._total, whatever it's called in the JSON
+        self.tick()
+        with self.lock:
+            samples = [ ("counter", _total(k), v) for k,v in self._counts().items() ]
+            samples += [ ("gauge", k, v) for k,v in self._gauges().items() ]
+            samples += [ ("gauge", name + "_max_seconds", v) for name,v in self.timer_max.items() ]
+
+        by_name = {}
+        for typ,k,v in samples:
+            by_name.setdefault(k.split("{")[0], (typ, []))[1].append((k, v))
+
+        lines = []
+        for name in sorted(by_name):
+            typ, values = by_name[name]
+            lines.append("# TYPE %s%s %s" % (prefix, name, typ))
+            for k,v in sorted(values):
+                lines.append("%s%s %r" % (prefix, k, float(v)))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,120 @@
+import socket
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+from metrics import Timer, label
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    "An HTTPServer with a thread per request, so one client can't stall the rest"
+    daemon_threads = True
+
+
+class MJPEGStream:
+    """A JPEG stream that's encoded once and shared by every client watching it
+
+    publish() encodes a frame at most once, and no more than fps times a
+    second (and not at all while nobody's watching), into a single shared
+    slot tagged with a sequence number.
+    Clients wait for a sequence number newer than the last one they sent,
+    and always get whatever is newest, so a slow client just skips the
+    frames it missed instead of holding anything up.
+    """
+    def __init__(self, name, quality=80, fps=10.0):
+        self.name = name
+        self.quality = int(quality)
+        self.fps = float(fps)
+
+        import cv2 # not at the top, so the HTTP bits don't drag it in
+        self.imencode = cv2.imencode
+        self.params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.jpeg = None
+        self.t_last = 0
+
+        self.encode_time = Timer()
+        self.encoded_bytes = 0
+        self.clients = {} # "host:port" => [frames, bytes] sent, while connected
+        self.sent = [0, 0] # the same, for every client there's been
+
+    def publish(self, img, t=None):
+        # Offer a frame to the stream; returns True if it was encoded and sent out
+        t = t or time.time()
+        if not self.clients or t - self.t_last < 1.0/self.fps:
+            return False
+        self.t_last = t
+
+        t0 = time.time()
+        r, buf = self.imencode(".jpg", img, self.params)
+        if not r:
+            return False
+        jpeg = buf.tostring()
+        self.encode_time.since(t0)
+        self.encoded_bytes += len(jpeg)
+
+        with self.cond:
+            self.jpeg = jpeg
+            self.seq += 1
+            self.cond.notify_all()
+        return True
+
+    def next_frame(self, last_seq, timeout=None):
+        # Wait for a frame newer than last_seq; returns (seq, jpeg), jpeg is None on timeout
+        with self.cond:
+            if self.seq <= last_seq:
+                self.cond.wait(timeout)
+            if self.seq <= last_seq:
+                return (last_seq, None)
+            return (self.seq, self.jpeg)
+
+    def serve(self, handler):
+        # Stream to a BaseHTTPRequestHandler's client until it goes away
+        handler.send_response(200)
+        handler.send_header('Content-type','multipart/x-mixed-replace; boundary=--jpgboundary')
+        handler.end_headers()
+
+        client = "%s:%d" % handler.client_address[:2]
+        sent = self.clients[client] = [0, 0]
+
+        seq = 0
+        try:
+            while True:
+                seq, jpeg = self.next_frame(seq, 5.0)
+                if jpeg is None:
+                    continue
+                handler.wfile.write("--jpgboundary\r\n")
+                handler.send_header('Content-type','image/jpeg')
+                handler.send_header('Content-length',str(len(jpeg)))
+                handler.end_headers()
+                handler.wfile.write(jpeg)
+                handler.wfile.write('\r\n')
+                sent[0] += 1
+                sent[1] += len(jpeg)
+        except socket.error:
+            pass # client hung up
+        finally:
+            del self.clients[client]
+            self.sent[0] += sent[0]
+            self.sent[1] += sent[1]
+
+    def stats(self):
+        # Counters for metrics.Metrics, labelled with the stream name.  Not
+        # per client: every reconnect is a new port, and so a new series
+        # (the HUD has a stream_clients gauge for how many are watching).
+        retval = {
+            label("stream_encoded_frames", stream=self.name): self.seq,
+            label("stream_encoded_bytes", stream=self.name): self.encoded_bytes,
+            label("stream_encode_count", stream=self.name): self.encode_time.count,
+            label("stream_encode_seconds_total", stream=self.name): self.encode_time.total,
+        }
+        frames, nbytes = self.sent
+        for f,b in self.clients.values():
+            frames += f
+            nbytes += b
+        retval[label("stream_sent_frames", stream=self.name)] = frames
+        retval[label("stream_sent_bytes", stream=self.name)] = nbytes
+        return retval
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+# Satellite pass prediction for a whole TLE catalog at once.
+#
+#   passes.py catalog.txt config.json [--hours 12] [--min-alt 10]
+#
+# Instead of stepping each satellite through the night one ephem call at a
+# time (see upcoming_passes_in_window.ipynb), this propagates a chunk of
+# the catalog over a coarse time grid in one SatrecArray call, gets the
+# elevation of everything at every grid time in one batched alt_az_range,
+# and only goes looking for exact rise/culmination/set times in the grid
+# intervals where something happens.  Positions inside an interval come
+# from cubic Hermite interpolation of the SGP4 position and velocity at
+# its ends, so refining doesn't need any more propagation.
+
+import argparse
+from collections import namedtuple
+import ConfigParser
+import glob
+import json
+import time
+
+import numpy as np
+
+from eci import *
+
+# Times are unix seconds; alt/az (radians) are at culmination.  Passes
+# already underway when the window opens rise at its start, and ones
+# still up when it closes set at its end.
+Pass = namedtuple('Pass', ['sat', 'name', 'rise', 'culmination', 'set', 'alt', 'az'])
+
+RISE, CULMINATION, SET = 0, 1, 2
+
+GOLDEN = (np.sqrt(5) - 1)/2
+
+
+def parse_tles(lines):
+    # (name, line1, line2) for each TLE in lines, which may or may not have name lines
+    retval = []
+    lines = [ l.rstrip() for l in lines if l.strip() ]
+    i = 0
+    while i < len(lines) - 1:
+        if lines[i].startswith("1 ") and lines[i+1].startswith("2 "):
+            retval.append((lines[i][2:7].strip(), lines[i], lines[i+1]))
+            i += 2
+        elif i < len(lines) - 2 and lines[i+1].startswith("1 ") and lines[i+2].startswith("2 "):
+            name = lines[i][2:] if lines[i].startswith("0 ") else lines[i]
+            retval.append((name.strip(), lines[i+1], lines[i+2]))
+            i += 3
+        else:
+            raise ValueError("Can't make sense of TLE line %d: %r" % (i, lines[i]))
+    return retval
+
+def gpredict_tles(pattern):
+    # (name, line1, line2) from Gpredict's .sat files, eg ~/.config/Gpredict/satdata/*.sat
+    retval = []
+    for p in sorted(glob.glob(pattern)):
+        cp = ConfigParser.RawConfigParser()
+        cp.read(p)
+        retval.append((cp.get('Satellite', 'name'), cp.get('Satellite', 'TLE1'), cp.get('Satellite', 'TLE2')))
+    return retval
+
+def unix_to_jd(t):
+    # Split Julian dates (whole, fraction) for unix time(s) t, as sgp4 likes them
+    days = np.asarray(t, dtype=float)/86400.0
+    whole = np.floor(days)
+    return (whole + 2440587.5, days - whole)
+
+
+class Catalog:
+    "A set of satellites, propagated together with sgp4's SatrecArray"
+    def __init__(self, satrecs, names=None):
+        self.satrecs = list(satrecs)
+        self.names = list(names) if names is not None else [ str(s.satnum) for s in self.satrecs ]
+        self._array = None
+
+    @classmethod
+    def from_tles(cls, tles):
+        from sgp4.api import Satrec
+        return cls([ Satrec.twoline2rv(l1, l2) for name,l1,l2 in tles ], [ name for name,l1,l2 in tles ])
+
+    @classmethod
+    def load(cls, path):
+        # A plain TLE file, or a glob of Gpredict .sat files
+        if path.endswith(".sat"):
+            return cls.from_tles(gpredict_tles(path))
+        f = open(path)
+        tles = parse_tles(f.readlines())
+        f.close()
+        return cls.from_tles(tles)
+
+    def __len__(self):
+        return len(self.satrecs)
+
+    def __getitem__(self, s):
+        # A slice of the catalog is a catalog
+        return Catalog(self.satrecs[s], self.names[s])
+
+    def propagate(self, t):
+        """TEME position (km) and velocity (km/s) of every satellite at every unix time t
+
+        Returns (err, r, v), shaped (N,M), (N,M,3), (N,M,3).  TEME is close
+        enough to the frame eci.py rotates the earth in by GMST for our
+        purposes.  Where err is nonzero, r and v are NaN.
+        """
+        if self._array is None:
+            from sgp4.api import SatrecArray
+            self._array = SatrecArray(self.satrecs)
+        jd, fr = unix_to_jd(np.atleast_1d(t))
+        return self._array.sgp4(jd, fr)
+
+
+def hermite(r0, v0, r1, v1, dt, s):
+    # Cubic Hermite position at fraction s of the way across an interval of dt seconds
+    s = s[...,None]
+    s2 = s*s
+    s3 = s2*s
+    return ((2*s3 - 3*s2 + 1)*r0 + (s3 - 2*s2 + s)*dt*v0 +
+            (3*s2 - 2*s3)*r1 + (s3 - s2)*dt*v1)
+
+class Intervals:
+    """Elevations inside chosen grid intervals, for refining events
+
+    Each entry is one (satellite, grid interval) pair, and positions come
+    from interpolating across that interval.  The searches take a bracket
+    per entry, which defaults to the whole interval.
+    """
+    def __init__(self, observer, t_grid, r, v, sats, idx):
+        self.observer = observer
+        self.t0 = t_grid[idx]
+        self.dt = t_grid[idx+1] - t_grid[idx]
+        self.r0, self.v0 = r[sats,idx], v[sats,idx]
+        self.r1, self.v1 = r[sats,idx+1], v[sats,idx+1]
+
+    def __len__(self):
+        return len(self.t0)
+
+    def alt_az(self, t):
+        # Elevation and azimuth of each entry at its own time t
+        pos = hermite(self.r0, self.v0, self.r1, self.v1, self.dt[:,None], (t - self.t0)/self.dt)
+        alt, az, d = self.observer.alt_az_range(t, pos[None])
+        return (alt[0], az[0])
+
+    def elevation(self, t):
+        return self.alt_az(t)[0]
+
+    def _bracket(self, lo, hi):
+        lo = self.t0.copy() if lo is None else np.array(lo, dtype=float)
+        hi = self.t0 + self.dt if hi is None else np.array(hi, dtype=float)
+        return (lo, hi)
+
+    def flip(self, pred, tol, lo=None, hi=None):
+        # Bisect for where pred(t) (a bool per entry) comes true, given it's false at lo and true at hi
+        lo, hi = self._bracket(lo, hi)
+        for i in range(int(np.ceil(np.log2(max(np.max(hi - lo), tol)/tol)))):
+            mid = (lo + hi)/2
+            past = pred(mid)
+            hi = np.where(past, mid, hi)
+            lo = np.where(past, lo, mid)
+        return (lo + hi)/2
+
+    def bisect(self, rising, min_alt, tol, lo=None, hi=None):
+        # Where the elevation crosses min_alt, going up if rising, else down
+        return self.flip(lambda t: (self.elevation(t) > min_alt) == rising, tol, lo, hi)
+
+    def maximize(self, tol, lo=None, hi=None):
+        # Golden-section search for the highest elevation
+        a, b = self._bracket(lo, hi)
+        c = b - GOLDEN*(b - a)
+        d = a + GOLDEN*(b - a)
+        fc = self.elevation(c)
+        fd = self.elevation(d)
+        for i in range(int(np.ceil(np.log(max(np.max(b - a), tol)/tol)/np.log(1/GOLDEN)))):
+            left = fc > fd # the max is in [a, d]
+            b = np.where(left, d, b)
+            a = np.where(left, a, c)
+            # One old inner point carries over, so there's only one new one to evaluate
+            x = np.where(left, b - GOLDEN*(b - a), a + GOLDEN*(b - a))
+            fx = self.elevation(x)
+            c, d, fc, fd = (np.where(left, x, d), np.where(left, c, x),
+                            np.where(left, fx, fd), np.where(left, fc, fx))
+        return (a + b)/2
+
+
+def time_grid(t0, t1, step):
+    n = max(2, int(np.ceil((t1 - t0)/step)) + 1)
+    return np.linspace(t0, t0 + (n-1)*step, n)
+
+RATE_DT = 1.0 # seconds ahead, for elevation rates by finite difference
+
+def grid_frames(observer, t_grid):
+    # The observer frames elevations() needs, for computing once and sharing around
+    return (observer.frames(t_grid), observer.frames(t_grid + RATE_DT))
+
+def elevations(observer, t_grid, propagated, frames=None):
+    """Find out how high everything in propagated (catalog.propagate(t_grid)) is
+
+    frames is grid_frames(observer, t_grid), if it's already been done.
+    Returns (r, v, el, climbing, ok): TEME positions and velocities, (N,M)
+    elevations (radians) and whether each one's increasing, and an (N,M-1)
+    mask of the grid intervals that propagated cleanly at both ends.
+    """
+    err, r, v = propagated
+    if frames is None:
+        frames = grid_frames(observer, t_grid)
+
+    ok = (err == 0) # NB: r and v are NaN where it isn't
+    el = observer.alt_az_range(t_grid, r, frames[0])[0]
+    el_dt = observer.alt_az_range(t_grid + RATE_DT, r + v*RATE_DT, frames[1])[0]
+    el[~ok] = el_dt[~ok] = -np.pi
+    climbing = ok & (el_dt > el)
+    return (r, v, el, climbing, ok[:,:-1] & ok[:,1:])
+
+def peaks(climbing, ok):
+    # (sats, intervals) where the elevation tops out
+    return np.nonzero(climbing[:,:-1] & ~climbing[:,1:] & ok)
+
+def screen(catalog, observer, t_grid, min_alt=0.0, tol=0.01, offset=0, propagated=None, frames=None):
+    """Find the passes of every satellite in catalog over t_grid
+
+    min_alt is in radians.  Satellite numbers in the Passes returned
+    start at offset, for when catalog is one chunk of a bigger one.
+    propagated and frames can be passed in when screening the same chunk
+    from several sites (see elevations()).  Returns a list of Passes, in
+    no particular order.
+    """
+    if propagated is None:
+        propagated = catalog.propagate(t_grid)
+    r, v, el, climbing, ok = elevations(observer, t_grid, propagated, frames)
+    m = len(t_grid)
+    up = el > min_alt
+
+    events = [] # (sats, times, kind, alts, azs)
+
+    # Rises and sets are where up changes across an interval
+    for kind, change in ((RISE, ~up[:,:-1] & up[:,1:]), (SET, up[:,:-1] & ~up[:,1:])):
+        s, i = np.nonzero(change & ok)
+        if len(s):
+            iv = Intervals(observer, t_grid, r, v, s, i)
+            t = iv.bisect(kind == RISE, min_alt, tol)
+            alt, az = iv.alt_az(t)
+            events.append((s, t, kind, alt, az))
+
+    # The elevation peaks wherever it goes from climbing to not.  If that's
+    # between two grid times where it's below min_alt, this might be a short
+    # pass the grid stepped right over.
+    s, i = peaks(climbing, ok)
+    if len(s):
+        iv = Intervals(observer, t_grid, r, v, s, i)
+        tc = iv.maximize(tol)
+        alt, az = iv.alt_az(tc)
+        events.append((s, tc, CULMINATION, alt, az))
+
+        hidden = (alt > min_alt) & ~up[s,i] & ~up[s,i+1]
+        if np.any(hidden):
+            iv = Intervals(observer, t_grid, r, v, s[hidden], i[hidden])
+            tc = tc[hidden]
+            for kind, lo, hi in ((RISE, None, tc), (SET, tc, None)):
+                t = iv.bisect(kind == RISE, min_alt, tol, lo, hi)
+                alt, az = iv.alt_az(t)
+                events.append((s[hidden], t, kind, alt, az))
+
+    # Anything up at either end of the window rises or sets there
+    for kind, col in ((RISE, 0), (SET, m-1)):
+        s = np.flatnonzero(up[:,col])
+        if len(s):
+            alt, az, d = observer.alt_az_range(t_grid[col], r[s,col][:,None])
+            events.append((s, np.repeat(t_grid[col], len(s)), kind, alt[:,0], az[:,0]))
+
+    return assemble(catalog.names, events, offset)
+
+def assemble(names, events, offset=0):
+    # Pair up each satellite's rises and sets into Passes, with the highest point in between
+    if not events:
+        return []
+    sats = np.concatenate([ e[0] for e in events ])
+    times = np.concatenate([ e[1] for e in events ])
+    kinds = np.concatenate([ np.repeat(e[2], len(e[0])) for e in events ])
+    alts = np.concatenate([ e[3] for e in events ])
+    azs = np.concatenate([ e[4] for e in events ])
+
+    # By satellite, then time, then rise before culmination before set
+    order = np.lexsort((kinds, times, sats))
+
+    retval = []
+    current = None # [sat, rise, culmination, alt, az] for the pass we're in
+    for j in order:
+        sat, kind = sats[j], kinds[j]
+        if kind == RISE:
+            current = [sat, times[j], times[j], alts[j], azs[j]]
+            continue
+        if current is None or current[0] != sat:
+            continue # a peak below min_alt, or a pass cut short by a propagation error
+        if alts[j] > current[3]:
+            current[2:] = [times[j], alts[j], azs[j]]
+        if kind == SET:
+            retval.append(Pass(int(sat) + offset, names[sat], current[1], current[2], times[j], current[3], current[4]))
+            current = None
+    return retval
+
+def find_passes(catalog, observer, t0, t1, step=60.0, min_alt=0.0, tol=0.01, chunk=1024):
+    """Every pass above min_alt (radians) from observer between unix times t0 and t1
+
+    observer is an ECIObserver (or any ECIEarthPoints).  The catalog is
+    screened chunk satellites at a time, to keep the (chunk, grid, 3)
+    position arrays to a sensible size.  Returns Passes sorted by rise.
+    """
+    t_grid = time_grid(t0, t1, step)
+    retval = []
+    for i in range(0, len(catalog), chunk):
+        retval.extend(screen(catalog[i:i+chunk], observer, t_grid, min_alt, tol, offset=i))
+    retval.sort(key=lambda p: (p.rise, p.sat))
+    return retval
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Predict satellite passes for a TLE catalog")
+    parser.add_argument("catalog", help="TLE file (2 or 3 line), or a glob of Gpredict .sat files")
+    parser.add_argument("config", help="JSON config with the observer's loc, eg dev.json")
+    parser.add_argument("--start", type=float, default=None, help="unix time to start from (default: now)")
+    parser.add_argument("--hours", type=float, default=12.0)
+    parser.add_argument("--min-alt", type=float, default=10.0, help="degrees")
+    parser.add_argument("--step", type=float, default=60.0, help="coarse grid step, seconds")
+    args = parser.parse_args(argv)
+
+    f = open(args.config)
+    loc = json.load(f)['loc']
+    f.close()
+    qth = ECIObserver(np.deg2rad(loc['lat']), np.deg2rad(loc['lon']), loc['alt'])
+
+    t_load = time.time()
+    catalog = Catalog.load(args.catalog)
+    t_start = time.time()
+    t0 = args.start or t_start
+    passes = find_passes(catalog, qth, t0, t0 + args.hours*3600, args.step, np.deg2rad(args.min_alt))
+    t_end = time.time()
+
+    for p in passes:
+        print "%-24s %s  %s  %s  alt=%5.1f az=%5.1f" % (p.name[:24],
+            time.strftime("%H:%M:%S", time.localtime(p.rise)),
+            time.strftime("%H:%M:%S", time.localtime(p.culmination)),
+            time.strftime("%H:%M:%S", time.localtime(p.set)),
+            np.rad2deg(p.alt), np.rad2deg(p.az))
+    print "%d passes of %d satellites; loaded in %0.2fs, screened in %0.2fs" % (len(passes), len(catalog), t_start - t_load, t_end - t_start)
+
+if __name__ == '__main__':
+    main()
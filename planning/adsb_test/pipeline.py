@@ -0,0 +1,73 @@
+import os
+import signal
+import threading
+import time
+import traceback
+
+class LatestSlot:
+    """A single-slot queue where put() replaces anything not yet taken
+
+    This is what connects the stages of the frame pipeline: a producer
+    never blocks, and a consumer that falls behind only ever sees the
+    newest item, so latency stays bounded at about one item per stage.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.full = False
+
+        self.puts = 0
+        self.dropped = 0 # items replaced before anyone got to them
+
+    def put(self, item):
+        with self.cond:
+            if self.full:
+                self.dropped += 1
+            self.item = item
+            self.full = True
+            self.puts += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        # Take the item, waiting up to timeout seconds for one; None if nothing showed up
+        with self.cond:
+            if timeout is not None:
+                t_end = time.time() + timeout
+            while not self.full:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = t_end - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+
+            item = self.item
+            self.item = None
+            self.full = False
+            return item
+
+
+def start_stage(name, fn, src, dst):
+    """Run fn over everything put into src, putting its results into dst
+
+    This happens in a daemon thread, which is returned.  A None result is
+    dropped rather than passed along.  If fn raises, the traceback gets
+    printed and the whole process interrupted, like the HUD's other
+    workers, rather than the pipeline just stalling.
+    """
+    def run():
+        try:
+            while True:
+                retval = fn(src.get())
+                if retval is not None:
+                    dst.put(retval)
+        except Exception:
+            print "Error in %s stage:" % name
+            traceback.print_exc()
+            os.kill(os.getpid(), signal.SIGINT)
+
+    th = threading.Thread(name=name, target=run)
+    th.setDaemon(True)
+    th.start()
+    return th
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+
+# Calibrating the camera's pointing off the stars.
+#
+#   platesolve.py config.json frame.jpg [--time unix_time] [--force]
+#
+# The first time through, a frame goes off to astrometry.net's solve-field
+# (see ../20171128_starfield_cal/notes.txt), with hints about where it's
+# pointed and how wide it is to save it some searching.  That can take
+# minutes.  The solution (a TAN WCS) is cached on disk, keyed by the
+# config's camera_loc, camera FOV and the frame size, along with the
+# RA/Dec of the stars we could find in that frame.
+#
+# After that, checking the pointing is quick: find the stars in a new
+# frame, predict where the cached stars should be by now (the camera's
+# fixed, so the sky's just turned under it), match them up, and fit an
+# affine correction to the solution.  Only if too few stars match does
+# it go back to solve-field.
+#
+# A Solution has the same to_px/from_px/onscreen as fov.CameraProjection
+# and takes alt/az in the same (eci.sez_alt_az) convention, so the HUD can
+# use one in place of its linear projection.
+#
+# Pixels: WCSs use FITS's 1-based (x, y), which for the frames we give
+# solve-field is x = column + 1, y = row + 1 counting from the top.  Star
+# finding returns rows and columns, as OpenCV has them, and to_px returns
+# (px_alt, px_az) counting up from the bottom, like aa_deg2px.
+
+import argparse
+from collections import namedtuple
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from eci import GMST, sez_xform, sez_alt_az
+from detect import associate
+
+ARCSEC = np.deg2rad(1/3600.0)
+
+# Stars found in a frame: rows, columns (0-based, from the top left) and
+# background subtracted flux, brightest first
+Stars = namedtuple('Stars', ['y', 'x', 'flux'])
+
+
+############################################################
+# Coordinates
+
+def _R2(a):
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, 0, -s], [0, 1, 0], [s, 0, c]])
+
+def _R3(a):
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+
+def precession(t):
+    """Rotation from J2000 to the mean equator and equinox of unix time t (IAU 1976)
+
+    The ECI frame in eci.py is of date, and star catalogs (and so
+    solve-field) are J2000, which is a quarter degree off by now.
+    """
+    T = (t - GMST.T0_utc)/86400.0/36525 # Julian centuries since J2000
+    zeta = (2306.2181*T + 0.30188*T**2 + 0.017998*T**3)*ARCSEC
+    z = (2306.2181*T + 1.09468*T**2 + 0.018203*T**3)*ARCSEC
+    theta = (2004.3109*T - 0.42665*T**2 - 0.041833*T**3)*ARCSEC
+    return _R3(-z).dot(_R2(theta)).dot(_R3(-zeta))
+
+def radec_to_vec(ra, dec):
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    return np.stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)), axis=-1)
+
+def vec_to_radec(v):
+    ra = np.rad2deg(np.arctan2(v[...,1], v[...,0])) % 360
+    dec = np.rad2deg(np.arcsin(np.clip(v[...,2], -1, 1)))
+    return (ra, dec)
+
+def sez_to_j2000(t, lat, lon):
+    # Rotation from an observer's (south, east, zenith) at unix time t to J2000 (radians in)
+    lst = GMST.from_unix(t) + lon
+    return precession(t).T.dot(sez_xform(lat, lst).T)
+
+
+############################################################
+# FITS WCS
+
+def read_fits_header(path):
+    # The primary header of a FITS file (eg solve-field's .wcs) as a dict
+    retval = {}
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(2880)
+            if len(block) < 2880:
+                return retval
+            for i in range(0, 2880, 80):
+                card = block[i:i+80]
+                key = card[:8].strip()
+                if key == 'END':
+                    return retval
+                if card[8:10] != '= ':
+                    continue
+                value = card[10:].strip()
+                if value.startswith("'"):
+                    retval[key] = value[1:value.index("'", 1)].rstrip()
+                    continue
+                value = value.split('/')[0].strip()
+                if value in ('T', 'F'):
+                    retval[key] = (value == 'T')
+                    continue
+                try:
+                    retval[key] = int(value)
+                except ValueError:
+                    try:
+                        retval[key] = float(value.replace('D', 'E'))
+                    except ValueError:
+                        retval[key] = value
+    finally:
+        f.close()
+
+
+class WCS:
+    """A FITS TAN (gnomonic) world coordinate system: pixels <=> RA/Dec
+
+    crval is the RA/Dec (degrees) of the tangent point, crpix its (x, y)
+    pixel, and cd the 2x2 matrix taking pixel offsets to degrees in the
+    tangent plane.  Only the linear part is used: solve-field gets asked
+    for no SIP distortion terms, and refine() is affine as well.
+    """
+    def __init__(self, crval, crpix, cd):
+        self.crval = np.asarray(crval, dtype=float)
+        self.crpix = np.asarray(crpix, dtype=float)
+        self.cd = np.asarray(cd, dtype=float)
+        self.cd_inv = np.linalg.inv(self.cd)
+
+    @classmethod
+    def from_header(cls, h):
+        if 'TAN' not in h.get('CTYPE1', 'RA---TAN'):
+            raise ValueError("Only TAN projections are supported, not %s" % h['CTYPE1'])
+        if 'CD1_1' in h:
+            cd = [[h['CD1_1'], h.get('CD1_2', 0.0)], [h.get('CD2_1', 0.0), h['CD2_2']]]
+        else:
+            pc = np.array([[h.get('PC1_1', 1.0), h.get('PC1_2', 0.0)], [h.get('PC2_1', 0.0), h.get('PC2_2', 1.0)]])
+            cd = np.diag([h['CDELT1'], h['CDELT2']]).dot(pc)
+        return cls((h['CRVAL1'], h['CRVAL2']), (h['CRPIX1'], h['CRPIX2']), cd)
+
+    @classmethod
+    def read(cls, path):
+        return cls.from_header(read_fits_header(path))
+
+    def to_header(self):
+        return {
+            'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+            'CRVAL1': self.crval[0], 'CRVAL2': self.crval[1],
+            'CRPIX1': self.crpix[0], 'CRPIX2': self.crpix[1],
+            'CD1_1': self.cd[0,0], 'CD1_2': self.cd[0,1],
+            'CD2_1': self.cd[1,0], 'CD2_2': self.cd[1,1],
+        }
+
+    def pix_to_radec(self, x, y):
+        p = np.stack((np.asarray(x, dtype=float) - self.crpix[0], np.asarray(y, dtype=float) - self.crpix[1]), axis=-1)
+        xi, eta = np.deg2rad(p.dot(self.cd.T)).T
+        ra0, dec0 = np.deg2rad(self.crval)
+        den = np.cos(dec0) - eta*np.sin(dec0)
+        ra = ra0 + np.arctan2(xi, den)
+        dec = np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.sqrt(xi**2 + den**2))
+        return (np.rad2deg(ra) % 360, np.rad2deg(dec))
+
+    def radec_to_pix(self, ra, dec):
+        # (x, y, ok), where ok is False for anything behind the tangent plane
+        ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+        ra0, dec0 = np.deg2rad(self.crval)
+        d_ra = ra - ra0
+        cosc = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*np.cos(dec)*np.cos(d_ra)
+        ok = cosc > 1e-6
+        cosc = np.where(ok, cosc, 1)
+        xi = np.cos(dec)*np.sin(d_ra)/cosc
+        eta = (np.cos(dec0)*np.sin(dec) - np.sin(dec0)*np.cos(dec)*np.cos(d_ra))/cosc
+        p = np.rad2deg(np.stack((xi, eta), axis=-1)).dot(self.cd_inv.T)
+        return (p[...,0] + self.crpix[0], p[...,1] + self.crpix[1], ok)
+
+    def affine(self, A, b):
+        # The WCS for pixels moved by p' = A p + b
+        A = np.asarray(A, dtype=float)
+        return WCS(self.crval, A.dot(self.crpix) + b, self.cd.dot(np.linalg.inv(A)))
+
+    def scale(self):
+        # Degrees per pixel, about
+        return np.sqrt(abs(np.linalg.det(self.cd)))
+
+
+############################################################
+# Solutions
+
+class Solution:
+    """A plate solution for a fixed camera, as a projection from alt/az to pixels
+
+    wcs is the solution for a frame taken at unix time t, by an observer
+    at lat, lon (degrees), and shape is that frame's (height, width).
+    stars are the (K, 2) RA/Dec of the stars found in it, for refine().
+    The camera's fixed, so which alt/az lands on which pixel doesn't
+    depend on when you ask.
+    """
+    def __init__(self, wcs, t, lat, lon, shape, stars=None):
+        self.wcs = wcs
+        self.t = t
+        self.lat = lat
+        self.lon = lon
+        self.shape = tuple(shape)
+        self.stars = np.zeros((0, 2)) if stars is None else np.asarray(stars, dtype=float).reshape(-1, 2)
+        self.xform = sez_to_j2000(t, np.deg2rad(lat), np.deg2rad(lon))
+        self.px = self.shape # for code that wants a CameraProjection
+
+    def to_json(self):
+        return {
+            "wcs": self.wcs.to_header(),
+            "t": self.t,
+            "loc": [self.lat, self.lon],
+            "shape": list(self.shape),
+            "stars": self.stars.tolist(),
+        }
+
+    @classmethod
+    def from_json(cls, j):
+        return cls(WCS.from_header(j["wcs"]), j["t"], j["loc"][0], j["loc"][1], j["shape"], j.get("stars"))
+
+    def altaz_to_radec(self, alt, az):
+        # J2000 RA/Dec (degrees) of alt, az (degrees), as seen at self.t
+        alt, az = np.deg2rad(alt), np.deg2rad(az)
+        sez = np.stack((np.cos(alt)*np.cos(az), np.cos(alt)*np.sin(az), np.sin(alt)), axis=-1)
+        return vec_to_radec(sez.dot(self.xform.T))
+
+    def radec_to_altaz(self, ra, dec):
+        alt, az, d = sez_alt_az(radec_to_vec(ra, dec).dot(self.xform))
+        return (np.rad2deg(alt), np.rad2deg(az))
+
+    def to_px(self, alt, az):
+        # Fractional (px_alt, px_az) for arrays of alt, az in degrees; -1 for anything behind the camera
+        x, y, ok = self.wcs.radec_to_pix(*self.altaz_to_radec(alt, az))
+        return (np.where(ok, self.shape[0] - y, -1.0), np.where(ok, x - 1, -1.0))
+
+    def from_px(self, px_alt, px_az):
+        ra, dec = self.wcs.pix_to_radec(np.asarray(px_az) + 1, self.shape[0] - np.asarray(px_alt))
+        return self.radec_to_altaz(ra, dec)
+
+    def onscreen(self, px_alt, px_az):
+        return (px_alt >= 0) & (px_alt < self.shape[0]) & (px_az >= 0) & (px_az < self.shape[1])
+
+    def _border(self):
+        # alt, az (degrees) of points around the edge of the sensor
+        h, w = self.shape
+        across, up = np.linspace(0, w - 1, 64), np.linspace(0, h - 1, 64)
+        px_alt = np.concatenate((np.zeros(64), np.full(64, h - 1.0), up, up))
+        px_az = np.concatenate((across, across, np.zeros(64), np.full(64, w - 1.0)))
+        return self.from_px(px_alt, px_az)
+
+    def lowest(self):
+        # The lowest elevation (degrees) that lands on the sensor
+        return float(np.min(self._border()[0]))
+
+    def span(self):
+        # (alt, az) degrees either side of center() that land on the sensor, as FOVCull takes
+        alt0, az0 = self.center()
+        alt, az = self._border()
+        d_az = np.mod(az - az0 + 180, 360) - 180
+        return (float(np.max(np.abs(alt - alt0))), float(np.max(np.abs(d_az))))
+
+    def predict(self, ra, dec, t):
+        """FITS (x, y, ok) of J2000 RA/Dec in a frame taken at unix time t"""
+        now = sez_to_j2000(t, np.deg2rad(self.lat), np.deg2rad(self.lon))
+        # J2000 at t -> the observer's SEZ -> J2000 as it was at self.t
+        ra0, dec0 = vec_to_radec(radec_to_vec(ra, dec).dot(now).dot(self.xform.T))
+        return self.wcs.radec_to_pix(ra0, dec0)
+
+    def center(self):
+        # alt, az (degrees) of the middle of the frame
+        alt, az = self.from_px(self.shape[0]/2.0, self.shape[1]/2.0)
+        return (float(alt), float(az))
+
+
+def find_stars(img, n=60, k=5.0, blur=25, max_area=100):
+    """The n brightest star-like blobs in a uint8 frame (gray or RGB), as Stars
+
+    Stars are whatever's more than k noise sigmas above a box-blurred
+    background, and smaller than max_area pixels.
+    """
+    import cv2
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+    diff = cv2.subtract(gray, cv2.blur(gray, (blur, blur)))
+
+    sub = diff[::4, ::4]
+    med = np.median(sub)
+    sigma = max(1.4826*np.median(np.abs(sub - med)), 1.0)
+    ret, mask = cv2.threshold(diff, med + k*sigma, 255, cv2.THRESH_BINARY)
+
+    n_c, labels, comp, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    ys, xs = np.nonzero(mask)
+    if not len(ys):
+        return Stars(np.zeros(0), np.zeros(0), np.zeros(0))
+    lab = labels[ys, xs]
+    w = diff[ys, xs].astype(float)
+    flux = np.bincount(lab, weights=w, minlength=n_c)[1:]
+    cy = np.bincount(lab, weights=w*ys, minlength=n_c)[1:]/np.maximum(flux, 1e-9)
+    cx = np.bincount(lab, weights=w*xs, minlength=n_c)[1:]/np.maximum(flux, 1e-9)
+
+    ok = np.flatnonzero((comp[1:, cv2.CC_STAT_AREA] <= max_area) & (flux > 0))
+    order = ok[np.argsort(-flux[ok])][:n]
+    return Stars(cy[order], cx[order], flux[order])
+
+
+def refine(solution, stars, t, catalog=None, radius=10.0, min_matches=6, iterations=4):
+    """Correct solution against the Stars found in a frame taken at unix time t
+
+    The solution's own stars (and catalog's (K, 2) RA/Dec, if given)
+    are predicted into the frame, matched with what was found within
+    radius pixels, and an affine correction fit to the matches, with
+    outliers dropped.  Returns (refined Solution, matches, rms pixels),
+    or None if fewer than min_matches stars matched.
+    """
+    ref = solution.stars
+    if catalog is not None:
+        ref = np.concatenate((ref, catalog))
+    if not len(ref) or not len(stars.y):
+        return None
+
+    x, y, ok = solution.predict(ref[:,0], ref[:,1], t)
+    h, w = solution.shape
+    ok &= (x > -radius) & (x < w + radius) & (y > -radius) & (y < h + radius)
+    x, y = x[ok], y[ok]
+    found = Stars(stars.y + 1, stars.x + 1, stars.flux) # as FITS pixels
+
+    A, b = np.eye(2), np.zeros(2)
+    for it in range(iterations):
+        pred = np.column_stack((x, y)).dot(A.T) + b
+        p, q = associate(found, pred[:,1], pred[:,0], radius)
+        if len(p) < min_matches:
+            return None
+
+        P = np.column_stack((x[p], y[p], np.ones(len(p))))
+        Q = np.column_stack((found.x[q], found.y[q]))
+        for clip in range(2):
+            coef = np.linalg.lstsq(P, Q, rcond=None)[0] # Q = P . coef
+            r = np.sqrt(np.sum((Q - P.dot(coef))**2, axis=1))
+            rms = np.sqrt(np.mean(r**2))
+            good = r < max(3*rms, 1.0)
+            if good.all() or good.sum() < min_matches:
+                break
+            P, Q = P[good], Q[good]
+
+        A, b = coef[:2].T, coef[2]
+        radius = max(3*rms, 2.0)
+
+    refined = Solution(solution.wcs.affine(A, b), solution.t, solution.lat, solution.lon, solution.shape, solution.stars)
+    return (refined, len(P), rms)
+
+
+############################################################
+# solve-field
+
+def solve_field(img, t, hint=None, fov=None, solve_field="solve-field", config=None, cpulimit=300):
+    """Blind(ish) solve of a uint8 frame with astrometry.net, returning a WCS or None
+
+    hint is a Solution-like thing with altaz_to_radec and an (alt, az)
+    to start looking around, and fov the config's camera FOV (degrees);
+    either narrows down the search.
+    """
+    import cv2
+    tmp = tempfile.mkdtemp(prefix="platesolve")
+    try:
+        path = os.path.join(tmp, "frame.png")
+        cv2.imwrite(path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR) if img.ndim == 3 else img)
+
+        args = [solve_field, "--overwrite", "--no-plots", "--dir", tmp, "--new-fits", "none",
+                "--tweak-order", "1", "--cpulimit", str(int(cpulimit))]
+        if config:
+            args += ["--config", config]
+        if fov is not None:
+            # The HUD's FOV spans +/- fov across the frame (see aa_deg2px),
+            # so allow for it meaning either the whole width or half of it
+            width = max(fov)
+            args += ["--scale-units", "degwidth", "--scale-low", str(0.5*width), "--scale-high", str(2.5*width)]
+        if hint is not None:
+            solution, (alt, az) = hint
+            ra, dec = solution.altaz_to_radec(alt, az)
+            args += ["--ra", str(float(ra)), "--dec", str(float(dec)), "--radius", str(2*max(fov or (30,)))]
+        args.append(path)
+
+        out = open(os.path.join(tmp, "log"), "w")
+        try:
+            subprocess.call(args, stdout=out, stderr=subprocess.STDOUT)
+        finally:
+            out.close()
+
+        if not os.path.exists(os.path.join(tmp, "frame.solved")):
+            return None
+        return WCS.read(os.path.join(tmp, "frame.wcs"))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+class SolutionCache:
+    """Plate solutions, in a JSON file, looked up by approximate pointing and FOV
+
+    A cached solution is good for a heading (camera_loc alt/az) within
+    tolerance degrees, an FOV within 5%, and exactly the same frame size.
+    """
+    def __init__(self, path, tolerance=5.0):
+        self.path = path
+        self.tolerance = tolerance
+        self.entries = [] # (heading, fov, Solution)
+        if os.path.exists(path):
+            f = open(path)
+            for e in json.load(f)["solutions"]:
+                self.entries.append((e["heading"], e["fov"], Solution.from_json(e)))
+            f.close()
+
+    def _find(self, heading, fov, shape):
+        # Index of the nearest matching entry, or None
+        best, best_d = None, self.tolerance
+        for i,(h, f, solution) in enumerate(self.entries):
+            if tuple(solution.shape) != tuple(shape):
+                continue
+            if np.any(np.abs(np.asarray(f) - fov) > 0.05*np.asarray(fov)):
+                continue
+            a0, z0, a1, z1 = np.deg2rad([h[0], h[1], heading[0], heading[1]])
+            d = np.rad2deg(np.arccos(np.clip(np.sin(a0)*np.sin(a1) + np.cos(a0)*np.cos(a1)*np.cos(z1 - z0), -1, 1)))
+            if d <= best_d:
+                best, best_d = i, d
+        return best
+
+    def lookup(self, heading, fov, shape):
+        i = self._find(heading, fov, shape)
+        return None if i is None else self.entries[i][2]
+
+    def store(self, heading, fov, solution):
+        entry = (list(heading), list(fov), solution)
+        i = self._find(heading, fov, solution.shape)
+        if i is None:
+            self.entries.append(entry)
+        else:
+            self.entries[i] = entry
+
+        solutions = []
+        for h, f, s in self.entries:
+            j = s.to_json()
+            j["heading"], j["fov"] = h, f
+            solutions.append(j)
+        tmp = self.path + ".tmp"
+        f = open(tmp, "w")
+        json.dump({ "solutions": solutions }, f, indent=1)
+        f.close()
+        os.rename(tmp, self.path)
+
+
+class PlateSolver:
+    """Keeps a camera's plate solution current, from its frames
+
+    Takes the config's loc, camera_loc and camera.FOV, plus the camera's
+    "platesolve" section: cache (path), and optionally solve_field,
+    config (solve-field's), catalog (a CSV of ra,dec in degrees of extra
+    reference stars) and cpulimit.
+    """
+    def __init__(self, config):
+        pc = config['camera']['platesolve']
+        self.lat = config['loc']['lat']
+        self.lon = config['loc']['lon']
+        self.heading = (config['camera_loc']['alt'], config['camera_loc']['az'])
+        self.fov = tuple(config['camera']['FOV'])
+        self.cache = SolutionCache(pc.get('cache', 'platesolve.json'))
+        self.solve_field = pc.get('solve_field', 'solve-field')
+        self.solve_config = pc.get('config')
+        self.cpulimit = pc.get('cpulimit', 300)
+        self.catalog = load_catalog(pc['catalog']) if pc.get('catalog') else None
+
+        self.current = None
+        self.stats = { 'solves': 0, 'refines': 0, 'failures': 0, 'matches': 0, 'rms_px': 0.0 }
+
+    def cached(self, shape):
+        # The cached solution for frames of this shape, if there is one
+        if self.current is None or self.current.shape != tuple(shape):
+            self.current = self.cache.lookup(self.heading, self.fov, shape)
+        return self.current
+
+    def solve(self, img, t, stars=None):
+        # A full solve-field solve; returns the Solution, or None
+        if stars is None:
+            stars = find_stars(img)
+        hint = (Solution(WCS((0, 0), (0, 0), np.eye(2)), t, self.lat, self.lon, img.shape[:2]), self.heading)
+        wcs = solve_field(img, t, hint, self.fov, self.solve_field, self.solve_config, self.cpulimit)
+        if wcs is None:
+            self.stats['failures'] += 1
+            return None
+        ra, dec = wcs.pix_to_radec(stars.x + 1, stars.y + 1)
+        self.current = Solution(wcs, t, self.lat, self.lon, img.shape[:2], np.column_stack((ra, dec)))
+        self.cache.store(self.heading, self.fov, self.current)
+        self.stats['solves'] += 1
+        return self.current
+
+    def update(self, img, t, force=False):
+        """Check the pointing against a frame taken at unix time t
+
+        Refines the cached solution if there is one, falling back to a
+        full solve.  Returns the Solution (None if all that failed).
+        """
+        stars = find_stars(img)
+        solution = self.cached(img.shape[:2])
+        if solution is not None and not force:
+            r = refine(solution, stars, t, self.catalog)
+            if r is not None:
+                self.current, self.stats['matches'], self.stats['rms_px'] = r
+                self.stats['refines'] += 1
+                self.cache.store(self.heading, self.fov, self.current)
+                return self.current
+        return self.solve(img, t, stars)
+
+
+def load_catalog(path):
+    # (K, 2) RA/Dec, degrees, from a CSV with those as its first two columns ('#' for comments)
+    rows = []
+    f = open(path)
+    for l in f:
+        l = l.split('#')[0].strip()
+        if l:
+            rows.append([ float(v) for v in l.split(',')[:2] ])
+    f.close()
+    return np.array(rows).reshape(-1, 2)
+
+
+def main(argv=None):
+    import cv2
+
+    parser = argparse.ArgumentParser(description="Plate solve (or re-check) a frame from the HUD's camera")
+    parser.add_argument("config", help="JSON config with loc, camera_loc and camera, eg dev.json")
+    parser.add_argument("image")
+    parser.add_argument("--time", type=float, default=None, help="unix time the frame was taken (default: its mtime)")
+    parser.add_argument("--force", action="store_true", help="do a full solve even if there's a cached one")
+    args = parser.parse_args(argv)
+
+    f = open(args.config)
+    config = json.load(f)
+    f.close()
+    config['camera'].setdefault('platesolve', {})
+
+    img = cv2.imread(args.image)
+    if img is None:
+        raise SystemExit("Couldn't read %s" % args.image)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    t = args.time or os.path.getmtime(args.image)
+
+    solver = PlateSolver(config)
+    t0 = time.time()
+    solution = solver.update(img, t, args.force)
+    dt = time.time() - t0
+    if solution is None:
+        print "No solution (%0.1fs)" % dt
+        return
+
+    how = "refined" if solver.stats['refines'] else "solved"
+    ra, dec = solution.wcs.pix_to_radec(solution.shape[1]/2.0 + 1, solution.shape[0]/2.0 + 1)
+    print "%s in %0.2fs: center alt %0.3f az %0.3f (RA %0.3f Dec %0.3f), %0.2f arcmin/px" % (
+        how, dt, solution.center()[0], solution.center()[1], ra, dec, solution.wcs.scale()*60)
+    if solver.stats['refines']:
+        print "%d stars matched, %0.2f px rms" % (solver.stats['matches'], solver.stats['rms_px'])
+
+if __name__ == '__main__':
+    main()
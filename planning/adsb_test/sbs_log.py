@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Record and replay raw SBS-1 feeds, so we can reproduce load and bugs
+# without a dump1090 box.
+#
+#   sbs_log.py record out.sbslog[.gz] [host:port ...]
+#   sbs_log.py replay in.sbslog[.gz] [--speed 1.0]
+#
+# A log is a short header followed by one record per line received:
+# a little-endian float64 unix timestamp, a uint16 length, then the raw
+# line.  Uncompressed logs get memory-mapped for replay; a .gz suffix
+# gzips them instead, which only gets its trailer (and so only reads
+# back) once the writer's been closed.
+
+import argparse
+import gzip
+import mmap
+import struct
+import threading
+import time
+
+from adsb_listener import ADSBMultiListener
+
+MAGIC = "SBSLOG1\n"
+RECORD = struct.Struct("<dH")
+MAX_LINE = 0xffff # what RECORD's length can hold; nothing longer is a real SBS-1 line
+
+
+class SBSLogWriter:
+    """Appends timestamped raw SBS-1 lines to a log
+
+    Lines longer than MAX_LINE are counted in skipped rather than written.
+    close() can come from another thread (an atexit handler, say) while
+    the listener's still writing; anything written after that is dropped.
+    """
+    def __init__(self, path):
+        self.path = path
+        if path.endswith(".gz"):
+            self.f = gzip.open(path, "wb")
+        else:
+            self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        self.lock = threading.Lock()
+
+        self.n = 0
+        self.skipped = 0
+
+    def write(self, l, t=None):
+        self.write_lines([l], t)
+
+    def write_lines(self, lines, t=None):
+        # A whole batch from one recv, all stamped with the same time
+        t = t or time.time()
+        records = [ RECORD.pack(t, len(l)) + l for l in lines if len(l) <= MAX_LINE ]
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.write("".join(records))
+        self.n += len(records)
+        self.skipped += len(lines) - len(records)
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+class SBSLogReader:
+    "Iterates over the (t, line) records in a log"
+    def __init__(self, path):
+        self.path = path
+        if path.endswith(".gz"):
+            f = gzip.open(path, "rb")
+            self.data = f.read()
+            f.close()
+        else:
+            f = open(path, "rb")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s isn't an SBS log" % path)
+
+    def __iter__(self):
+        data = self.data
+        off = len(MAGIC)
+        end = len(data) - RECORD.size
+        while off <= end:
+            t, n = RECORD.unpack_from(data, off)
+            off += RECORD.size
+            yield (t, data[off:off+n])
+            off += n
+
+
+def replay(listener, log, speed=None, expire_after=10.0):
+    """Feed a recorded log through listener, as if it came off the wire
+
+    speed is a multiple of real time (1.0 is as recorded); None goes as
+    fast as possible.  The listener's clock follows the recorded
+    timestamps either way, so expiry and position timestamps behave as
+    they did live.  Lines from one recv share a timestamp, so batched
+    callbacks get flushed at the same points _poll() would have.
+
+    Returns (lines, wall clock seconds taken).
+    """
+    state = { "t": 0 }
+    listener.clock = lambda: state["t"]
+
+    n = 0
+    t_expire = None
+    t_wall0 = time.time()
+    t_log0 = None
+    t_prev = None
+
+    for t, l in log:
+        if t_log0 is None:
+            t_log0 = t
+            t_expire = t + 1
+        if speed:
+            delay = (t - t_log0)/speed - (time.time() - t_wall0)
+            if delay > 0:
+                time.sleep(delay)
+
+        if t != t_prev:
+            if listener.changed:
+                listener.maybe_flush()
+            t_prev = t
+
+        state["t"] = t
+        listener._handle(l, t)
+        listener.stats['lines'] += 1
+        n += 1
+
+        if expire_after and t >= t_expire:
+            listener.expire(t - expire_after)
+            t_expire = t + 1
+
+    listener.flush()
+    return (n, time.time() - t_wall0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record or replay SBS-1 feeds")
+    sub = parser.add_subparsers(dest="cmd")
+
+    p = sub.add_parser("record", help="record feeds to a log")
+    p.add_argument("log")
+    p.add_argument("feeds", nargs="*", default=["localhost:30003"], help="host:port")
+
+    p = sub.add_parser("replay", help="replay a log and report throughput")
+    p.add_argument("log")
+    p.add_argument("--speed", type=float, default=None, help="multiple of real time (default: flat out)")
+
+    args = parser.parse_args()
+
+    if args.cmd == "record":
+        al = ADSBMultiListener([ (s.split(":")[0], int(s.split(":")[1])) for s in args.feeds ], lambda p: None)
+        al.recorder = SBSLogWriter(args.log)
+        try:
+            while True:
+                if al.wait(1.0):
+                    al._poll()
+                al.expire(time.time() - 10)
+        except KeyboardInterrupt:
+            pass
+        al.recorder.close()
+        print "Recorded %d lines to %s" % (al.recorder.n, args.log)
+    else:
+        al = ADSBMultiListener([], lambda p: None)
+        n, dt = replay(al, SBSLogReader(args.log), args.speed)
+        print "Replayed %d lines in %0.3fs: %0.0f lines/sec, %d duplicates" % (n, dt, n/max(dt, 1e-9), al.duplicates)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Pass screening for a whole catalog from several sites at once, spread
+# across every core.
+#
+#   screening.py catalog.txt dev.json [kitchen.json ...] [--hours 12] [--processes N]
+#
+# The work is cut into tasks of (catalog chunk, time shard).  Each task
+# propagates its chunk once and screens it from every site (the
+# propagation doesn't care where you're standing).  The time grid and
+# every site's observer frames on it are computed up front into shared
+# memory before the workers fork, and the catalog comes along with the
+# fork too, so a task on the wire is just four indices.  Results are put
+# back together in task order, so the output doesn't depend on which
+# worker finished first.
+#
+# With one core (or --processes 1) everything runs in-process, through
+# the same code.
+
+import argparse
+import json
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import time
+
+import numpy as np
+
+from eci import *
+from passes import Catalog, grid_frames, screen, time_grid
+
+_TASK = None # what the workers need, set up by _init before they fork
+
+
+class SharedGrid:
+    "The time grid, and each site's grid_frames on it, in shared memory"
+    def __init__(self, observers, t_grid):
+        self.n_sites = len(observers)
+        self.m = len(t_grid)
+        self.raw_t = RawArray('d', self.m)
+        self.raw_pos = RawArray('d', self.n_sites*2*self.m*3)
+        self.raw_xform = RawArray('d', self.n_sites*2*self.m*9)
+
+        t, pos, xform = self.arrays()
+        t[:] = t_grid
+        for k, observer in enumerate(observers):
+            for j, (p, x) in enumerate(grid_frames(observer, t_grid)):
+                pos[k,j] = p
+                xform[k,j] = x
+
+    def arrays(self):
+        # NumPy views of the shared memory: t (M,), pos (sites,2,M,3), xform (sites,2,M,3,3)
+        t = np.frombuffer(self.raw_t, dtype=float)
+        pos = np.frombuffer(self.raw_pos, dtype=float).reshape(self.n_sites, 2, self.m, 3)
+        xform = np.frombuffer(self.raw_xform, dtype=float).reshape(self.n_sites, 2, self.m, 3, 3)
+        return (t, pos, xform)
+
+
+def _init(catalog, observers, shared, min_alt, tol):
+    global _TASK
+    t, pos, xform = shared.arrays()
+    _TASK = { "catalog": catalog, "observers": observers, "t": t, "pos": pos, "xform": xform,
+              "min_alt": min_alt, "tol": tol }
+
+def _screen_task(task):
+    # Screen catalog[lo:hi] over grid points a..b (inclusive) from every site
+    lo, hi, a, b = task
+    chunk = _TASK["catalog"][lo:hi]
+    t = _TASK["t"][a:b+1]
+    pos, xform = _TASK["pos"][:,:,a:b+1], _TASK["xform"][:,:,a:b+1]
+
+    propagated = chunk.propagate(t)
+    retval = []
+    for k, observer in enumerate(_TASK["observers"]):
+        frames = ((pos[k,0], xform[k,0]), (pos[k,1], xform[k,1]))
+        retval.append(screen(chunk, observer, t, _TASK["min_alt"], _TASK["tol"], lo, propagated, frames))
+    return retval
+
+
+def plan(n_sats, m, processes, chunk):
+    """Cut the work into (lo, hi, a, b) tasks: satellites lo:hi over grid points a..b
+
+    The catalog gets cut into chunks; if that's not enough tasks to keep
+    every process busy, the time grid gets cut into shards as well.
+    Neighbouring shards share their boundary grid point.
+    """
+    sat_ranges = [ (i, min(i + chunk, n_sats)) for i in range(0, n_sats, chunk) ]
+    n_shards = max(1, min(m - 1, -(-processes//max(len(sat_ranges), 1))))
+    bounds = np.unique(np.linspace(0, m - 1, n_shards + 1).astype(int))
+    return [ (lo, hi, a, b) for lo,hi in sat_ranges for a,b in zip(bounds[:-1], bounds[1:]) ]
+
+def merge(passes, boundaries):
+    # Join up passes that got cut in two at a time shard boundary; returns them sorted by rise
+    boundaries = set(boundaries)
+    retval = []
+    for p in sorted(passes, key=lambda p: (p.sat, p.rise, p.set)):
+        q = retval[-1] if retval else None
+        if q is not None and q.sat == p.sat and q.set == p.rise and p.rise in boundaries:
+            top = q if q.alt >= p.alt else p
+            retval[-1] = q._replace(set=p.set, culmination=top.culmination, alt=top.alt, az=top.az)
+        else:
+            retval.append(p)
+    retval.sort(key=lambda p: (p.rise, p.sat))
+    return retval
+
+def screen_sites(catalog, observers, t0, t1, step=60.0, min_alt=0.0, tol=0.01, processes=None, chunk=256):
+    """find_passes() for every observer in observers, spread over processes
+
+    processes defaults to one per core; with 1, it all happens in this
+    process.  Returns a list of Passes (sorted by rise) per observer.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    t_grid = time_grid(t0, t1, step)
+    tasks = plan(len(catalog), len(t_grid), processes, chunk)
+    shared = SharedGrid(observers, t_grid)
+
+    initargs = (catalog, observers, shared, min_alt, tol)
+    results = None
+    if processes > 1 and len(tasks) > 1:
+        try:
+            pool = multiprocessing.Pool(processes, _init, initargs)
+        except (OSError, ImportError), e:
+            print "Couldn't start worker processes (%s), screening in-process" % e
+        else:
+            try:
+                results = pool.map(_screen_task, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    if results is None:
+        _init(*initargs)
+        results = [ _screen_task(task) for task in tasks ]
+
+    boundaries = [ t_grid[a] for lo,hi,a,b in tasks if a > 0 ]
+    return [ merge([ p for r in results for p in r[k] ], boundaries) for k in range(len(observers)) ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Screen a TLE catalog for passes from several sites, on every core")
+    parser.add_argument("catalog", help="TLE file (2 or 3 line), or a glob of Gpredict .sat files")
+    parser.add_argument("configs", nargs="+", help="JSON configs with each site's loc, eg dev.json kitchen.json")
+    parser.add_argument("--start", type=float, default=None, help="unix time to start from (default: now)")
+    parser.add_argument("--hours", type=float, default=12.0)
+    parser.add_argument("--min-alt", type=float, default=10.0, help="degrees")
+    parser.add_argument("--processes", type=int, default=None, help="default: one per core")
+    args = parser.parse_args(argv)
+
+    observers = []
+    for path in args.configs:
+        f = open(path)
+        loc = json.load(f)['loc']
+        f.close()
+        observers.append(ECIObserver(np.deg2rad(loc['lat']), np.deg2rad(loc['lon']), loc['alt']))
+
+    catalog = Catalog.load(args.catalog)
+    t_start = time.time()
+    t0 = args.start or t_start
+    results = screen_sites(catalog, observers, t0, t0 + args.hours*3600,
+                           min_alt=np.deg2rad(args.min_alt), processes=args.processes)
+    t_end = time.time()
+
+    for path, passes in zip(args.configs, results):
+        print "%s: %d passes by %d satellites" % (path, len(passes), len(set(p.sat for p in passes)))
+    print "Screened %d satellites from %d sites in %0.2fs" % (len(catalog), len(observers), t_end - t_start)
+
+if __name__ == '__main__':
+    main()
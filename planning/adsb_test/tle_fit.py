@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Refine a TLE from our own observations of a pass.
+#
+# Observations are timestamped alt/az (in eci's alt_az convention, so
+# straight out of the HUD's pixels via CameraProjection.from_px) from a
+# site given as an ECIEarthPoints.  The fit is Levenberg-Marquardt on the
+# mean elements at the TLE's epoch.  Each Jacobian is one SatrecArray
+# call: the current elements plus one forward-difference perturbation per
+# element, all propagated to every observation time together, and turned
+# into alt/az in one batched alt_az_range.
+
+import calendar
+from collections import namedtuple
+import time
+
+import numpy as np
+
+from passes import unix_to_jd
+
+# Elements we know how to fit, and the forward-difference step for each
+# (radians, or rad/minute for no_kozai, or 1/earth radii for bstar)
+STEPS = {
+    'inclo': 1e-6,
+    'nodeo': 1e-6,
+    'ecco': 1e-7,
+    'argpo': 1e-6,
+    'mo': 1e-6,
+    'no_kozai': 1e-10,
+    'bstar': 1e-7,
+}
+
+# bstar barely shows up in one pass, so it's not fit by default
+ELEMENTS = ('inclo', 'nodeo', 'ecco', 'argpo', 'mo', 'no_kozai')
+
+# TLE bookkeeping the pure-Python Satrec doesn't carry through sgp4init,
+# and what to use if the template never had it either
+_COPIED = (('classification', 'U'), ('intldesg', ''), ('elnum', 0), ('revnum', 0), ('ephtype', 0))
+
+# satrec is the refined Satrec, tle its (line1, line2).  rms is the angular
+# residual (radians) before and after, and residuals the final (alt, az*cos(alt))
+# misses per observation.
+Fit = namedtuple('Fit', ['satrec', 'tle', 'rms0', 'rms', 'iterations', 'residuals'])
+
+
+def with_elements(template, names, values):
+    """New Satrecs like template, but with the elements in names set to each row of values"""
+    from sgp4.api import Satrec, WGS72
+
+    epoch = template.jdsatepoch + template.jdsatepochF - 2433281.5 # days since 1949 Dec 31
+    retval = []
+    for row in np.atleast_2d(values):
+        el = dict((n, getattr(template, n)) for n in STEPS)
+        el.update(zip(names, row))
+        s = Satrec()
+        s.sgp4init(WGS72, 'i', template.satnum, epoch, el['bstar'], template.ndot, template.nddot,
+                   el['ecco'], el['argpo'], el['inclo'], el['mo'], el['no_kozai'], el['nodeo'])
+        for a, default in _COPIED:
+            setattr(s, a, getattr(template, a, default))
+        s.epochyr, s.epochdays = _tle_epoch(template)
+        retval.append(s)
+    return retval
+
+def _tle_epoch(satrec):
+    # (2 digit year, fractional day of year) of satrec's epoch, as written in a TLE
+    if hasattr(satrec, 'epochyr'):
+        return (satrec.epochyr, satrec.epochdays)
+    t = (satrec.jdsatepoch + satrec.jdsatepochF - 2440587.5)*86400
+    year = time.gmtime(t).tm_year
+    return (year % 100, (t - calendar.timegm((year, 1, 1, 0, 0, 0)))/86400.0 + 1)
+
+def residuals(satrecs, observer, t, alt, az):
+    """Angular misses of each Satrec against the observations, as a (len(satrecs), 2K) array
+
+    The first K columns are the elevation misses, and the rest the
+    azimuth misses scaled by cos(alt), so both are in radians on the sky.
+    Satellites that fail to propagate get NaNs.
+    """
+    from sgp4.api import SatrecArray
+    jd, fr = unix_to_jd(t)
+    err, r, v = SatrecArray(satrecs).sgp4(jd, fr)
+    m_alt, m_az, d = observer.alt_az_range(t, r)
+
+    d_alt = m_alt - alt
+    d_az = (np.mod(m_az - az + np.pi, 2*np.pi) - np.pi)*np.cos(alt)
+    retval = np.concatenate((d_alt, d_az), axis=1)
+    retval[np.repeat(err != 0, 2, axis=1)] = np.nan
+    return retval
+
+def rms(res):
+    return np.sqrt(np.mean(res**2))
+
+
+def fit(satrec, observer, t, alt, az, elements=ELEMENTS, max_iter=20, tol=1e-6):
+    """Refine satrec's elements to best match observations (unix t, alt, az in radians)
+
+    Stops after max_iter iterations, or once an accepted step improves
+    the rms by less than a fraction tol.  Returns a Fit.
+    """
+    from sgp4.exporter import export_tle
+
+    t = np.asarray(t, dtype=float)
+    alt = np.asarray(alt, dtype=float)
+    az = np.asarray(az, dtype=float)
+    names = list(elements)
+    steps = np.array([ STEPS[n] for n in names ])
+
+    x = np.array([ getattr(satrec, n) for n in names ], dtype=float)
+    lam = 1e-3
+    best = satrec
+    res = residuals([satrec], observer, t, alt, az)[0]
+    rms0 = cost = rms(res)
+
+    it = -1 # max_iter=0 is just the starting rms, after 0 iterations
+    for it in range(max_iter):
+        # The current elements and every perturbation of them, in one go
+        X = np.vstack((x, x + np.diag(steps)))
+        R = residuals(with_elements(satrec, names, X), observer, t, alt, az)
+        res = R[0]
+        J = ((R[1:] - res)/steps[:,None]).T # (2K, P)
+
+        # Columns are wildly differently scaled (radians vs rad/min), so normalize them
+        scale = np.sqrt(np.sum(J**2, axis=0))
+        scale[scale == 0] = 1
+        Jn = J/scale
+        A = Jn.T.dot(Jn)
+        g = Jn.T.dot(res)
+
+        improved = False
+        while lam < 1e10:
+            dx = -np.linalg.solve(A + lam*np.diag(np.diag(A)), g)/scale
+            trial = with_elements(satrec, names, x + dx)
+            trial_res = residuals(trial, observer, t, alt, az)[0]
+            trial_cost = rms(trial_res)
+            if trial_cost < cost: # NaN (a failed propagation) never is
+                improved = True
+                break
+            lam *= 10
+
+        if not improved:
+            break
+        x += dx
+        best = trial[0]
+        res = trial_res
+        lam = max(lam/10, 1e-9)
+        done = (cost - trial_cost) < tol*cost
+        cost = trial_cost
+        if done:
+            break
+
+    return Fit(best, export_tle(best), rms0, cost, it+1, res)
+
+def fit_pixels(satrec, observer, proj, t, px):
+    """fit() from pixel observations: px is (K,2) as (y, x), in proj's (CameraProjection's) coordinates"""
+    px = np.asarray(px, dtype=float)
+    alt, az = proj.from_px(px[:,0], px[:,1])
+    return fit(satrec, observer, t, np.deg2rad(alt), np.deg2rad(az))